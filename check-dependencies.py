@@ -125,6 +125,17 @@ except ImportError:
   optional += 1
 
 
+# Test for scandir
+try:
+  from os import scandir
+except ImportError:
+  try:
+    import scandir
+  except ImportError:
+    sys.stderr.write("[OPTIONAL] Unable to import the 'scandir' module, do you have scandir installed for python %s? This feature is not required but speeds up finding metrics in large whisper directories.\n" % py_version)
+    optional += 1
+
+
 # Test for python-ldap
 try:
   import ldap
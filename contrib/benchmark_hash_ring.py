@@ -0,0 +1,67 @@
+#!/usr/bin/env python
+"""Compares the carbon_ch and fnv1a_ch consistent hashing schemes used by
+CarbonLink: how evenly metrics spread over the carbon-caches, and how fast
+metrics are looked up with and without the lookup cache.
+
+Usage: PYTHONPATH=/opt/graphite/webapp benchmark_hash_ring.py [caches] [metrics]
+"""
+import bisect
+import os
+import sys
+import time
+from hashlib import md5
+
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "graphite.settings")
+from graphite.render.hashing import ConsistentHashRing
+
+
+def uncached_get_nodes(ring, key):
+  "The ring walk performed for every lookup before lookups were precomputed"
+  position = ring.compute_ring_position(key)
+  index = bisect.bisect_left(ring.ring, (position, None)) % ring.ring_len
+  last_index = (index - 1) % ring.ring_len
+  nodes = []
+  while len(nodes) < ring.nodes_len and index != last_index:
+    node = ring.ring[index][1]
+    if node not in nodes:
+      nodes.append(node)
+    index = (index + 1) % ring.ring_len
+  return nodes
+
+
+def distribution(ring, metrics):
+  counts = dict((node, 0) for node in ring.nodes)
+  for metric in metrics:
+    counts[ring.get_node(metric)] += 1
+  expected = float(len(metrics)) / len(counts)
+  return (min(counts.values()) / expected, max(counts.values()) / expected)
+
+
+def throughput(lookup, metrics):
+  t = time.time()
+  for metric in metrics:
+    lookup(metric)
+  return len(metrics) / (time.time() - t)
+
+
+def main(cache_count=24, metric_count=200000):
+  hosts = [('127.0.0.1', 'cache%d' % i) for i in range(cache_count)]
+  metrics = ['servers.host%d.%s.metric%d' % (i % 997, md5(str(i)).hexdigest()[:6], i)
+             for i in range(metric_count)]
+
+  print "%d carbon-caches, %d metrics" % (cache_count, metric_count)
+  for hash_type in ConsistentHashRing.hash_types:
+    ring = ConsistentHashRing(hosts, hash_type=hash_type)
+    cached_ring = ConsistentHashRing(hosts, hash_type=hash_type, cache_size=metric_count)
+    throughput(cached_ring.get_nodes, metrics) # warm the cache
+
+    (lowest, highest) = distribution(ring, metrics)
+    print "%s:" % hash_type
+    print "  least / most loaded cache: %.2f / %.2f of the fair share" % (lowest, highest)
+    print "  ring walk:       %10.0f lookups/s" % throughput(lambda m: uncached_get_nodes(ring, m), metrics)
+    print "  precomputed:     %10.0f lookups/s" % throughput(ring.get_nodes, metrics)
+    print "  precomputed+LRU: %10.0f lookups/s" % throughput(cached_ring.get_nodes, metrics)
+
+
+if __name__ == '__main__':
+  main(*[int(arg) for arg in sys.argv[1:]])
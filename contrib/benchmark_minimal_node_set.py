@@ -0,0 +1,109 @@
+#!/usr/bin/env python
+"""Compares Store.find's selection of the minimal node set of each path with
+the selection it replaced, which measured every remaining node again each
+time it took one, on synthetic replicas with fragmented intervals.
+
+Usage: PYTHONPATH=/opt/graphite/webapp benchmark_minimal_node_set.py [paths] [replicas] [gaps]
+"""
+import os
+import random
+import sys
+import time
+
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "graphite.settings")
+from graphite.intervals import Interval, IntervalSet
+from graphite.node import LeafNode
+from graphite.storage import select_minimal_node_set
+
+
+class StaticReader(object):
+  __slots__ = ('intervals',)
+
+  def __init__(self, intervals):
+    self.intervals = intervals
+
+  def get_intervals(self):
+    return self.intervals
+
+
+def quadratic_minimal_node_set(leaf_nodes, query_interval, prior_to_window=None):
+  "The selection Store.find used before select_minimal_node_set()"
+  minimal_node_set = set()
+  covered_intervals = [IntervalSet([])]
+
+  def measure_of_added_coverage(node, drop_window=prior_to_window is not None):
+    relevant_intervals = node.intervals.intersect_interval(query_interval)
+    if drop_window:
+      relevant_intervals = relevant_intervals.intersect_interval(prior_to_window)
+    return covered_intervals[0].union(relevant_intervals).size - covered_intervals[0].size
+
+  nodes_remaining = list(leaf_nodes)
+
+  for node in leaf_nodes:
+    if node.local and measure_of_added_coverage(node, False) > 0:
+      nodes_remaining.remove(node)
+      minimal_node_set.add(node)
+      covered_intervals[0] = covered_intervals[0].union(node.intervals)
+
+  while nodes_remaining:
+    node_coverages = [ (measure_of_added_coverage(n), n) for n in nodes_remaining ]
+    best_coverage, best_node = max(node_coverages)
+
+    if best_coverage == 0:
+      break
+
+    nodes_remaining.remove(best_node)
+    minimal_node_set.add(best_node)
+    covered_intervals[0] = covered_intervals[0].union(best_node.intervals)
+
+  return minimal_node_set
+
+
+def fragmented_intervals(start, end, gaps):
+  "Returns an IntervalSet spanning start to end with gaps random holes"
+  points = sorted( random.uniform(start, end) for i in range(gaps * 2) )
+  bounds = [start] + points + [end]
+  return IntervalSet([ Interval(bounds[i], bounds[i + 1]) for i in range(0, len(bounds), 2) ])
+
+
+def build_paths(path_count, replica_count, gaps, now):
+  paths = []
+  for i in range(path_count):
+    nodes = []
+    for j in range(replica_count):
+      node = LeafNode('servers.host%d.metric' % i, StaticReader(None))
+      node.intervals = fragmented_intervals(now - 86400 * 7, now, gaps)
+      node.local = (j == 0)
+      nodes.append(node)
+    paths.append(nodes)
+  return paths
+
+
+def measure(select, paths, query_interval, prior_to_window):
+  t = time.time()
+  node_sets = [ select(nodes, query_interval, prior_to_window) for nodes in paths ]
+  return (time.time() - t, node_sets)
+
+
+def main(path_count=10000, replica_count=4, gaps=8):
+  random.seed(0)
+  now = time.time()
+  paths = build_paths(path_count, replica_count, gaps, now)
+  query_interval = Interval(now - 86400 * 7, now)
+  prior_to_window = Interval(float('-inf'), now - 600)
+
+  print "%d paths of %d replicas with %d gaps each" % (path_count, replica_count, gaps)
+  (quadratic, expected) = measure(quadratic_minimal_node_set, paths, query_interval, prior_to_window)
+  (heap, node_sets) = measure(select_minimal_node_set, paths, query_interval, prior_to_window)
+
+  def covered(node_set):
+    return reduce(lambda covered, node: covered.union(node.intervals), node_set, IntervalSet([])).size
+  same = sum(1 for (a, b) in zip(expected, node_sets) if a == b or covered(a) == covered(b))
+
+  print "  %-28s %8.3fs" % ("measure every node", quadratic)
+  print "  %-28s %8.3fs" % ("lazy priority queue", heap)
+  print "  %d of %d paths get the same coverage" % (same, path_count)
+
+
+if __name__ == '__main__':
+  main(*[int(arg) for arg in sys.argv[1:]])
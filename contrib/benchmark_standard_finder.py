@@ -0,0 +1,122 @@
+#!/usr/bin/env python
+"""Compares StandardFinder's directory traversal with the listdir() and
+isdir()/isfile() traversal it replaced, on a synthetic whisper tree.
+
+Usage: PYTHONPATH=/opt/graphite/webapp benchmark_standard_finder.py [dirs] [files per dir]
+"""
+import os
+import shutil
+import sys
+import tempfile
+import time
+from os.path import isdir, isfile, join
+
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "graphite.settings")
+from graphite import finders
+from graphite.finders import match_entries
+from graphite.finders.standard import StandardFinder
+from graphite.readers import RRDReader
+from graphite.storage import FindQuery
+
+
+class ListdirStandardFinder(StandardFinder):
+  "The traversal StandardFinder used before it relied on directory entry types"
+  def _find_paths(self, current_dir, patterns):
+    pattern = patterns[0]
+    patterns = patterns[1:]
+    entries = os.listdir(current_dir)
+
+    subdirs = [entry for entry in entries if isdir(join(current_dir, entry))]
+    matching_subdirs = match_entries(subdirs, pattern)
+
+    if len(patterns) == 1 and RRDReader.supported:
+      files = [entry for entry in entries if isfile(join(current_dir, entry))]
+      match_entries(files, pattern + ".rrd")
+
+    if patterns:
+      for subdir in matching_subdirs:
+        for match in self._find_paths(join(current_dir, subdir), patterns):
+          yield match
+
+    else:
+      files = [entry for entry in entries if isfile(join(current_dir, entry))]
+      matching_files = match_entries(files, pattern + '.*')
+
+      for base_name in matching_files + matching_subdirs:
+        absolute_path = join(current_dir, base_name)
+        # find_nodes() then tested every result again
+        is_dir = isdir(absolute_path)
+        if not is_dir:
+          isfile(absolute_path)
+        yield (absolute_path, is_dir)
+
+
+class StatCounter:
+  "Counts the os.stat() and os.lstat() calls made while traversing"
+  def __init__(self):
+    self.calls = 0
+    self.stat = os.stat
+    self.lstat = os.lstat
+
+  def counted(self, func):
+    def call(*args):
+      self.calls += 1
+      return func(*args)
+    return call
+
+  def __enter__(self):
+    os.stat = self.counted(self.stat)
+    os.lstat = self.counted(self.lstat)
+    return self
+
+  def __exit__(self, *exc_info):
+    os.stat = self.stat
+    os.lstat = self.lstat
+
+
+def build_tree(root, dir_count, file_count):
+  for i in range(dir_count):
+    directory = join(root, 'servers', 'host%d' % i)
+    os.makedirs(directory)
+    for j in range(file_count):
+      open(join(directory, 'metric%d.wsp' % j), 'w').close()
+
+
+def measure(finder, pattern, repeat=5):
+  query = FindQuery(pattern, None, None)
+  with StatCounter() as counter:
+    best = None
+    for i in range(repeat):
+      t = time.time()
+      nodes = list(finder.find_nodes(query))
+      elapsed = time.time() - t
+      best = elapsed if best is None else min(best, elapsed)
+  return (best, counter.calls / repeat, len(nodes))
+
+
+def main(dir_count=20, file_count=5000):
+  root = tempfile.mkdtemp(prefix='graphite-finder-')
+  try:
+    build_tree(root, dir_count, file_count)
+    print "%d directories of %d whisper files, scandir %s" % (
+      dir_count, file_count, "available" if finders.scandir else "unavailable")
+
+    scandir = finders.scandir
+    for pattern in ['servers.*.*', 'servers.*.metric1*', 'servers.host1.*',
+                    'servers.host1.metric1']:
+      print "%s:" % pattern
+      runs = [('listdir + isdir/isfile', ListdirStandardFinder([root]), scandir),
+              ('listdir + one stat', StandardFinder([root]), None)]
+      if scandir:
+        runs.append( ('scandir', StandardFinder([root]), scandir) )
+
+      for (name, finder, finders.scandir) in runs:
+        (elapsed, stats, nodes) = measure(finder, pattern)
+        print "  %-24s %8.3fs %8d stat() calls %8d nodes" % (name, elapsed, stats, nodes)
+      finders.scandir = scandir
+  finally:
+    shutil.rmtree(root)
+
+
+if __name__ == '__main__':
+  main(*[int(arg) for arg in sys.argv[1:]])
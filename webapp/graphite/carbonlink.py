@@ -3,7 +3,9 @@ import socket
 import struct
 import errno
 import random
+import bisect
 from select import select
+from threading import Condition, Lock
 from django.conf import settings
 from graphite.render.hashing import ConsistentHashRing
 from graphite.logger import log
@@ -24,25 +26,42 @@ def load_keyfunc():
     return lambda x: x
 
 
+# Read-only requests, which can safely be sent to a second replica
+HEDGED_REQUEST_TYPES = ('cache-query', 'cache-query-bulk', 'get-metadata')
+
+
 class CarbonLinkPool:
   def __init__(self, hosts, timeout):
     self.hosts = [ (server, instance) for (server, port, instance) in hosts ]
+    # A port is either a TCP port number or the path of a unix domain socket
     self.ports = dict( ((server, instance), port) for (server, port, instance) in hosts )
+    if len(self.ports) < len(self.hosts):
+      raise Exception("CARBONLINK_HOSTS must not list the same server and instance twice")
     self.timeout = float(timeout)
     servers = set([server for (server, port, instance) in hosts])
     if len(servers) < settings.REPLICATION_FACTOR:
       raise Exception("REPLICATION_FACTOR=%d cannot exceed servers=%d" % (settings.REPLICATION_FACTOR, len(servers)))
 
-    self.hash_ring = ConsistentHashRing(self.hosts)
+    self.hash_ring = ConsistentHashRing(self.hosts,
+                                        hash_type=settings.CARBONLINK_HASHING_TYPE,
+                                        cache_size=settings.CARBONLINK_HASHING_CACHE_SIZE)
     self.keyfunc = load_keyfunc()
-    self.connections = {}
+    self.connections = ConnectionPool(settings.CARBONLINK_POOL_SIZE,
+                                      settings.CARBONLINK_POOL_IDLE_TIMEOUT)
     self.last_failure = {}
-    # Create a connection pool for each host
-    for host in self.hosts:
-      self.connections[host] = set()
+    self.latencies = dict( (host, LatencyHistogram()) for host in self.hosts )
 
   def select_host(self, metric):
     "Returns the carbon host that has data for the given metric"
+    return self.get_replicas(metric)[0]
+
+  def get_replicas(self, metric):
+    """Returns the carbon hosts holding the given metric, starting with a random
+    available one and followed by the other replicas in ring order"""
+    return self.order_replicas( self.ring_replicas(metric) )
+
+  def ring_replicas(self, metric):
+    "Returns the carbon hosts holding the given metric in ring order"
     key = self.keyfunc(metric)
     nodes = []
     servers = set()
@@ -54,35 +73,50 @@ class CarbonLinkPool:
       nodes.append(node)
       if len(servers) >= settings.REPLICATION_FACTOR:
         break
+    return nodes
 
+  def order_replicas(self, nodes):
+    "Moves a random available host of nodes to the front"
     available = [ n for n in nodes if self.is_available(n) ]
-    return random.choice(available or nodes)
+    first = random.choice(available or nodes)
+    return [first] + [ n for n in nodes if n != first ]
 
   def is_available(self, host):
     now = time.time()
     last_fail = self.last_failure.get(host, 0)
     return (now - last_fail) < settings.CARBONLINK_RETRY_DELAY
 
-  def get_connection(self, host):
+  def get_connection(self, host, timeout=None):
+    """Returns a connection to host, waiting up to timeout (by default the
+    CarbonLink timeout) for one when the pool of that host is full"""
+    if timeout is None:
+      timeout = self.timeout
     # First try to take one out of the pool for this host
     (server, instance) = host
     port = self.ports[host]
-    connectionPool = self.connections[host]
-    try:
-      return connectionPool.pop()
-    except KeyError:
-      pass #nothing left in the pool, gotta make a new connection
+    connection = self.connections.get(host, timeout)
+    if connection is not None:
+      return connection
+    #nothing usable left in the pool, gotta make a new connection
 
     log.cache("CarbonLink creating a new socket for %s" % str(host))
-    connection = socket.socket()
-    connection.settimeout(self.timeout)
     try:
-      connection.connect( (server, port) )
+      if isinstance(port, basestring):
+        connection = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        address = port
+      else:
+        connection = socket.socket()
+        address = (server, port)
+      connection.settimeout(self.timeout)
+      connection.connect(address)
     except:
       self.last_failure[host] = time.time()
+      self.connections.discard(host, connection)
       raise
     else:
-      connection.setsockopt( socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1 )
+      if connection.family == socket.AF_INET:
+        connection.setsockopt( socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1 )
+      self.connections.count('created')
       return connection
 
   def query(self, metric):
@@ -103,59 +137,216 @@ class CarbonLinkPool:
     log.cache("CarbonLink set-metadata request received for %s:%s" % (metric, key))
     return results
 
+  def query_bulk(self, metrics):
+    """Returns a dict mapping each metric to the datapoints carbon's cache holds
+    for it, sending a single cache-query-bulk request to each carbon-cache"""
+    datapoints_by_metric = {}
+    carbon_metrics = []
+    other_metrics = []
+
+    for metric in metrics:
+      if metric.startswith(settings.CARBON_METRIC_PREFIX):
+        carbon_metrics.append(metric)
+      else:
+        other_metrics.append(metric)
+
+    # carbon's own metrics are held by every carbon-cache
+    if carbon_metrics:
+      requests = [ dict(type='cache-query', metric=metric) for metric in carbon_metrics ]
+      responses = self.send_requests( dict((host, requests) for host in self.hosts) )
+      for metric in carbon_metrics:
+        datapoints_by_metric[metric] = []
+      for host_results in responses.values():
+        for metric, result in zip(carbon_metrics, host_results):
+          if len(result.get('datapoints', [])) > 1:
+            datapoints_by_metric[metric].extend(result['datapoints'])
+
+    if self.hedging:
+      # Metrics sharing their replicas are hedged together, whatever order the
+      # ring lists them in. The replica asked first is picked per group.
+      metrics_by_replicas = {}
+      for metric in other_metrics:
+        metrics_by_replicas.setdefault(tuple(sorted(self.ring_replicas(metric))), []).append(metric)
+
+      groups = [ (self.order_replicas(list(replicas)), host_metrics)
+                 for (replicas, host_metrics) in metrics_by_replicas.items() ]
+      jobs = [ (dict(type='cache-query-bulk', metrics=host_metrics), replicas)
+               for (replicas, host_metrics) in groups ]
+      answers = [ (replicas[0], host_metrics, result or {})
+                  for ((replicas, host_metrics), result) in zip(groups, self.send_hedged(jobs)) ]
+    else:
+      metrics_by_host = {}
+      for metric in other_metrics:
+        metrics_by_host.setdefault(self.select_host(metric), []).append(metric)
+
+      requests_by_host = dict( (host, [dict(type='cache-query-bulk', metrics=host_metrics)])
+                               for (host, host_metrics) in metrics_by_host.items() )
+      responses = self.send_requests(requests_by_host)
+      answers = [ (host, host_metrics, responses.get(host, [{}])[0])
+                  for (host, host_metrics) in metrics_by_host.items() ]
+
+    unsupported = {}
+    for host, host_metrics, result in answers:
+      if 'error' in result:
+        # Older carbon-caches do not understand bulk queries
+        log.cache("CarbonLink cache-query-bulk unsupported by %s, querying metrics one by one" % str(host))
+        unsupported.setdefault(host, []).extend(host_metrics)
+        continue
+
+      host_datapoints = result.get('datapointsByMetric', {})
+      for metric in host_metrics:
+        datapoints_by_metric[metric] = host_datapoints.get(metric, [])
+      log.cache("CarbonLink cache-query-bulk request to %s for %d metrics returned %d datapoints" %
+                (str(host), len(host_metrics), sum(len(d) for d in host_datapoints.values())))
+
+    # Fall back to cache-query requests, pipelined on one connection per host
+    requests_by_host = dict( (host, [dict(type='cache-query', metric=metric) for metric in host_metrics])
+                             for (host, host_metrics) in unsupported.items() )
+    responses = self.send_requests(requests_by_host)
+
+    for host, host_metrics in unsupported.items():
+      for metric in host_metrics:
+        datapoints_by_metric[metric] = []
+      for metric, result in zip(host_metrics, responses.get(host, [])):
+        datapoints_by_metric[metric] = result.get('datapoints', [])
+
+    return datapoints_by_metric
+
   def send_request(self, request):
     metric = request['metric']
-    serialized_request = pickle.dumps(request, protocol=-1)
-    len_prefix = struct.pack("!L", len(serialized_request))
-    request_packet = len_prefix + serialized_request
-    result = {}
-    result.setdefault('datapoints', [])
-
     if metric.startswith(settings.CARBON_METRIC_PREFIX):
       return self.send_request_to_all(request)
 
+    # Writes such as set-metadata must reach a single carbon-cache
+    if self.hedging and request['type'] in HEDGED_REQUEST_TYPES:
+      result = self.send_hedged([ (request, self.get_replicas(metric)) ])[0]
+      if result is None:
+        return dict(datapoints=[])
+      if 'error' in result:
+        log.cache("Error getting data from cache: %s" % result['error'])
+        raise CarbonLinkRequestError(result['error'])
+      return result
+
     host = self.select_host(metric)
-    conn = self.get_connection(host)
-    log.cache("CarbonLink sending request for %s to %s" % (metric, str(host)))
-    try:
-      conn.sendall(request_packet)
-      result = self.recv_response(conn)
-    except Exception,e:
-      self.last_failure[host] = time.time()
-      log.cache("Exception getting data from cache %s: %s" % (str(host), e))
-    else:
-      self.connections[host].add(conn)
+    return self.send_request_to_host(host, request)
+
+  @property
+  def hedging(self):
+    return settings.CARBONLINK_HEDGED_REQUESTS and settings.REPLICATION_FACTOR > 1
+
+  def hedge_delay(self, host):
+    """Time to wait for host before also asking the next replica, the
+    CARBONLINK_HEDGE_PERCENTILE of its recent latencies"""
+    delay = self.latencies[host].percentile(settings.CARBONLINK_HEDGE_PERCENTILE)
+    if delay is None: # not enough samples yet
+      return self.timeout / 2
+    return min(delay, self.timeout)
+
+  def send_request_to_host(self, host, request):
+    result = {}
+    result.setdefault('datapoints', [])
+
+    responses = self.send_requests({host : [request]})
+    if host in responses:
+      result = responses[host][0]
       if 'error' in result:
         log.cache("Error getting data from cache: %s" % result['error'])
         raise CarbonLinkRequestError(result['error'])
-      log.cache("CarbonLink finished receiving %s from %s" % (str(metric), str(host)))
     return result
 
   def send_request_to_all(self, request):
     metric = request['metric']
-    serialized_request = pickle.dumps(request, protocol=-1)
-    len_prefix = struct.pack("!L", len(serialized_request))
-    request_packet = len_prefix + serialized_request
     results = {}
     results.setdefault('datapoints', [])
 
-    for host in self.hosts:
-      conn = self.get_connection(host)
-      log.cache("CarbonLink sending request for %s to %s" % (metric, str(host)))
-      try:
-        conn.sendall(request_packet)
-        result = self.recv_response(conn)
-      except Exception,e:
-        self.last_failure[host] = time.time()
-        log.cache("Exception getting data from cache %s: %s" % (str(host), e))
+    responses = self.send_requests( dict((host, [request]) for host in self.hosts) )
+    for host, host_results in responses.items():
+      result = host_results[0]
+      if 'error' in result:
+        log.cache("Error getting data from cache %s: %s" % (str(host), result['error']))
       else:
-        self.connections[host].add(conn)
-        if 'error' in result:
-          log.cache("Error getting data from cache %s: %s" % (str(host), result['error']))
-        else:
-          if len(result['datapoints']) > 1:
-              results['datapoints'].extend(result['datapoints'])
-      log.cache("CarbonLink finished receiving %s from %s" % (str(metric), str(host)))
+        if len(result['datapoints']) > 1:
+            results['datapoints'].extend(result['datapoints'])
+    log.cache("CarbonLink finished receiving %s from %d hosts" % (str(metric), len(responses)))
+    return results
+
+  def send_requests(self, requests_by_host):
+    """Sends each host its list of requests, pipelined over a single connection,
+    and waits for the responses of all hosts at once within one overall
+    timeout, which also bounds waiting for pooled connections. Returns a dict mapping hosts to their list of responses, hosts
+    that failed or did not answer in time are left out."""
+    exchange = RequestExchange(self)
+    responses = {}
+
+    for host, requests in requests_by_host.items():
+      if requests and exchange.send(host, [ (request, None) for request in requests ]):
+        responses[host] = []
+
+    while exchange.busy():
+      remaining = exchange.deadline - time.time()
+      if remaining <= 0:
+        break
+
+      (received, failed) = exchange.receive(remaining)
+      for (host, tag, response) in received:
+        responses[host].append(response)
+      for (host, tags) in failed:
+        del responses[host]
+
+    for host in exchange.close():
+      responses.pop(host, None)
+
+    return responses
+
+  def send_hedged(self, jobs):
+    """Sends each (request, hosts) job to the first of its hosts. When that host
+    has not answered within its hedge_delay(), or fails, the request is also
+    sent to the next host and the first response received wins. Returns the
+    responses in the order of jobs, None for jobs no host answered in time."""
+    exchange = RequestExchange(self)
+    results = [None] * len(jobs)
+    attempts = [0] * len(jobs)
+    hedge_at = {} # job index -> time at which to try its next host
+    unanswered = set(range(len(jobs)))
+
+    def attempt(i):
+      (request, hosts) = jobs[i]
+      hedge_at.pop(i, None)
+      while attempts[i] < len(hosts):
+        host = hosts[attempts[i]]
+        attempts[i] += 1
+        if exchange.send(host, [ (request, i) ]):
+          if attempts[i] < len(hosts):
+            hedge_at[i] = time.time() + self.hedge_delay(host)
+          return
+
+    for i in range(len(jobs)):
+      attempt(i)
+
+    while unanswered and exchange.busy():
+      now = time.time()
+      if now >= exchange.deadline:
+        break
+
+      wake_up = min([exchange.deadline] + hedge_at.values())
+      (received, failed) = exchange.receive( max(0, wake_up - now) )
+      for (host, i, response) in received:
+        if i in unanswered:
+          results[i] = response
+          unanswered.discard(i)
+          hedge_at.pop(i, None)
+      for (host, tags) in failed:
+        for i in tags:
+          if i in unanswered:
+            attempt(i)
+
+      now = time.time()
+      for i, hedge_time in hedge_at.items():
+        if hedge_time <= now and i in unanswered:
+          log.cache("CarbonLink hedging request to %s" % str(jobs[i][1][attempts[i]]))
+          attempt(i)
+
+    exchange.close()
     return results
 
   def recv_response(self, conn):
@@ -169,6 +360,249 @@ class CarbonLinkRequestError(Exception):
   pass
 
 
+class RequestExchange:
+  """Requests in flight to several carbon-caches at once, pipelined over one
+  connection per host. Every request carries a tag handed back along with its
+  response. The whole exchange, waits for pooled connections included, ends
+  at its deadline, one CarbonLink timeout after it started."""
+  def __init__(self, pool):
+    self.pool = pool
+    self.deadline = time.time() + pool.timeout
+    self.hosts = {} # connection -> host
+    self.connections = {} # host -> connection
+    self.buffers = {}
+    self.outstanding = {} # host -> [(tag, sent_at)], oldest first
+
+  def busy(self):
+    return bool(self.connections)
+
+  def send(self, host, tagged_requests):
+    "Sends (request, tag) pairs to host, returns False if that failed"
+    log.cache("CarbonLink sending %d requests to %s" % (len(tagged_requests), str(host)))
+    conn = self.connections.get(host)
+    try:
+      if conn is None:
+        conn = self.pool.get_connection(host, max(0, self.deadline - time.time()))
+      conn.sendall( ''.join(serialize_request(request) for (request, tag) in tagged_requests) )
+    except ConnectionPoolExhausted,e:
+      log.cache("CarbonLink not sending requests to %s: %s" % (str(host), e))
+      return False
+    except Exception,e:
+      self.pool.last_failure[host] = time.time()
+      log.cache("Exception sending requests to cache %s: %s" % (str(host), e))
+      if host in self.connections:
+        self.drop(host)
+      elif conn is not None:
+        self.pool.connections.discard(host, conn)
+      return False
+
+    if host not in self.connections:
+      self.connections[host] = conn
+      self.hosts[conn] = host
+      self.buffers[conn] = ''
+      self.outstanding[host] = []
+    now = time.time()
+    self.outstanding[host].extend( (tag, now) for (request, tag) in tagged_requests )
+    return True
+
+  def receive(self, timeout):
+    """Waits up to timeout for responses. Returns a list of received
+    (host, tag, response) and a list of failed (host, [tag, ...])."""
+    received = []
+    failed = []
+
+    for conn in select(self.hosts.keys(), [], [], timeout)[0]:
+      host = self.hosts[conn]
+      try:
+        data = conn.recv(65536)
+        if not data:
+          raise Exception("Connection lost")
+        self.buffers[conn] += data
+        (messages, self.buffers[conn]) = split_responses(self.buffers[conn])
+        if len(messages) > len(self.outstanding[host]):
+          raise Exception("Received %d responses for %d outstanding requests" %
+                          (len(messages), len(self.outstanding[host])))
+        responses = [ unpickle.loads(message) for message in messages ]
+      except Exception,e:
+        self.pool.last_failure[host] = time.time()
+        log.cache("Exception getting data from cache %s: %s" % (str(host), e))
+        failed.append( (host, [tag for (tag, sent_at) in self.drop(host)]) )
+        continue
+
+      now = time.time()
+      for response in responses:
+        (tag, sent_at) = self.outstanding[host].pop(0)
+        self.pool.latencies[host].record(now - sent_at)
+        received.append( (host, tag, response) )
+
+      if not self.outstanding[host]:
+        log.cache("CarbonLink finished receiving responses from %s" % str(host))
+        self.pool.connections.put(host, conn)
+        self.forget(host)
+
+    return (received, failed)
+
+  def close(self):
+    """Drops connections still waiting on responses, as they are out of sync,
+    and returns their hosts"""
+    now = time.time()
+    hosts = self.connections.keys()
+    for host in hosts:
+      log.cache("Timed out getting data from cache %s" % str(host))
+      outstanding = self.drop(host)
+      # Slow hosts must show in their latency histogram even when their
+      # responses are abandoned
+      self.pool.latencies[host].record(now - outstanding[0][1])
+    return hosts
+
+  def drop(self, host):
+    conn = self.connections[host]
+    outstanding = self.outstanding[host]
+    self.forget(host)
+    self.pool.connections.discard(host, conn)
+    return outstanding
+
+  def forget(self, host):
+    conn = self.connections.pop(host)
+    del self.hosts[conn]
+    del self.buffers[conn]
+    del self.outstanding[host]
+
+
+class LatencyHistogram:
+  """Histogram of recent request latencies over logarithmic buckets. Counts are
+  halved whenever max_samples is reached so it follows changes in latency."""
+  bounds = [ 0.0005 * (2 ** (i / 2.0)) for i in range(32) ] # 0.5ms to ~23s
+  min_samples = 20
+
+  def __init__(self, max_samples=1000):
+    self.max_samples = max_samples
+    self.counts = [0] * (len(self.bounds) + 1)
+    self.total = 0
+    self.lock = Lock()
+
+  def record(self, latency):
+    bucket = bisect.bisect_left(self.bounds, latency)
+    with self.lock:
+      self.counts[bucket] += 1
+      self.total += 1
+      if self.total >= self.max_samples:
+        self.counts = [ count / 2 for count in self.counts ]
+        self.total = sum(self.counts)
+
+  def percentile(self, percent):
+    "Returns the upper bound of the latency percentile or None without enough samples"
+    with self.lock:
+      if self.total < self.min_samples:
+        return None
+
+      threshold = self.total * percent / 100.0
+      seen = 0
+      for bucket, count in enumerate(self.counts):
+        seen += count
+        if seen >= threshold:
+          break
+
+    if bucket < len(self.bounds):
+      return self.bounds[bucket]
+    return float('inf')
+
+
+class ConnectionPool:
+  """Thread-safe pool of CarbonLink connections. At most max_size connections
+  are open to each host, checked out or idle, and callers wait for one to be
+  released beyond that. Connections idle for longer than idle_timeout seconds
+  are closed, and idle connections are checked to still be alive before being
+  handed out again."""
+  def __init__(self, max_size, idle_timeout):
+    self.max_size = max_size
+    self.idle_timeout = idle_timeout
+    self.condition = Condition()
+    self.idle = {} # host -> [(connection, released_at)], most recent last
+    self.open = {} # host -> number of open connections
+    self.stats = dict(created=0, reused=0, expired=0, stale=0, exhausted=0)
+
+  def count(self, stat):
+    with self.condition:
+      self.stats[stat] += 1
+
+  def idle_count(self, host):
+    with self.condition:
+      return len(self.idle.get(host, []))
+
+  def open_count(self, host):
+    with self.condition:
+      return self.open.get(host, 0)
+
+  def get(self, host, timeout):
+    """Returns a live idle connection to host, or None when the caller may open
+    a new one, which it must then put() or discard(). Raises
+    ConnectionPoolExhausted when neither happened within timeout seconds."""
+    deadline = time.time() + timeout
+    with self.condition:
+      while True:
+        idle = self.idle.get(host)
+        while idle:
+          (connection, released_at) = idle.pop()
+          if time.time() - released_at > self.idle_timeout:
+            self.stats['expired'] += 1
+            self.close(host, connection)
+            continue
+
+          try:
+            alive = still_connected(connection)
+          except socket.error:
+            alive = False
+
+          if not alive:
+            log.cache("CarbonLink discarding a connection to %s closed by the peer" % str(host))
+            self.stats['stale'] += 1
+            self.close(host, connection)
+            continue
+
+          self.stats['reused'] += 1
+          return connection
+
+        if self.open.get(host, 0) < self.max_size:
+          self.open[host] = self.open.get(host, 0) + 1
+          return None
+
+        remaining = deadline - time.time()
+        if remaining <= 0:
+          self.stats['exhausted'] += 1
+          raise ConnectionPoolExhausted("%d connections to %s already open" % (self.max_size, str(host)))
+        self.condition.wait(remaining)
+
+  def put(self, host, connection):
+    "Makes a connection taken with get() available again"
+    now = time.time()
+    with self.condition:
+      idle = self.idle.setdefault(host, [])
+      for (c, released_at) in list(idle):
+        if now - released_at > self.idle_timeout:
+          idle.remove( (c, released_at) )
+          self.stats['expired'] += 1
+          self.close(host, c)
+      idle.append( (connection, now) )
+      self.condition.notify()
+
+  def discard(self, host, connection=None):
+    "Gives up a connection taken with get(), or the slot for one that failed to open"
+    with self.condition:
+      self.close(host, connection)
+      self.condition.notify()
+
+  def close(self, host, connection):
+    # Called with the condition held
+    self.open[host] -= 1
+    if connection is not None:
+      connection.close()
+
+
+class ConnectionPoolExhausted(Exception):
+  pass
+
+
 # Socket helper functions
 def still_connected(sock):
   is_readable = select([sock], [], [], 0)[0]
@@ -189,6 +623,25 @@ def still_connected(sock):
     return True
 
 
+def serialize_request(request):
+  serialized_request = pickle.dumps(request, protocol=-1)
+  len_prefix = struct.pack("!L", len(serialized_request))
+  return len_prefix + serialized_request
+
+
+def split_responses(buf):
+  "Splits complete length-prefixed messages off the front of buf"
+  messages = []
+  while len(buf) >= 4:
+    body_size = struct.unpack("!L", buf[:4])[0]
+    if len(buf) < 4 + body_size:
+      break
+    messages.append( buf[4:4 + body_size] )
+    buf = buf[4 + body_size:]
+
+  return (messages, buf)
+
+
 def recv_exactly(conn, num_bytes):
   buf = ''
   while len(buf) < num_bytes:
@@ -200,18 +653,40 @@ def recv_exactly(conn, num_bytes):
   return buf
 
 
-#parse hosts from local_settings.py
-hosts = []
-for host in settings.CARBONLINK_HOSTS:
-  parts = host.split(':')
-  server = parts[0]
-  port = int( parts[1] )
-  if len(parts) > 2:
-    instance = parts[2]
-  else:
-    instance = None
+def parse_hosts(carbonlink_hosts):
+  """Parses "server:port[:instance]" and "unix:/path/to/socket[:instance]"
+  entries into (server, port, instance) tuples. Unix domain sockets always
+  live on this machine, so they hash as the loopback address just like the
+  TCP entries they replace. They are placed by instance name only, so no two
+  local entries may share an instance name."""
+  hosts = []
+  seen = {}
+  for host in carbonlink_hosts:
+    if host.startswith('unix:'):
+      parts = host[len('unix:'):].split(':')
+      server = '127.0.0.1'
+      port = parts[0]
+    else:
+      parts = host.split(':')
+      server = parts.pop(0)
+      port = int( parts[0] )
+
+    if len(parts) > 1:
+      instance = parts[1]
+    else:
+      instance = None
 
-  hosts.append( (server, int(port), instance) )
+    if (server, instance) in seen:
+      raise Exception("CARBONLINK_HOSTS entries %s and %s both hash as %s:%s, give them distinct instance names" %
+                      (seen[(server, instance)], host, server, instance))
+    seen[(server, instance)] = host
+    hosts.append( (server, port, instance) )
+
+  return hosts
+
+
+#parse hosts from local_settings.py
+hosts = parse_hosts(settings.CARBONLINK_HOSTS)
 
 
 #A shared importable singleton
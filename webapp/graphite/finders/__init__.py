@@ -1,5 +1,17 @@
-import fnmatch
+import os
 import os.path
+import re
+import stat
+
+from graphite.util import LRUCache
+
+try:
+  from os import scandir
+except ImportError:
+  try:
+    from scandir import scandir
+  except ImportError:
+    scandir = None
 
 
 def get_real_metric_path(absolute_path, metric_path):
@@ -20,30 +32,143 @@ def fs_to_metric(path):
   return os.path.join(dirpath, filename.split('.')[0]).replace(os.sep,'.')
 
 
-def _deduplicate(entries):
-  yielded = set()
-  for entry in entries:
-    if entry not in yielded:
-      yielded.add(entry)
-      yield entry
+def list_directory(path, symlinks=None):
+  """Returns the names of the subdirectories and of the files in path. With
+  scandir the entry types come from the directory listing itself, so only
+  symbolic links and entries of unreported type get stat()ed. The names of
+  symbolic links are also appended to symlinks when given."""
+  subdirs = []
+  files = []
+
+  if scandir is not None:
+    for entry in scandir(path):
+      if entry.is_dir():
+        subdirs.append(entry.name)
+      elif entry.is_file():
+        files.append(entry.name)
+      else:
+        continue
+
+      if symlinks is not None and entry.is_symlink():
+        symlinks.append(entry.name)
+
+  else:
+    for name in os.listdir(path):
+      entry_path = os.path.join(path, name)
+      try:
+        mode = os.lstat(entry_path).st_mode
+        if stat.S_ISLNK(mode):
+          mode = os.stat(entry_path).st_mode
+          if symlinks is not None:
+            symlinks.append(name)
+      except OSError:
+        continue
+
+      if stat.S_ISDIR(mode):
+        subdirs.append(name)
+      elif stat.S_ISREG(mode):
+        files.append(name)
+
+  return (subdirs, files)
+
+
+# Compiled matchers of the pattern components seen recently
+pattern_cache = LRUCache(10000)
 
 
 def match_entries(entries, pattern):
   """A drop-in replacement for fnmatch.filter that supports pattern
-  variants (ie. {foo,bar}baz = foobaz or barbaz)."""
-  v1, v2 = pattern.find('{'), pattern.find('}')
+  variants (ie. {foo,bar}baz = foobaz or barbaz), including several and
+  nested brace groups. Matching entries are returned sorted."""
+  matcher = compile_pattern(pattern)
+  return sorted( entry for entry in entries if matcher(entry) )
 
-  if v1 > -1 and v2 > v1:
-    variations = pattern[v1+1:v2].split(',')
-    variants = [ pattern[:v1] + v + pattern[v2+1:] for v in variations ]
-    matching = []
 
-    for variant in variants:
-      matching.extend( fnmatch.filter(entries, variant) )
+def compile_pattern(pattern):
+  "Returns a function matching entries against pattern with a single regex"
+  matcher = pattern_cache.get(pattern)
+  if matcher is None:
+    matcher = re.compile(translate_pattern(pattern), re.DOTALL).match
+    pattern_cache.set(pattern, matcher)
+  return matcher
 
-    return list( _deduplicate(matching) ) #remove dupes without changing order
 
-  else:
-    matching = fnmatch.filter(entries, pattern)
-    matching.sort()
-    return matching
+def translate_pattern(pattern):
+  """Translates a glob pattern component to a regular expression. Like
+  fnmatch.translate, with {a,b} alternatives and backslash escapes."""
+  braces = _brace_pairs(pattern)
+  groups = [] # closing brace indexes of the groups being translated
+  regex = []
+  i = 0
+  n = len(pattern)
+
+  while i < n:
+    c = pattern[i]
+    if c == '\\' and i + 1 < n:
+      regex.append( re.escape(pattern[i + 1]) )
+      i += 2
+      continue
+
+    if c == '*':
+      regex.append('.*')
+    elif c == '?':
+      regex.append('.')
+    elif c == '[':
+      end = _class_end(pattern, i)
+      if end is None:
+        regex.append('\\[')
+      else:
+        chars = pattern[i + 1:end].replace('\\', '\\\\')
+        if chars[0] == '!':
+          chars = '^' + chars[1:]
+        elif chars[0] == '^':
+          chars = '\\' + chars
+        regex.append('[%s]' % chars)
+        i = end
+    elif c == '{' and i in braces:
+      regex.append('(?:')
+      groups.append(braces[i])
+    elif c == ',' and groups:
+      regex.append('|')
+    elif c == '}' and groups and groups[-1] == i:
+      regex.append(')')
+      groups.pop()
+    else:
+      regex.append( re.escape(c) )
+    i += 1
+
+  return ''.join(regex) + '\\Z'
+
+
+def _class_end(pattern, start):
+  "Returns the index of the ] closing the character class opened at start"
+  i = start + 1
+  if i < len(pattern) and pattern[i] == '!':
+    i += 1
+  if i < len(pattern) and pattern[i] == ']':
+    i += 1
+  end = pattern.find(']', i)
+  if end < 0:
+    return None
+  return end
+
+
+def _brace_pairs(pattern):
+  "Maps the index of every balanced { in pattern to that of its }"
+  pairs = {}
+  stack = []
+  i = 0
+
+  while i < len(pattern):
+    c = pattern[i]
+    if c == '\\':
+      i += 1
+    elif c == '[':
+      i = _class_end(pattern, i) or i
+    elif c == '{':
+      stack.append(i)
+    elif c == '}' and stack:
+      pairs[stack.pop()] = i
+    i += 1
+
+  return pairs
@@ -7,6 +7,7 @@ from ceres import CeresTree, CeresNode
 from django.conf import settings
 from graphite.node import BranchNode, LeafNode
 from graphite.readers import CeresReader
+from graphite.util import is_pattern
 
 from . import get_real_metric_path
 
@@ -18,7 +19,15 @@ class CeresFinder:
     self.tree = CeresTree(directory)
 
   def find_nodes(self, query):
-    for fs_path in glob( self.tree.getFilesystemPath(query.pattern) ):
+    fs_pattern = self.tree.getFilesystemPath(query.pattern)
+    if is_pattern(query.pattern):
+      fs_paths = glob(fs_pattern)
+    elif os.path.exists(fs_pattern):
+      fs_paths = [fs_pattern]
+    else:
+      fs_paths = []
+
+    for fs_path in fs_paths:
       metric_path = self.tree.getNodePath(fs_path)
 
       if CeresNode.isNodeDir(fs_path):
@@ -1,13 +1,22 @@
-import os
-from os.path import isdir, isfile, join, basename
+import sys
+from functools import partial
+from os.path import isdir, isfile, join, basename, sep
 from django.conf import settings
 
 from graphite.logger import log
+from graphite.metrics.catalog import get_catalog
 from graphite.node import BranchNode, LeafNode
 from graphite.readers import WhisperReader, GzippedWhisperReader, RRDReader
-from graphite.util import find_escaped_pattern_fields
+from graphite.util import find_escaped_pattern_fields, is_pattern
 
-from . import fs_to_metric, get_real_metric_path, match_entries
+from . import fs_to_metric, get_real_metric_path, list_directory, match_entries
+
+
+# Extensions of the files a literal metric name may be stored in
+LEAF_EXTENSIONS = [ extension for (extension, reader) in [('.wsp', WhisperReader),
+                                                          ('.wsp.gz', GzippedWhisperReader),
+                                                          ('.rrd', RRDReader)]
+                    if reader.supported ]
 
 
 class StandardFinder:
@@ -18,75 +27,106 @@ class StandardFinder:
     self.directories = directories
 
   def find_nodes(self, query):
+    for root_dir in self.directories:
+      for node in self.find_nodes_in(query, root_dir):
+        yield node
+
+  def find_tasks(self, query):
+    "Splits a find into one task per root directory, see Store.find()"
+    return [ partial(self.find_nodes_in, query, root_dir) for root_dir in self.directories ]
+
+  def find_nodes_in(self, query, root_dir):
     clean_pattern = query.pattern.replace('\\', '')
     pattern_parts = clean_pattern.split('.')
+    catalog = get_catalog()
 
-    for root_dir in self.directories:
-      for absolute_path in self._find_paths(root_dir, pattern_parts):
-        if basename(absolute_path).startswith('.'):
-          continue
-
-        if self.DATASOURCE_DELIMETER in basename(absolute_path):
-          (absolute_path, datasource_pattern) = absolute_path.rsplit(self.DATASOURCE_DELIMETER, 1)
-        else:
-          datasource_pattern = None
-
-        relative_path = absolute_path[ len(root_dir): ].lstrip('/')
-        metric_path = fs_to_metric(relative_path)
-        real_metric_path = get_real_metric_path(absolute_path, metric_path)
-
-        metric_path_parts = metric_path.split('.')
-        for field_index in find_escaped_pattern_fields(query.pattern):
-          metric_path_parts[field_index] = pattern_parts[field_index].replace('\\', '')
-        metric_path = '.'.join(metric_path_parts)
-
-        # Now we construct and yield an appropriate Node object
-        if isdir(absolute_path):
-          yield BranchNode(metric_path)
-
-        elif isfile(absolute_path):
-          if absolute_path.endswith('.wsp') and WhisperReader.supported:
-            reader = WhisperReader(absolute_path, real_metric_path)
-            yield LeafNode(metric_path, reader)
-
-          elif absolute_path.endswith('.wsp.gz') and GzippedWhisperReader.supported:
-            reader = GzippedWhisperReader(absolute_path, real_metric_path)
-            yield LeafNode(metric_path, reader)
-
-          elif absolute_path.endswith('.rrd') and RRDReader.supported:
-            if datasource_pattern is None:
-              yield BranchNode(metric_path)
-
-            else:
-              for datasource_name in RRDReader.get_datasources(absolute_path):
-                if match_entries([datasource_name], datasource_pattern):
-                  reader = RRDReader(absolute_path, datasource_name)
-                  yield LeafNode(metric_path + "." + datasource_name, reader)
+    for (absolute_path, is_dir) in self._find_paths(root_dir, pattern_parts):
+      if basename(absolute_path).startswith('.'):
+        continue
+
+      if self.DATASOURCE_DELIMETER in basename(absolute_path):
+        (absolute_path, datasource_pattern) = absolute_path.rsplit(self.DATASOURCE_DELIMETER, 1)
+      else:
+        datasource_pattern = None
+
+      relative_path = absolute_path[ len(root_dir): ].lstrip('/')
+      metric_path = fs_to_metric(relative_path)
+      real_metric_path = get_real_metric_path(absolute_path, metric_path)
+
+      metric_path_parts = metric_path.split('.')
+      for field_index in find_escaped_pattern_fields(query.pattern):
+        metric_path_parts[field_index] = pattern_parts[field_index].replace('\\', '')
+      metric_path = '.'.join(metric_path_parts)
+
+      # Now we construct and yield an appropriate Node object
+      if is_dir:
+        yield BranchNode(metric_path)
+
+      else:
+        if absolute_path.endswith('.wsp') and WhisperReader.supported:
+          reader = WhisperReader(absolute_path, real_metric_path)
+          yield LeafNode(metric_path, reader)
+
+        elif absolute_path.endswith('.wsp.gz') and GzippedWhisperReader.supported:
+          reader = GzippedWhisperReader(absolute_path, real_metric_path)
+          yield LeafNode(metric_path, reader)
+
+        elif absolute_path.endswith('.rrd') and RRDReader.supported:
+          if datasource_pattern is None:
+            yield BranchNode(metric_path)
+
+          else:
+            datasources = catalog and catalog.get_datasources(absolute_path)
+            if datasources is None:
+              datasources = RRDReader.get_datasources(absolute_path)
+
+            for datasource_name in datasources:
+              if match_entries([datasource_name], datasource_pattern):
+                reader = RRDReader(absolute_path, datasource_name)
+                yield LeafNode(metric_path + "." + datasource_name, reader)
 
   def _find_paths(self, current_dir, patterns):
-    """Recursively generates absolute paths whose components underneath current_dir
-    match the corresponding pattern in patterns"""
+    """Recursively generates (absolute_path, is_dir) for the paths whose components
+    underneath current_dir match the corresponding pattern in patterns"""
     pattern = patterns[0]
     patterns = patterns[1:]
-    try:
-      entries = os.listdir(current_dir)
-    except OSError as e:
-      log.exception(e)
-      entries = []
 
-    subdirs = [entry for entry in entries if isdir(join(current_dir, entry))]
-    matching_subdirs = match_entries(subdirs, pattern)
+    # Literal components are looked up directly, only wildcards need a listing.
+    # Components a listing could never match (empty ones or ones containing a
+    # path separator) still go through it, so lookups stay within current_dir
+    literal = pattern and sep not in pattern and not is_pattern(pattern)
+    if literal and isinstance(pattern, unicode):
+      # File names are looked up as the filesystem encodes them, components it
+      # cannot encode are left to the listing, which does not match them
+      try:
+        pattern = pattern.encode( sys.getfilesystemencoding() or 'ascii' )
+      except UnicodeError:
+        literal = False
+
+    if literal:
+      matching_subdirs = [pattern] if isdir(join(current_dir, pattern)) else []
+
+    else:
+      try:
+        (subdirs, files) = list_directory(current_dir)
+      except OSError as e:
+        log.exception(e)
+        (subdirs, files) = ([], [])
+
+      matching_subdirs = match_entries(subdirs, pattern)
 
     if len(patterns) == 1 and RRDReader.supported: #the last pattern may apply to RRD data sources
-      files = [entry for entry in entries if isfile(join(current_dir, entry))]
-      rrd_files = match_entries(files, pattern + ".rrd")
+      if literal:
+        rrd_files = [ pattern + ".rrd" ] if isfile(join(current_dir, pattern + ".rrd")) else []
+      else:
+        rrd_files = match_entries(files, pattern + ".rrd")
 
       if rrd_files: #let's assume it does
         datasource_pattern = patterns[0]
 
         for rrd_file in rrd_files:
           absolute_path = join(current_dir, rrd_file)
-          yield absolute_path + self.DATASOURCE_DELIMETER + datasource_pattern
+          yield (absolute_path + self.DATASOURCE_DELIMETER + datasource_pattern, False)
 
     if patterns: #we've still got more directories to traverse
       for subdir in matching_subdirs:
@@ -96,8 +136,13 @@ class StandardFinder:
           yield match
 
     else: #we've got the last pattern
-      files = [entry for entry in entries if isfile(join(current_dir, entry))]
-      matching_files = match_entries(files, pattern + '.*')
-
-      for base_name in matching_files + matching_subdirs:
-        yield join(current_dir, base_name)
+      if literal:
+        matching_files = [ pattern + extension for extension in LEAF_EXTENSIONS
+                           if isfile(join(current_dir, pattern + extension)) ]
+      else:
+        matching_files = match_entries(files, pattern + '.*')
+
+      for base_name in matching_files:
+        yield (join(current_dir, base_name), False)
+      for base_name in matching_subdirs:
+        yield (join(current_dir, base_name), True)
@@ -0,0 +1,245 @@
+import os
+import time
+from os.path import isfile, join, realpath
+from threading import Lock, Thread
+from django.conf import settings
+
+from graphite.logger import log
+from graphite.metrics.index import read_index_paths
+from graphite.node import BranchNode, LeafNode
+from graphite.readers import WhisperReader, GzippedWhisperReader
+from graphite.util import find_escaped_pattern_fields, is_pattern
+
+from . import get_real_metric_path, list_directory, match_entries
+
+
+# Leaf file extensions and their readers, longest extension first
+LEAF_READERS = [ (extension, reader) for (extension, reader) in [('.wsp.gz', GzippedWhisperReader),
+                                                                  ('.wsp', WhisperReader)]
+                 if reader.supported ]
+
+
+class TrieBranch(object):
+  """A directory of the metric namespace. branches maps the names of its
+  subdirectories to their TrieBranch, leaves maps metric names to their file
+  extension, or to an (extension, real_metric_path) pair for symbolic links.
+  Both dicts are replaced rather than modified so they can be read while the
+  trie is refreshed."""
+  __slots__ = ('branches', 'leaves', 'mtime')
+
+  def __init__(self):
+    self.branches = {}
+    self.leaves = {}
+    self.mtime = None
+
+
+class MetricTrie(object):
+  """The metric namespace underneath a storage directory. Leaves loaded from
+  an index are only listed there, so verify_leaves is set for finds to check
+  that their files exist."""
+  def __init__(self, directory):
+    self.directory = directory
+    self.root = TrieBranch()
+    self.verify_leaves = False
+
+  def refresh(self, branch=None, relative_dir=''):
+    """Relists the directories that changed since they were last loaded. A
+    directory's mtime only changes when entries are added or removed, so
+    unchanged directories cost a single stat."""
+    if branch is None:
+      branch = self.root
+    fs_dir = join(self.directory, relative_dir)
+
+    try:
+      mtime = os.stat(fs_dir).st_mtime
+      if mtime != branch.mtime:
+        self.load(branch, fs_dir)
+        branch.mtime = mtime
+    except OSError as e:
+      log.exception(e)
+      return
+
+    for name, child in branch.branches.items():
+      self.refresh(child, join(relative_dir, name))
+
+  def load(self, branch, fs_dir):
+    symlinks = []
+    (subdirs, files) = list_directory(fs_dir, symlinks)
+    symlinks = set(symlinks)
+
+    branches = {}
+    for name in subdirs:
+      if name.startswith('.'):
+        continue
+      if name in symlinks and is_ancestor(join(fs_dir, name), fs_dir):
+        continue # a link back up the tree would never end
+      branches[intern(name)] = branch.branches.get(name) or TrieBranch()
+
+    leaves = {}
+    for name in files:
+      if name.startswith('.'):
+        continue
+
+      for (extension, reader) in LEAF_READERS:
+        if name.endswith(extension):
+          metric_name = intern( name[:-len(extension)] )
+          if name in symlinks:
+            metric_path = self.metric_path( join(fs_dir, metric_name) )
+            real_metric_path = get_real_metric_path(join(fs_dir, name), metric_path)
+            leaves[metric_name] = (extension, real_metric_path)
+          else:
+            leaves[metric_name] = extension
+          break
+
+    branch.branches = branches
+    branch.leaves = leaves
+
+  def load_index(self, index_file):
+    "Loads the whisper metrics listed in a text or binary index_file"
+    self.root = TrieBranch()
+    self.verify_leaves = True
+    for path in read_index_paths(index_file):
+      parts = path.split('.')
+      branch = self.root
+      for name in parts[:-1]:
+        name = intern(name)
+        if name not in branch.branches:
+          branch.branches[name] = TrieBranch()
+        branch = branch.branches[name]
+      branch.leaves[intern(parts[-1])] = '.wsp'
+
+  def metric_path(self, fs_path):
+    return fs_path[ len(self.directory): ].strip('/').replace('/', '.')
+
+  def find(self, patterns, branch=None, prefix=()):
+    """Generates the (path_parts, leaf) matching the pattern components in
+    patterns, where leaf is None for branches"""
+    if branch is None:
+      branch = self.root
+    (branches, leaves) = (branch.branches, branch.leaves)
+    pattern = patterns[0]
+
+    if len(patterns) == 1:
+      for name in match_names(leaves, pattern):
+        yield (prefix + (name,), leaves[name])
+      for name in match_names(branches, pattern):
+        yield (prefix + (name,), None)
+
+    else:
+      for name in match_names(branches, pattern):
+        for match in self.find(patterns[1:], branches[name], prefix + (name,)):
+          yield match
+
+
+def match_names(names, pattern):
+  if is_pattern(pattern):
+    return match_entries(names, pattern)
+  elif pattern in names:
+    return [pattern]
+  else:
+    return []
+
+
+def is_ancestor(link, fs_dir):
+  target = realpath(link)
+  return (realpath(fs_dir) + '/').startswith(target + '/')
+
+
+class TrieFinder:
+  """Answers finds from an in-memory trie of the whisper files underneath
+  the STANDARD_DIRS, or of the metrics listed in INDEX_FILE. The trie is
+  refreshed every TRIE_FINDER_REFRESH_INTERVAL seconds in a background
+  thread, finds keep using the current one meanwhile."""
+  def __init__(self, directories=None):
+    self.directories = directories or settings.STANDARD_DIRS
+    self.tries = None
+    self.refreshed_at = 0
+    self.index_mtime = None
+    self.refresher = None
+    self.lock = Lock()
+
+  def get_tries(self):
+    tries = self.tries
+    if tries is None:
+      # Nothing to answer from yet, the first load happens on the request thread
+      with self.lock:
+        if self.tries is None:
+          self.refresh()
+        return self.tries
+
+    if time.time() - self.refreshed_at >= settings.TRIE_FINDER_REFRESH_INTERVAL:
+      self.refresh_in_background()
+    return tries
+
+  def refresh_in_background(self):
+    with self.lock:
+      if self.refresher is not None and self.refresher.is_alive():
+        return
+      self.refresher = Thread(target=self.background_refresh, name="TrieFinder refresh")
+      self.refresher.daemon = True
+      self.refresher.start()
+
+  def background_refresh(self):
+    try:
+      self.refresh()
+    except Exception:
+      log.exception("[TrieFinder] failed to refresh the metric trie")
+
+  def refresh(self):
+    t = time.time()
+    if settings.TRIE_FINDER_USE_INDEX:
+      try:
+        index_mtime = os.stat(settings.INDEX_FILE).st_mtime
+        if index_mtime != self.index_mtime:
+          trie = MetricTrie(settings.WHISPER_DIR)
+          trie.load_index(settings.INDEX_FILE)
+          self.tries = [trie]
+          self.index_mtime = index_mtime
+      except (IOError, OSError) as e:
+        log.exception("Failed to load the metric trie from %s: %s" % (settings.INDEX_FILE, e))
+        if self.tries is None:
+          self.tries = []
+
+    else:
+      tries = self.tries
+      if tries is None:
+        tries = [ MetricTrie(directory) for directory in self.directories ]
+      # Loaded in place, readers see each directory before or after its reload
+      for trie in tries:
+        trie.refresh()
+      self.tries = tries
+
+    self.refreshed_at = time.time()
+    log.info("[TrieFinder] refreshed the metric trie in %.6f seconds" % (self.refreshed_at - t))
+
+  def find_nodes(self, query):
+    clean_pattern = query.pattern.replace('\\', '')
+    pattern_parts = clean_pattern.split('.')
+    escaped_fields = list( find_escaped_pattern_fields(query.pattern) )
+
+    for trie in self.get_tries():
+      for (path_parts, leaf) in trie.find(pattern_parts):
+        fs_path = join(trie.directory, *path_parts)
+
+        metric_path_parts = list(path_parts)
+        for field_index in escaped_fields:
+          metric_path_parts[field_index] = pattern_parts[field_index]
+        metric_path = '.'.join(metric_path_parts)
+
+        if leaf is None:
+          yield BranchNode(metric_path)
+          continue
+
+        if isinstance(leaf, tuple):
+          (extension, real_metric_path) = leaf
+        else:
+          (extension, real_metric_path) = (leaf, '.'.join(path_parts))
+
+        # Index entries may be ceres metrics or deleted since the index was built
+        if trie.verify_leaves and not isfile(fs_path + extension):
+          continue
+
+        for (leaf_extension, reader_class) in LEAF_READERS:
+          if extension == leaf_extension:
+            reader = reader_class(fs_path + extension, real_metric_path)
+            yield LeafNode(metric_path, reader)
@@ -1,17 +1,47 @@
+from bisect import bisect_left, bisect_right
+
 INFINITY = float('inf')
 NEGATIVE_INFINITY = -INFINITY
 
 
 class IntervalSet:
-  __slots__ = ('intervals', 'size')
+  """A set of disjoint intervals, kept as sorted lists of their starts and
+  ends. Set operations merge the bounds of both sets in a single pass, and
+  Interval objects are only created for callers iterating over the set."""
+  __slots__ = ('starts', 'ends', 'size')
 
   def __init__(self, intervals, disjoint=False):
-    self.intervals = intervals
-
+    bounds = [ (interval.start, interval.end) for interval in intervals ]
     if not disjoint:
-      self.intervals = union_overlapping(self.intervals)
-
-    self.size = sum(i.size for i in self.intervals)
+      bounds = union_overlapping_bounds( sorted(bounds) )
+    self.set_bounds([ start for (start, end) in bounds ],
+                    [ end for (start, end) in bounds ])
+
+  @classmethod
+  def from_bounds(cls, starts, ends):
+    "Returns the IntervalSet of sorted, disjoint bounds without checking them"
+    interval_set = cls([], disjoint=True)
+    interval_set.set_bounds(starts, ends)
+    return interval_set
+
+  def set_bounds(self, starts, ends):
+    self.starts = starts
+    self.ends = ends
+    self.size = sum(end - start for (start, end) in zip(starts, ends))
+
+  @property
+  def intervals(self):
+    return [ Interval(start, end) for (start, end) in zip(self.starts, self.ends) ]
+
+  # Pickled in the same form as before the bounds were kept as lists, so
+  # cluster members running older versions can still unpickle find results
+  def __getstate__(self):
+    return { 'intervals' : self.intervals, 'size' : self.size }
+
+  def __setstate__(self, state):
+    intervals = state['intervals']
+    self.set_bounds([ interval.start for interval in intervals ],
+                    [ interval.end for interval in intervals ])
 
   def __repr__(self):
     return repr(self.intervals)
@@ -26,50 +56,89 @@ class IntervalSet:
     return self.intersect( other.complement() )
 
   def complement(self):
-    complementary = []
+    starts = []
+    ends = []
     cursor = NEGATIVE_INFINITY
 
-    for interval in self.intervals:
-      if cursor < interval.start:
-        complementary.append( Interval(cursor, interval.start) )
-        cursor = interval.end
+    for (start, end) in zip(self.starts, self.ends):
+      if cursor < start:
+        starts.append(cursor)
+        ends.append(start)
+      cursor = end
 
     if cursor < INFINITY:
-      complementary.append( Interval(cursor, INFINITY) )
-
-    return IntervalSet(complementary, disjoint=True)
+      starts.append(cursor)
+      ends.append(INFINITY)
 
-  def intersect(self, other): #XXX The last major bottleneck. Factorial-time hell.
-    # Then again, this function is entirely unused...
-    if (not self) or (not other):
-      return IntervalSet([])
+    return IntervalSet.from_bounds(starts, ends)
 
-    #earliest = max(self.intervals[0].start, other.intervals[0].start)
-    #latest = min(self.intervals[-1].end, other.intervals[-1].end)
+  def intersect(self, other):
+    (my_starts, my_ends) = (self.starts, self.ends)
+    (their_starts, their_ends) = (other.starts, other.ends)
+    starts = []
+    ends = []
+    i = j = 0
+
+    while i < len(my_starts) and j < len(their_starts):
+      start = max(my_starts[i], their_starts[j])
+      end = min(my_ends[i], their_ends[j])
+      if end > start:
+        starts.append(start)
+        ends.append(end)
+
+      # Whichever interval ends first cannot overlap anything further on
+      if my_ends[i] < their_ends[j]:
+        i += 1
+      else:
+        j += 1
+
+    return IntervalSet.from_bounds(starts, ends)
 
-    #mine = [i for i in self.intervals if i.start >= earliest and i.end <= latest]
-    #theirs = [i for i in other.intervals if i.start >= earliest and i.end <= latest]
+  def intersect_interval(self, interval):
+    # Only the intervals ending after interval starts and starting before it
+    # ends can overlap it
+    first = bisect_right(self.ends, interval.start)
+    last = bisect_left(self.starts, interval.end, first)
+    starts = []
+    ends = []
+
+    for i in xrange(first, last):
+      start = max(self.starts[i], interval.start)
+      end = min(self.ends[i], interval.end)
+      if end > start:
+        starts.append(start)
+        ends.append(end)
+
+    return IntervalSet.from_bounds(starts, ends)
 
-    intersections = [x for x in (i.intersect(j)
-                                 for i in self.intervals
-                                 for j in other.intervals)
-                     if x]
+  def union(self, other):
+    (my_starts, my_ends) = (self.starts, self.ends)
+    (their_starts, their_ends) = (other.starts, other.ends)
+    starts = []
+    ends = []
+    i = j = 0
 
-    return IntervalSet(intersections, disjoint=True)
+    while i < len(my_starts) or j < len(their_starts):
+      if j == len(their_starts) or (i < len(my_starts) and my_starts[i] <= their_starts[j]):
+        (start, end) = (my_starts[i], my_ends[i])
+        i += 1
+      else:
+        (start, end) = (their_starts[j], their_ends[j])
+        j += 1
 
-  def intersect_interval(self, interval):
-    intersections = [x for x in (i.intersect(interval)
-                                 for i in self.intervals)
-                     if x]
-    return IntervalSet(intersections, disjoint=True)
+      if ends and ends[-1] >= start:
+        if end > ends[-1]:
+          ends[-1] = end
+      else:
+        starts.append(start)
+        ends.append(end)
 
-  def union(self, other):
-    return IntervalSet( sorted(self.intervals + other.intervals) )
+    return IntervalSet.from_bounds(starts, ends)
 
 
 
 class Interval:
-  __slots__ = ('start', 'end', 'tuple', 'size')
+  __slots__ = ('start', 'end', 'size')
 
   def __init__(self, start, end):
     if end - start < 0:
@@ -77,14 +146,23 @@ class Interval:
 
     self.start = start
     self.end = end
-    self.tuple = (start, end)
     self.size = self.end - self.start
 
+  # Older versions compare and hash intervals by their tuple attribute
+  def __getstate__(self):
+    return { 'start' : self.start, 'end' : self.end, 'size' : self.size,
+             'tuple' : (self.start, self.end) }
+
+  def __setstate__(self, state):
+    self.start = state['start']
+    self.end = state['end']
+    self.size = state['size']
+
   def __eq__(self, other):
-    return self.tuple == other.tuple
+    return (self.start, self.end) == (other.start, other.end)
 
   def __hash__(self):
-    return hash( self.tuple )
+    return hash( (self.start, self.end) )
 
   def __cmp__(self, other):
     return cmp(self.start, other.start)
@@ -96,7 +174,7 @@ class Interval:
     return self.size != 0
 
   def __repr__(self):
-    return '<Interval: %s>' % str(self.tuple)
+    return '<Interval: %s>' % str( (self.start, self.end) )
 
   def intersect(self, other):
     start = max(self.start, other.start)
@@ -130,3 +208,18 @@ def union_overlapping(intervals):
       disjoint_intervals.append(interval)
 
   return disjoint_intervals
+
+
+def union_overlapping_bounds(bounds):
+  """Union any overlapping (start, end) pairs in the given list, sorted by
+  start."""
+  disjoint_bounds = []
+
+  for (start, end) in bounds:
+    if disjoint_bounds and disjoint_bounds[-1][1] >= start:
+      if end > disjoint_bounds[-1][1]:
+        disjoint_bounds[-1] = (disjoint_bounds[-1][0], end)
+    else:
+      disjoint_bounds.append( (start, end) )
+
+  return disjoint_bounds
@@ -0,0 +1,221 @@
+"""An SQLite catalog of the metadata of the whisper and RRD files underneath
+the STANDARD_DIRS.
+
+build-index records the retention, finest step, aggregation method, RRD
+datasources and last update of every metric file, so readers can compute
+their intervals and finders list RRD datasources without opening the files.
+Rebuilds only read the headers of files that are new or were replaced; the
+others just get a stat() for their new mtime.
+"""
+import os
+import sqlite3
+import time
+from os.path import join
+from tempfile import mkstemp
+from threading import Lock
+from django.conf import settings
+
+from graphite.intervals import Interval, IntervalSet
+from graphite.logger import log
+from graphite.readers import RRDReader, gzip, rrdtool, whisper
+
+
+METRIC_EXTENSIONS = ('.wsp', '.wsp.gz', '.rrd')
+CHECK_INTERVAL = 1 # seconds between checks for a rebuilt catalog file
+
+SCHEMA = """
+CREATE TABLE catalog (
+  built_at REAL NOT NULL
+);
+CREATE TABLE metrics (
+  fs_path TEXT PRIMARY KEY,
+  inode INTEGER NOT NULL,
+  size INTEGER NOT NULL,
+  mtime REAL NOT NULL,
+  max_retention INTEGER NOT NULL,
+  step INTEGER NOT NULL,
+  aggregation TEXT,
+  datasources TEXT
+);
+"""
+
+
+def read_metadata(fs_path):
+  "Returns the (max_retention, step, aggregation, datasources) of a metric file"
+  if fs_path.endswith('.rrd'):
+    info = rrdtool.info(fs_path)
+    datasources = ','.join( sorted(RRDReader.get_datasources(fs_path)) )
+    return (RRDReader.get_retention(fs_path), info['step'], settings.RRD_CF, datasources)
+
+  if fs_path.endswith('.wsp.gz'):
+    fh = gzip.GzipFile(fs_path, 'rb')
+    try:
+      info = whisper.__readHeader(fh) # evil, but necessary.
+    finally:
+      fh.close()
+  else:
+    info = whisper.info(fs_path)
+
+  step = min( archive['secondsPerPoint'] for archive in info['archives'] )
+  return (info['maxRetention'], step, info['aggregationMethod'], None)
+
+
+def load_previous_rows(catalog_file):
+  "Returns the rows of an existing catalog by fs_path, or an empty dict"
+  if not os.path.exists(catalog_file):
+    return {}
+  try:
+    connection = sqlite3.connect(catalog_file)
+    try:
+      rows = connection.execute("SELECT fs_path, inode, size, max_retention, step, aggregation, datasources FROM metrics")
+      return dict( (row[0], row[1:]) for row in rows )
+    finally:
+      connection.close()
+  except sqlite3.Error as e:
+    log.exception("Ignoring the unreadable metric catalog %s: %s" % (catalog_file, e))
+    return {}
+
+
+def write_catalog(directories=None, catalog_file=None):
+  """Rebuilds the metric catalog of the metric files underneath directories.
+  The new catalog atomically replaces the old one."""
+  if directories is None:
+    directories = settings.STANDARD_DIRS
+  if not catalog_file:
+    catalog_file = settings.METRIC_CATALOG_FILE
+
+  t = time.time()
+  previous = load_previous_rows(catalog_file)
+  (total_entries, headers_read) = (0, 0)
+
+  # Written next to the catalog so that renaming it over the catalog is atomic
+  fd, tmp = mkstemp(dir=os.path.dirname( os.path.abspath(catalog_file) ))
+  os.close(fd)
+  try:
+    connection = sqlite3.connect(tmp)
+    try:
+      connection.executescript(SCHEMA)
+      connection.execute("INSERT INTO catalog (built_at) VALUES (?)", (t,))
+
+      for directory in directories:
+        for (dirpath, dirnames, filenames) in os.walk(directory, followlinks=True):
+          for filename in filenames:
+            if not filename.endswith(METRIC_EXTENSIONS):
+              continue
+            fs_path = join(dirpath, filename)
+
+            try:
+              stat = os.stat(fs_path)
+              row = previous.get(fs_path)
+              if row is None or row[:2] != (stat.st_ino, stat.st_size):
+                row = (stat.st_ino, stat.st_size) + read_metadata(fs_path)
+                headers_read += 1
+            except Exception as e:
+              log.exception("Leaving %s out of the metric catalog: %s" % (fs_path, e))
+              continue
+
+            (inode, size, max_retention, step, aggregation, datasources) = row
+            connection.execute("INSERT OR REPLACE INTO metrics VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                               (fs_path, inode, size, stat.st_mtime, max_retention, step, aggregation, datasources))
+            total_entries += 1
+
+      connection.commit()
+    finally:
+      connection.close()
+    os.chmod(tmp, 0644)
+    os.rename(tmp, catalog_file)
+  finally:
+    try:
+      os.unlink(tmp)
+    except:
+      pass
+
+  log.info("[MetricCatalog] catalog rebuild took %.6f seconds (%d entries, %d headers read)" %
+           (time.time() - t, total_entries, headers_read))
+  return total_entries
+
+
+class MetricCatalog(object):
+  "Read side of the catalog, reopened whenever build-index replaces the file"
+  def __init__(self, catalog_file):
+    self.catalog_file = catalog_file
+    self.connection = None
+    self.mtime = None
+    self.built_at = None
+    self.checked_at = 0
+    self.lock = Lock()
+
+  def reopen(self):
+    try:
+      mtime = os.stat(self.catalog_file).st_mtime
+    except OSError:
+      mtime = None
+
+    if mtime != self.mtime:
+      if self.connection is not None:
+        self.connection.close()
+      (self.connection, self.built_at) = (None, None)
+      self.mtime = mtime
+
+      if mtime is not None:
+        try:
+          self.connection = sqlite3.connect(self.catalog_file, check_same_thread=False)
+          self.built_at = self.connection.execute("SELECT built_at FROM catalog").fetchone()[0]
+        except (sqlite3.Error, TypeError) as e:
+          log.exception("Failed to open the metric catalog %s: %s" % (self.catalog_file, e))
+          self.connection = None
+
+    self.checked_at = time.time()
+
+  def lookup(self, fs_path):
+    "Returns the (mtime, max_retention, step, aggregation, datasources) of a metric file or None"
+    with self.lock:
+      if time.time() - self.checked_at >= CHECK_INTERVAL:
+        self.reopen()
+      if self.connection is None:
+        return None
+      return self.connection.execute(
+        "SELECT mtime, max_retention, step, aggregation, datasources FROM metrics WHERE fs_path = ?",
+        (fs_path,)).fetchone()
+
+  def get_intervals(self, fs_path, now=None):
+    """Returns the same intervals as the reader of fs_path as of the catalog's
+    build, or None when fs_path is not in the catalog"""
+    row = self.lookup(fs_path)
+    if row is None:
+      return None
+    (mtime, max_retention) = row[:2]
+
+    # Like the readers, intervals end at the file's current mtime. Only the
+    # header read is saved, a stat() tells whether the file is still written
+    # to, or was written to again since the build.
+    try:
+      mtime = os.stat(fs_path).st_mtime
+    except OSError:
+      pass
+
+    if now is None:
+      now = time.time()
+    start = now - max_retention
+    end = max(mtime, start)
+    return IntervalSet( [Interval(start, end)] )
+
+  def get_datasources(self, fs_path):
+    "Returns the datasources of an RRD file, or None when it is not in the catalog"
+    row = self.lookup(fs_path)
+    if row is None or row[4] is None:
+      return None
+    return row[4].split(',') if row[4] else []
+
+
+_catalog = None
+
+
+def get_catalog():
+  "Returns the MetricCatalog of METRIC_CATALOG_FILE, or None unless USE_METRIC_CATALOG"
+  global _catalog
+  if not settings.USE_METRIC_CATALOG:
+    return None
+  if _catalog is None or _catalog.catalog_file != settings.METRIC_CATALOG_FILE:
+    _catalog = MetricCatalog(settings.METRIC_CATALOG_FILE)
+  return _catalog
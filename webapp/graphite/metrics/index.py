@@ -0,0 +1,205 @@
+"""A compact binary form of the search index.
+
+The metric paths are stored as a trie, so every path component is only
+written once per parent. Each node is a table of its children sorted by
+name, and each child points to its name in a shared pool of unique names and
+to its own table. Processes read the file through a read-only memory mapping.
+This lets them share its pages, and they look names up by binary search
+instead of loading the index into dicts.
+
+Layout, all integers unsigned and big-endian:
+
+  header  magic, version, entry count, root table offset, name pool offset
+  tables  child count, then (name offset, name length | LEAF, table offset)
+          per child, children before their parents
+  names   the unique path components
+"""
+import mmap
+import struct
+
+from graphite.finders import match_entries
+from graphite.util import is_pattern
+
+
+MAGIC = 'GIDX'
+VERSION = 1
+HEADER_FORMAT = '!4sIIII'
+HEADER_SIZE = struct.calcsize(HEADER_FORMAT)
+COUNT_FORMAT = '!I'
+COUNT_SIZE = struct.calcsize(COUNT_FORMAT)
+CHILD_FORMAT = '!III'
+CHILD_SIZE = struct.calcsize(CHILD_FORMAT)
+LEAF = 0x80000000
+
+
+class SearchIndexCorrupt(StandardError):
+  pass
+
+
+def is_binary_index(index_path):
+  with open(index_path, 'rb') as index:
+    return index.read(len(MAGIC)) == MAGIC
+
+
+def read_index_paths(index_path):
+  "Generates the metric paths listed in a text or binary index"
+  if is_binary_index(index_path):
+    for path in BinaryIndex(index_path).paths():
+      yield path
+  else:
+    with open(index_path) as index:
+      for line in index:
+        line = line.strip()
+        if line:
+          yield line
+
+
+def write_binary_index(paths, fh):
+  "Writes the metric paths, in any order, as a binary index to the file fh"
+  pool = {} # name -> offset in the name pool
+  names = []
+  pool_size = [0]
+  tables = []
+  tables_size = [HEADER_SIZE]
+
+  def name_offset(name):
+    if name not in pool:
+      pool[name] = pool_size[0]
+      names.append(name)
+      pool_size[0] += len(name)
+    return pool[name]
+
+  def write_table(children):
+    offset = tables_size[0]
+    table = [ struct.pack(COUNT_FORMAT, len(children)) ]
+    for (name, is_leaf, child_offset) in children:
+      length = len(name) | (LEAF if is_leaf else 0)
+      table.append( struct.pack(CHILD_FORMAT, name_offset(name), length, child_offset) )
+    table = ''.join(table)
+    tables.append(table)
+    tables_size[0] += len(table)
+    return offset
+
+  # stack[d] holds the children of the node at depth d of the previous path,
+  # tables are written as soon as no later path can add to them
+  stack = [ [] ]
+  previous = []
+  entries = 0
+
+  for parts in sorted( path.split('.') for path in paths ):
+    common = 0
+    for (a, b) in zip(previous, parts):
+      if a != b:
+        break
+      common += 1
+
+    while len(stack) > common + 1:
+      children = stack.pop()
+      if children:
+        stack[-1][-1][2] = write_table(children)
+
+    for name in parts[common:]:
+      stack[-1].append( [name, False, 0] )
+      stack.append( [] )
+
+    if not stack[-2][-1][1]:
+      stack[-2][-1][1] = True
+      entries += 1
+    previous = parts
+
+  while len(stack) > 1:
+    children = stack.pop()
+    if children:
+      stack[-1][-1][2] = write_table(children)
+  root_offset = write_table(stack[0])
+
+  fh.write( struct.pack(HEADER_FORMAT, MAGIC, VERSION, entries, root_offset, tables_size[0]) )
+  for table in tables:
+    fh.write(table)
+  for name in names:
+    fh.write(name)
+  return entries
+
+
+class BinaryIndex(object):
+  "Read-only view of a binary index file"
+  def __init__(self, index_path):
+    with open(index_path, 'rb') as index:
+      self.mapping = mmap.mmap(index.fileno(), 0, access=mmap.ACCESS_READ)
+
+    try:
+      (magic, version, self.entries, self.root_offset, self.pool_offset) = \
+        struct.unpack_from(HEADER_FORMAT, self.mapping, 0)
+    except struct.error:
+      raise SearchIndexCorrupt("Unable to read the header of %s" % index_path)
+    if magic != MAGIC or version != VERSION:
+      raise SearchIndexCorrupt("%s is not a version %d binary index" % (index_path, VERSION))
+
+  def children(self, table_offset):
+    "Returns the (name, is_leaf, table_offset) of a node's children in order"
+    count = struct.unpack_from(COUNT_FORMAT, self.mapping, table_offset)[0]
+    fields = struct.unpack_from('!' + CHILD_FORMAT[1:] * count, self.mapping, table_offset + COUNT_SIZE)
+    children = []
+    for i in xrange(0, len(fields), 3):
+      (name_offset, length, child_offset) = fields[i:i + 3]
+      start = self.pool_offset + name_offset
+      name = self.mapping[start:start + (length & ~LEAF)]
+      children.append( (name, bool(length & LEAF), child_offset) )
+    return children
+
+  def child(self, table_offset, name):
+    "Returns the (name, is_leaf, table_offset) of a node's named child or None"
+    count = struct.unpack_from(COUNT_FORMAT, self.mapping, table_offset)[0]
+    low = 0
+    high = count
+    while low < high:
+      middle = (low + high) // 2
+      (name_offset, length, child_offset) = struct.unpack_from(
+        CHILD_FORMAT, self.mapping, table_offset + COUNT_SIZE + middle * CHILD_SIZE)
+      start = self.pool_offset + name_offset
+      child_name = self.mapping[start:start + (length & ~LEAF)]
+      if child_name < name:
+        low = middle + 1
+      elif child_name > name:
+        high = middle
+      else:
+        return (child_name, bool(length & LEAF), child_offset)
+    return None
+
+  def paths(self, table_offset=None, prefix=''):
+    "Generates every metric path in the index"
+    if table_offset is None:
+      table_offset = self.root_offset
+    for (name, is_leaf, child_offset) in self.children(table_offset):
+      path = prefix + name
+      if is_leaf:
+        yield path
+      if child_offset:
+        for child_path in self.paths(child_offset, path + '.'):
+          yield child_path
+
+  def subtree_query(self, query_parts, table_offset=None, prefix=''):
+    """Generates the same results as IndexSearcher.subtree_query() over the
+    equivalent text index"""
+    if table_offset is None:
+      table_offset = self.root_offset
+
+    if not query_parts:
+      matches = self.children(table_offset)
+    elif is_pattern(query_parts[0]):
+      children = dict( (child[0], child) for child in self.children(table_offset) )
+      matches = [ children[name] for name in match_entries(children, query_parts[0]) ]
+    else:
+      match = self.child(table_offset, query_parts[0])
+      matches = [match] if match else []
+
+    for (name, is_leaf, child_offset) in matches:
+      path = prefix + name
+      yield {
+        'path' : path if is_leaf else None,
+        'is_leaf' : is_leaf,
+      }
+
+      if query_parts and child_offset:
+        for result in self.subtree_query(query_parts[1:], child_offset, path + '.'):
+          yield result
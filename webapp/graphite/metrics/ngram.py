@@ -0,0 +1,107 @@
+"""Trigram inverted index over metric paths for substring and regex searches.
+
+Every lower cased path is split into its overlapping three character
+substrings, and each of those maps to the sorted ids of the paths containing
+it. A search only has to verify the paths holding every trigram of the
+literal text its regular expression requires.
+"""
+import re
+import sre_constants
+import sre_parse
+from array import array
+from bisect import bisect_left
+
+
+def trigrams(s):
+  return set( s[i:i + 3] for i in xrange(len(s) - 2) )
+
+
+def required_literals(pattern):
+  """Returns the lower cased literal strings that every match of the regular
+  expression pattern contains. Only runs of plain characters at the top level
+  of the expression are considered, anything else is left to verification."""
+  try:
+    parsed = sre_parse.parse(pattern)
+  except (sre_constants.error, OverflowError):
+    return []
+
+  literals = []
+  run = []
+  for (op, av) in parsed:
+    if op == sre_constants.LITERAL:
+      run.append( unichr(av) if av > 255 else chr(av) )
+      continue
+    if run:
+      literals.append( ''.join(run).lower() )
+      run = []
+  if run:
+    literals.append( ''.join(run).lower() )
+  return literals
+
+
+class TrigramIndex(object):
+  def __init__(self, paths):
+    self.paths = []
+    self.postings = {}
+    for (i, path) in enumerate(paths):
+      self.paths.append(path)
+      for trigram in trigrams( path.lower() ):
+        posting = self.postings.get(trigram)
+        if posting is None:
+          posting = self.postings[trigram] = array('I')
+        posting.append(i)
+
+  def candidates(self, literals):
+    """Returns the sorted ids of the paths containing all of literals, or None
+    when they are too short to narrow the search down"""
+    needed = set()
+    for literal in literals:
+      needed.update( trigrams(literal) )
+    if not needed:
+      return None
+
+    postings = []
+    for trigram in needed:
+      posting = self.postings.get(trigram)
+      if not posting:
+        return []
+      postings.append(posting)
+
+    postings.sort(key=len)
+    (shortest, others) = (postings[0], postings[1:])
+    return [ i for i in shortest if all(contains(posting, i) for posting in others) ]
+
+  def search(self, patterns, max_results=None):
+    """Returns the paths matching any of the regular expressions in patterns,
+    case insensitively, in index order"""
+    ids = set()
+    for pattern in patterns:
+      pattern_ids = self.candidates( required_literals(pattern) )
+      if pattern_ids is None:
+        ids = xrange( len(self.paths) )
+        break
+      ids.update(pattern_ids)
+    else:
+      ids = sorted(ids)
+
+    return scan( (self.paths[i] for i in ids), patterns, max_results )
+
+
+def scan(paths, patterns, max_results=None):
+  """Returns the paths matching any of the regular expressions in patterns,
+  case insensitively, in the order given"""
+  regexes = [ re.compile(pattern, re.I) for pattern in patterns ]
+  results = []
+  for path in paths:
+    for regex in regexes:
+      if regex.search(path):
+        results.append(path)
+        break
+    if max_results is not None and len(results) >= max_results:
+      break
+  return results
+
+
+def contains(posting, i):
+  position = bisect_left(posting, i)
+  return position < len(posting) and posting[position] == i
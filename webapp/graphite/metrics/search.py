@@ -1,10 +1,24 @@
 import time
 import os.path
+from threading import Lock, Thread
 from django.conf import settings
 from graphite.finders import match_entries
 from graphite.logger import log
+from graphite.metrics.index import BinaryIndex, is_binary_index, read_index_paths
+from graphite.metrics.ngram import TrigramIndex, scan
 from graphite.util import is_pattern, write_index
 
+class IndexSnapshot(object):
+  """One load of the index file. Reloads build a new snapshot and swap it in
+  whole, so a search never sees a partly loaded index."""
+  def __init__(self, mtime, tree, binary_index=None):
+    self.mtime = mtime
+    self.tree = tree
+    self.binary_index = binary_index
+    self.trigram_index = None
+    self.trigram_index_failed = False
+
+
 class IndexSearcher:
   def __init__(self, index_path):
     self.index_path = index_path
@@ -14,24 +28,100 @@ class IndexSearcher:
       except:
         log.exception("Couldn't build index file %s" % index_path)
         raise RuntimeError("Couldn't build index file %s" % index_path)
-    self.last_mtime = 0
-    self._tree = (None, {}) # (data, children)
+    self.snapshot = None
+    self.failed_mtime = None
+    self.last_reload_duration = None
+    self.reloader = None
+    self.trigram_builder = None
+    self.reload_lock = Lock()
+    self.trigram_lock = Lock()
     log.info("[IndexSearcher] performing initial index load")
     self.reload()
 
+  @property
+  def index(self):
+    """The last good IndexSnapshot. A changed index file is reloaded in a
+    background thread, searches keep using this snapshot until it is done."""
+    snapshot = self.snapshot
+    try:
+      current_mtime = os.path.getmtime(self.index_path)
+    except OSError:
+      current_mtime = snapshot.mtime
+    if current_mtime > snapshot.mtime and current_mtime != self.failed_mtime:
+      self.reload_in_background()
+    return snapshot
+
   @property
   def tree(self):
+    return self.index.tree
+
+  @property
+  def binary_index(self):
+    return self.index.binary_index
+
+  def reload_in_background(self):
+    with self.reload_lock:
+      if self.reloader is not None and self.reloader.is_alive():
+        return
+      self.reloader = Thread(target=self.background_reload, name="IndexSearcher reload")
+      self.reloader.daemon = True
+      self.reloader.start()
+
+  def background_reload(self):
     current_mtime = os.path.getmtime(self.index_path)
-    if current_mtime > self.last_mtime:
-      log.info("[IndexSearcher] reloading stale index, current_mtime=%s last_mtime=%s" %
-               (current_mtime, self.last_mtime))
+    log.info("[IndexSearcher] reloading stale index, current_mtime=%s last_mtime=%s" %
+             (current_mtime, self.snapshot.mtime))
+    try:
       self.reload()
-
-    return self._tree
+    except Exception:
+      # Not retried until the file changes again
+      self.failed_mtime = current_mtime
+      log.exception("[IndexSearcher] failed to reload %s, still using the index from mtime=%s" %
+                    (self.index_path, self.snapshot.mtime))
 
   def reload(self):
     log.info("[IndexSearcher] reading index data from %s" % self.index_path)
     t = time.time()
+    # Read before loading, a write during the load makes the index stale again
+    mtime = os.path.getmtime(self.index_path)
+
+    if is_binary_index(self.index_path):
+      # Mapped rather than loaded, so every process shares the same pages
+      snapshot = IndexSnapshot(mtime, (None, {}), BinaryIndex(self.index_path))
+      total_entries = snapshot.binary_index.entries
+    else:
+      (tree, total_entries) = self.load_tree()
+      snapshot = IndexSnapshot(mtime, tree)
+
+    # Searchers that already answered substring searches rebuild their
+    # trigram index now rather than after the next search
+    rebuild_trigrams = self.snapshot is not None and self.snapshot.trigram_index is not None
+
+    self.snapshot = snapshot
+    self.last_reload_duration = time.time() - t
+    log.info("[IndexSearcher] index reload took %.6f seconds (%d entries)" %
+             (self.last_reload_duration, total_entries))
+    if rebuild_trigrams:
+      self.build_trigram_index_in_background(snapshot)
+
+  def build_trigram_index_in_background(self, snapshot):
+    with self.trigram_lock:
+      if self.trigram_builder is not None and self.trigram_builder.is_alive():
+        return
+      self.trigram_builder = Thread(target=self.build_trigram_index, args=(snapshot,),
+                                    name="IndexSearcher trigram index build")
+      self.trigram_builder.daemon = True
+      self.trigram_builder.start()
+
+  def build_trigram_index(self, snapshot):
+    try:
+      snapshot.trigram_index = self.load_trigram_index()
+    except Exception:
+      # Not retried for this snapshot, searches keep scanning the index
+      snapshot.trigram_index_failed = True
+      log.exception("[IndexSearcher] failed to build the trigram index of %s" % self.index_path)
+
+  def load_tree(self):
     total_entries = 0
     tree = (None, {}) # (data, children)
     for line in open(self.index_path):
@@ -52,14 +142,25 @@ class IndexSearcher:
       cursor[1][leaf] = (line, {})
       total_entries += 1
 
-    self._tree = tree
-    self.last_mtime = os.path.getmtime(self.index_path)
-    log.info("[IndexSearcher] index reload took %.6f seconds (%d entries)" % (time.time() - t, total_entries))
+    return (tree, total_entries)
+
+  def load_trigram_index(self):
+    t = time.time()
+    trigram_index = TrigramIndex( read_index_paths(self.index_path) )
+    log.info("[IndexSearcher] trigram index build took %.6f seconds (%d entries)" %
+             (time.time() - t, len(trigram_index.paths)))
+    return trigram_index
 
   def search(self, query, max_results=None, keep_query_pattern=False):
     query_parts = query.split('.')
     metrics_found = set()
-    for result in self.subtree_query(self.tree, query_parts):
+    index = self.index
+    if index.binary_index is not None:
+      results = index.binary_index.subtree_query(query_parts)
+    else:
+      results = self.subtree_query(index.tree, query_parts)
+
+    for result in results:
       # Overlay the query pattern on the resulting paths
       if keep_query_pattern:
         path_parts = result['path'].split('.')
@@ -73,6 +174,19 @@ class IndexSearcher:
       if max_results is not None and len(metrics_found) >= max_results:
         return
 
+  def substring_search(self, patterns, max_results=None):
+    """Returns the metric paths matching any of the regular expressions in
+    patterns, case insensitively, in index order. The first search starts
+    building the trigram index in the background, searches scan the index
+    until it is ready."""
+    snapshot = self.index
+    if snapshot.trigram_index is not None:
+      return snapshot.trigram_index.search(patterns, max_results)
+
+    if settings.INDEX_TRIGRAMS and not snapshot.trigram_index_failed:
+      self.build_trigram_index_in_background(snapshot)
+    return scan(read_index_paths(self.index_path), patterns, max_results)
+
   def subtree_query(self, root, query_parts):
     if query_parts:
       my_query = query_parts[0]
@@ -100,8 +214,14 @@ class IndexSearcher:
           yield result
 
 
-class SearchIndexCorrupt(StandardError):
-  pass
+searcher = IndexSearcher(settings.INDEX_FILE)
+other_searchers = {}
 
 
-searcher = IndexSearcher(settings.INDEX_FILE)
+def get_searcher(index_path):
+  "Returns the IndexSearcher of an index, normally INDEX_FILE's"
+  if index_path == searcher.index_path:
+    return searcher
+  if index_path not in other_searchers:
+    other_searchers[index_path] = IndexSearcher(index_path)
+  return other_searchers[index_path]
@@ -80,6 +80,10 @@ def search_view(request):
   #if not search_request['query'].endswith('*'):
   #  search_request['query'] += '*'
 
+  # Queries are path patterns matched one component per level of the index
+  # tree, so only the subtrees they select are walked. Unlike the browser's
+  # substring search this cannot be narrowed down by the trigram index, as
+  # leaves shallower than the query match on fewer components.
   results = sorted(searcher.search(**search_request))
   return json_response_for(request, dict(metrics=results))
 
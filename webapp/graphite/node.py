@@ -18,14 +18,25 @@ class BranchNode(Node):
 
 
 class LeafNode(Node):
-  __slots__ = ('reader', 'intervals')
+  __slots__ = ('reader', '_intervals')
 
   def __init__(self, path, reader):
     Node.__init__(self, path)
     self.reader = reader
-    self.intervals = reader.get_intervals()
+    self._intervals = None
     self.is_leaf = True
 
+  @property
+  def intervals(self):
+    # Computed on first use, most finds never need to look at intervals
+    if self._intervals is None:
+      self._intervals = self.reader.get_intervals()
+    return self._intervals
+
+  @intervals.setter
+  def intervals(self, intervals):
+    self._intervals = intervals
+
   def fetch(self, startTime, endTime):
     return self.reader.fetch(startTime, endTime)
 
@@ -1,8 +1,15 @@
 import os
+import math
+import mmap
 import time
+import struct
+from functools import partial
+from threading import Lock
+from multiprocessing.pool import ThreadPool
 from graphite.intervals import Interval, IntervalSet
 from graphite.carbonlink import CarbonLink
 from graphite.logger import log
+from graphite.util import LRUCache
 from django.conf import settings
 
 try:
@@ -29,6 +36,130 @@ class FetchInProgress(object):
     return self.wait_callback()
 
 
+fetch_pool = None
+fetch_pool_pid = None
+fetch_pool_lock = Lock()
+
+
+def get_fetch_pool():
+  "Returns this process' worker pool for local fetches, or None if disabled"
+  global fetch_pool, fetch_pool_pid
+  if settings.FETCH_POOL_SIZE < 1:
+    return None
+
+  with fetch_pool_lock:
+    # Worker threads do not survive a fork, so each process gets its own pool
+    if fetch_pool is None or fetch_pool_pid != os.getpid():
+      fetch_pool = ThreadPool(settings.FETCH_POOL_SIZE)
+      fetch_pool_pid = os.getpid()
+    return fetch_pool
+
+
+def run_concurrently(func, items):
+  """Calls func on every item using the fetch worker pool and returns the
+  results in order. A single call never occupies more than
+  FETCH_CONCURRENCY workers at once."""
+  pool = get_fetch_pool()
+  if pool is None or len(items) < 2:
+    return [ func(item) for item in items ]
+
+  concurrency = max(1, settings.FETCH_CONCURRENCY)
+  chunksize = int( math.ceil(len(items) / float(concurrency)) )
+  return pool.map(func, items, chunksize)
+
+
+def fetch_multi(nodes, startTime, endTime):
+  """Starts fetching data for many leaf nodes at once and returns their results
+  (possibly FetchInProgress objects) in the same order as nodes.
+
+  Readers whose class implements fetch_multi(readers, startTime, endTime) are
+  handed all of their nodes in a single call so they can batch their I/O,
+  any other reader is fetched node by node."""
+  results = [None] * len(nodes)
+  batches = {}
+  unbatched = []
+
+  for i, node in enumerate(nodes):
+    reader_class = node.reader.__class__
+    if getattr(reader_class, 'fetch_multi', None) is not None:
+      batches.setdefault(reader_class, []).append(i)
+    else:
+      unbatched.append(i)
+
+  fetch_node = lambda i: nodes[i].fetch(startTime, endTime)
+  for i, result in zip(unbatched, run_concurrently(fetch_node, unbatched)):
+    results[i] = result
+
+  for reader_class, indexes in batches.items():
+    readers = [ nodes[i].reader for i in indexes ]
+    for i, result in zip(indexes, reader_class.fetch_multi(readers, startTime, endTime)):
+      results[i] = result
+
+  return results
+
+
+def plan_fetch(startTime, endTime, now=None):
+  """Decides where the datapoints of a window can live and returns a
+  (read_disk, query_cache) pair. Windows ending before CARBONLINK_CACHE_HORIZON
+  have been written out by carbon, and windows starting within
+  CARBONLINK_CACHE_ONLY_WINDOW have not been written yet."""
+  if now is None:
+    now = time.time()
+
+  horizon = settings.CARBONLINK_CACHE_HORIZON
+  if horizon > 0 and endTime < now - horizon:
+    return (True, False)
+
+  cache_only_window = settings.CARBONLINK_CACHE_ONLY_WINDOW
+  if cache_only_window > 0 and startTime >= now - cache_only_window:
+    return (False, True)
+
+  return (True, True)
+
+
+def fetch_with_cache(readers, startTime, endTime):
+  """Fetches local readers from disk and from carbon's cache as planned by
+  plan_fetch(). Readers must implement read() and empty(), the latter
+  returning read()'s result for a window without any datapoints on disk."""
+  (read_disk, query_cache) = plan_fetch(startTime, endTime)
+  if read_disk:
+    results = run_concurrently(lambda reader: reader.read(startTime, endTime), readers)
+  else:
+    results = [ reader.empty(startTime, endTime) for reader in readers ]
+
+  if query_cache:
+    merge_cached_datapoints([r.real_metric_path for r in readers], results)
+  return results
+
+
+def merge_cached_datapoints(metrics, results):
+  """Merges the datapoints carbon's cache holds for each metric into the
+  corresponding (time_info, values) result, querying the cache in bulk"""
+  metrics_with_data = [ metric for metric, result in zip(metrics, results) if result ]
+  if not metrics_with_data:
+    return
+
+  try:
+    datapoints_by_metric = CarbonLink.query_bulk(metrics_with_data)
+  except:
+    log.exception("Failed CarbonLink bulk query for %d metrics" % len(metrics_with_data))
+    datapoints_by_metric = {}
+
+  for metric, result in zip(metrics, results):
+    if not result:
+      continue
+
+    ((start, end, step), values) = result
+    for (timestamp, value) in datapoints_by_metric.get(metric, []):
+      interval = timestamp - (timestamp % step)
+
+      try:
+        i = int(interval - start) / step
+        values[i] = value
+      except:
+        pass
+
+
 class MultiReader(object):
   __slots__ = ('nodes',)
 
@@ -42,9 +173,24 @@ class MultiReader(object):
     return IntervalSet( sorted(interval_sets) )
 
   def fetch(self, startTime, endTime):
-    # Start the fetch on each node
-    results = [ n.fetch(startTime, endTime) for n in self.nodes ]
+    return self.merge_results( fetch_multi(list(self.nodes), startTime, endTime) )
+
+  @classmethod
+  def fetch_multi(cls, readers, startTime, endTime):
+    # Start the fetch on the nodes of every reader in one batch
+    nodes = [ n for reader in readers for n in reader.nodes ]
+    sub_results = fetch_multi(nodes, startTime, endTime)
+
+    results = []
+    offset = 0
+    for reader in readers:
+      reader_results = sub_results[offset:offset + len(reader.nodes)]
+      offset += len(reader.nodes)
+      results.append( FetchInProgress(partial(reader.merge_results, reader_results)) )
 
+    return results
+
+  def merge_results(self, results):
     # Wait for any asynchronous operations to complete
     for i, result in enumerate(results):
       if isinstance(result, FetchInProgress):
@@ -120,27 +266,208 @@ class CeresReader(object):
     return IntervalSet(intervals)
 
   def fetch(self, startTime, endTime):
+    return self.fetch_multi([self], startTime, endTime)[0]
+
+  @classmethod
+  def fetch_multi(cls, readers, startTime, endTime):
+    return fetch_with_cache(readers, startTime, endTime)
+
+  def read(self, startTime, endTime):
     data = self.ceres_node.read(startTime, endTime)
     time_info = (data.startTime, data.endTime, data.timeStep)
-    values = list(data.values)
+    return (time_info, list(data.values))
+
+  def empty(self, startTime, endTime):
+    if self.ceres_node.timeStep is None: # only set once the metadata was read
+      self.ceres_node.readMetadata()
+    step = self.ceres_node.timeStep
+    fromInterval = int(startTime - (startTime % step)) + step
+    untilInterval = int(endTime - (endTime % step)) + step
+    return ((fromInterval, untilInterval, step), [None] * ((untilInterval - fromInterval) // step))
+
+
+# Parsed whisper headers shared by every reader in the process, keyed by the
+# identity of the file they were read from (see whisper_cache_key)
+whisper_header_cache = LRUCache(settings.WHISPER_HEADER_CACHE_SIZE)
+
+WHISPER_METADATA_FORMAT = "!2LfL"
+WHISPER_METADATA_SIZE = struct.calcsize(WHISPER_METADATA_FORMAT)
+WHISPER_ARCHIVE_INFO_FORMAT = "!3L"
+WHISPER_ARCHIVE_INFO_SIZE = struct.calcsize(WHISPER_ARCHIVE_INFO_FORMAT)
+WHISPER_POINT_SIZE = struct.calcsize("!Ld")
+
+
+def whisper_cache_key(stat):
+  return (stat.st_dev, stat.st_ino, stat.st_size, stat.st_mtime)
+
+
+def map_whisper_file(fs_path):
+  "Returns the stat and a read-only memory mapping of the given whisper file"
+  fd = os.open(fs_path, os.O_RDONLY)
+  try:
+    stat = os.fstat(fd)
+    if not stat.st_size:
+      raise whisper.CorruptWhisperFile("Unable to read header", fs_path)
+    mapping = mmap.mmap(fd, 0, access=mmap.ACCESS_READ)
+  finally:
+    os.close(fd) # the mapping stays valid once the descriptor is closed
+  return stat, mapping
+
+
+def parse_whisper_header(mapping, fs_path):
+  try:
+    (aggregationType, maxRetention, xff, archiveCount) = \
+      struct.unpack_from(WHISPER_METADATA_FORMAT, mapping, 0)
+  except struct.error:
+    raise whisper.CorruptWhisperFile("Unable to read header", fs_path)
+
+  archives = []
+  offset = WHISPER_METADATA_SIZE
+  for i in xrange(archiveCount):
+    try:
+      (archiveOffset, secondsPerPoint, points) = \
+        struct.unpack_from(WHISPER_ARCHIVE_INFO_FORMAT, mapping, offset)
+    except struct.error:
+      raise whisper.CorruptWhisperFile("Unable to read archive%d metadata" % i, fs_path)
+
+    archives.append({
+      'offset' : archiveOffset,
+      'secondsPerPoint' : secondsPerPoint,
+      'points' : points,
+      'retention' : secondsPerPoint * points,
+      'size' : points * WHISPER_POINT_SIZE,
+    })
+    offset += WHISPER_ARCHIVE_INFO_SIZE
+
+  return {
+    'aggregationMethod' : whisper.aggregationTypeToMethod.get(aggregationType, 'average'),
+    'maxRetention' : maxRetention,
+    'xFilesFactor' : xff,
+    'archives' : archives,
+  }
+
+
+def get_whisper_header(fs_path, stat=None, mapping=None):
+  """Returns the parsed header of a whisper file, only reading the file when
+  it changed since the header was last cached"""
+  if stat is None:
+    stat = os.stat(fs_path)
+
+  key = whisper_cache_key(stat)
+  header = whisper_header_cache.get(key)
+  if header is not None:
+    return header
+
+  if mapping is None:
+    stat, mapping = map_whisper_file(fs_path)
+    try:
+      header = parse_whisper_header(mapping, fs_path)
+    finally:
+      mapping.close()
+    key = whisper_cache_key(stat)
+  else:
+    header = parse_whisper_header(mapping, fs_path)
+
+  whisper_header_cache.set(key, header)
+  return header
+
 
-    # Merge in data from carbon's cache
+def fetch_whisper_mmap(fs_path, fromTime, untilTime, now=None):
+  """Equivalent to whisper.fetch() but decodes the requested archive slice
+  directly out of a read-only memory mapping of the file"""
+  stat, mapping = map_whisper_file(fs_path)
+  try:
+    header = get_whisper_header(fs_path, stat, mapping)
+
+    window = whisper_window(header, fromTime, untilTime, now)
+    if window is None:
+      return None
+
+    return _fetch_whisper_archive(mapping, fs_path, *window)
+  finally:
+    mapping.close()
+
+
+def whisper_window(header, fromTime, untilTime, now=None):
+  """Picks the archive whisper.fetch() reads a window from and returns it with
+  the window's first and last intervals, or None if it lies outside the file"""
+  if now is None:
+    now = int( time.time() )
+  fromTime = int(fromTime)
+  untilTime = int(untilTime)
+
+  if fromTime > untilTime:
+    raise whisper.InvalidTimeInterval("Invalid time interval: from time '%s' is after until time '%s'" % (fromTime, untilTime))
+
+  oldestTime = now - header['maxRetention']
+  if fromTime > now or untilTime < oldestTime:
+    return None
+  fromTime = max(fromTime, oldestTime)
+  untilTime = min(untilTime, now)
+
+  diff = now - fromTime
+  for archive in header['archives']:
+    if archive['retention'] >= diff:
+      break
+
+  step = archive['secondsPerPoint']
+  fromInterval = int(fromTime - (fromTime % step)) + step
+  untilInterval = int(untilTime - (untilTime % step)) + step
+  if fromInterval == untilInterval:
+    untilInterval += step # zero-length time range: always include the next point
+
+  return (archive, fromInterval, untilInterval)
+
+
+def _fetch_whisper_archive(mapping, fs_path, archive, fromInterval, untilInterval):
+  step = archive['secondsPerPoint']
+
+  try:
+    (baseInterval, baseValue) = struct.unpack_from("!Ld", mapping, archive['offset'])
+  except struct.error:
+    raise whisper.CorruptWhisperFile("Unable to read base datapoint", fs_path)
+
+  timeInfo = (fromInterval, untilInterval, step)
+  if baseInterval == 0:
+    return (timeInfo, [None] * ((untilInterval - fromInterval) // step))
+
+  archiveStart = archive['offset']
+  archiveEnd = archiveStart + archive['size']
+  fromOffset = archiveStart + (((fromInterval - baseInterval) // step) * WHISPER_POINT_SIZE) % archive['size']
+  untilOffset = archiveStart + (((untilInterval - baseInterval) // step) * WHISPER_POINT_SIZE) % archive['size']
+
+  # Unpack straight out of the mapping, in two slices if the range wraps
+  if fromOffset < untilOffset:
+    slices = [(fromOffset, untilOffset)]
+  else:
+    slices = [(fromOffset, archiveEnd), (archiveStart, untilOffset)]
+
+  valueList = []
+  currentInterval = fromInterval
+  for (sliceStart, sliceEnd) in slices:
+    points = (sliceEnd - sliceStart) // WHISPER_POINT_SIZE
     try:
-      cached_datapoints = CarbonLink.query(self.real_metric_path)
-    except:
-      log.exception("Failed CarbonLink query '%s'" % self.real_metric_path)
-      cached_datapoints = []
+      series = struct.unpack_from("!" + "Ld" * points, mapping, sliceStart)
+    except struct.error:
+      raise whisper.CorruptWhisperFile("Unable to read datapoints", fs_path)
 
-    for (timestamp, value) in cached_datapoints:
-      interval = timestamp - (timestamp % data.timeStep)
+    for i in xrange(0, len(series), 2):
+      if series[i] == currentInterval:
+        valueList.append(series[i + 1])
+      else:
+        valueList.append(None)
+      currentInterval += step
 
-      try:
-        i = int(interval - data.startTime) / data.timeStep
-        values[i] = value
-      except:
-        pass
+  return (timeInfo, valueList)
 
-    return (time_info, values)
+
+def catalog_intervals(fs_path):
+  "Returns the intervals the metric catalog records for fs_path, or None"
+  from graphite.metrics.catalog import get_catalog # which imports this module
+  catalog = get_catalog()
+  if catalog is None:
+    return None
+  return catalog.get_intervals(fs_path)
 
 
 class WhisperReader(object):
@@ -152,41 +479,57 @@ class WhisperReader(object):
     self.real_metric_path = real_metric_path
 
   def get_intervals(self):
-    start = time.time() - whisper.info(self.fs_path)['maxRetention']
-    end = max( os.stat(self.fs_path).st_mtime, start )
+    intervals = catalog_intervals(self.fs_path)
+    if intervals is not None:
+      return intervals
+
+    if settings.WHISPER_MMAP:
+      stat = os.stat(self.fs_path)
+      info = get_whisper_header(self.fs_path, stat)
+    else:
+      info = whisper.info(self.fs_path)
+      stat = os.stat(self.fs_path)
+
+    start = time.time() - info['maxRetention']
+    end = max( stat.st_mtime, start )
     return IntervalSet( [Interval(start, end)] )
 
   def fetch(self, startTime, endTime):
-    data = whisper.fetch(self.fs_path, startTime, endTime)
-    if not data:
-      return None
+    return self.fetch_multi([self], startTime, endTime)[0]
 
-    time_info, values = data
-    (start,end,step) = time_info
+  @classmethod
+  def fetch_multi(cls, readers, startTime, endTime):
+    return fetch_with_cache(readers, startTime, endTime)
 
-    # Merge in data from carbon's cache
-    try:
-      cached_datapoints = CarbonLink.query(self.real_metric_path)
-    except:
-      log.exception("Failed CarbonLink query '%s'" % self.real_metric_path)
-      cached_datapoints = []
+  def read(self, startTime, endTime):
+    if settings.WHISPER_MMAP:
+      return fetch_whisper_mmap(self.fs_path, startTime, endTime)
+    else:
+      return whisper.fetch(self.fs_path, startTime, endTime)
 
-    for (timestamp, value) in cached_datapoints:
-      interval = timestamp - (timestamp % step)
+  def empty(self, startTime, endTime):
+    if settings.WHISPER_MMAP:
+      header = get_whisper_header(self.fs_path)
+    else:
+      header = whisper.info(self.fs_path)
 
-      try:
-        i = int(interval - start) / step
-        values[i] = value
-      except:
-        pass
+    window = whisper_window(header, startTime, endTime)
+    if window is None:
+      return None
 
-    return (time_info, values)
+    (archive, fromInterval, untilInterval) = window
+    step = archive['secondsPerPoint']
+    return ((fromInterval, untilInterval, step), [None] * ((untilInterval - fromInterval) // step))
 
 
 class GzippedWhisperReader(WhisperReader):
   supported = bool(whisper and gzip)
 
   def get_intervals(self):
+    intervals = catalog_intervals(self.fs_path)
+    if intervals is not None:
+      return intervals
+
     fh = gzip.GzipFile(self.fs_path, 'rb')
     try:
       info = whisper.__readHeader(fh) # evil, but necessary.
@@ -204,6 +547,10 @@ class GzippedWhisperReader(WhisperReader):
     finally:
       fh.close()
 
+  @classmethod
+  def fetch_multi(cls, readers, startTime, endTime):
+    return run_concurrently(lambda reader: reader.fetch(startTime, endTime), readers)
+
 
 class RRDReader:
   supported = bool(rrdtool)
@@ -213,6 +560,10 @@ class RRDReader:
     self.datasource_name = datasource_name
 
   def get_intervals(self):
+    intervals = catalog_intervals(self.fs_path)
+    if intervals is not None:
+      return intervals
+
     start = time.time() - self.get_retention(self.fs_path)
     end = max( os.stat(self.fs_path).st_mtime, start )
     return IntervalSet( [Interval(start, end)] )
@@ -1,6 +1,7 @@
 import socket
 import time
 import httplib
+from functools import partial
 from urllib import urlencode
 from threading import Lock, Event
 from django.conf import settings
@@ -101,6 +102,7 @@ class FindRequest(object):
       except:
         log.exception("FindRequest.get_results(host=%s, query=%s) exception processing response" % (self.store.host, self.query))
         self.store.fail()
+        self.failed = True
         return
 
       cache.set(self.cacheKey, results, settings.FIND_CACHE_DURATION)
@@ -136,6 +138,28 @@ class RemoteReader(object):
     return self.intervals
 
   def fetch(self, startTime, endTime):
+    return self.fetch_multi([self], startTime, endTime)[0]
+
+  @classmethod
+  def fetch_multi(cls, readers, startTime, endTime):
+    # Readers sharing a store and bulk query are served by a single request,
+    # whose series are only indexed by name once
+    series_by_request = {}
+    results = []
+
+    for reader in readers:
+      key = (reader.store.host, reader.query)
+      if key not in series_by_request:
+        series_by_request[key] = SeriesIndex(reader.request_series(startTime, endTime))
+
+      series_index = series_by_request[key]
+      results.append( FetchInProgress(partial(series_index.get_results, reader.metric_path)) )
+
+    return results
+
+  def request_series(self, startTime, endTime):
+    """Sends the render request for this reader's bulk query, unless another
+    reader already did, and returns a callable waiting for its series"""
     query_params = [
       ('target', self.query),
       ('format', 'pickle'),
@@ -152,10 +176,7 @@ class RemoteReader(object):
     self.clean_cache()
     cached_results = self.request_cache.get(url)
     if cached_results:
-      for series in cached_results:
-        if series['name'] == self.metric_path:
-          time_info = (series['start'], series['end'], series['step'])
-          return (time_info, series['values'])
+      return lambda: cached_results
 
     # Synchronize with other RemoteReaders using the same bulk query.
     # Despite our use of thread synchronization primitives, the common
@@ -203,13 +224,7 @@ class RemoteReader(object):
         else:
           return cached_results
 
-    def extract_my_results():
-      for series in wait_for_results():
-        if series['name'] == self.metric_path:
-          time_info = (series['start'], series['end'], series['step'])
-          return (time_info, series['values'])
-
-    return FetchInProgress(extract_my_results)
+    return wait_for_results
 
   def clean_cache(self):
     self.cache_lock.acquire()
@@ -238,6 +253,25 @@ class RemoteReader(object):
       self.cache_lock.release()
 
 
+class SeriesIndex(object):
+  """Waits for the series of a remote render request once, indexing them by
+  name for every reader interested in the result"""
+  __slots__ = ('wait_callback', 'series')
+
+  def __init__(self, wait_callback):
+    self.wait_callback = wait_callback
+    self.series = None
+
+  def get_results(self, metric_path):
+    if self.series is None:
+      self.series = dict( (series['name'], series) for series in self.wait_callback() )
+
+    series = self.series.get(metric_path)
+    if series is not None:
+      time_info = (series['start'], series['end'], series['step'])
+      return (time_info, series['values'])
+
+
 # This is a hack to put a timeout in the connect() of an HTTP request.
 # Python 2.6 supports this already, but many Graphite installations
 # are not on 2.6 yet.
@@ -15,7 +15,7 @@ limitations under the License."""
 import time
 from graphite.logger import log
 from graphite.storage import STORE
-from graphite.readers import FetchInProgress
+from graphite.readers import FetchInProgress, fetch_multi
 from django.conf import settings
 
 class TimeSeries(list):
@@ -96,7 +96,8 @@ def fetchData(requestContext, pathExpr):
 
   def _fetchData(pathExpr,startTime, endTime, requestContext, seriesList):
     matching_nodes = STORE.find(pathExpr, startTime, endTime, local=requestContext['localOnly'])
-    fetches = [(node, node.fetch(startTime, endTime)) for node in matching_nodes if node.is_leaf]
+    leaf_nodes = [node for node in matching_nodes if node.is_leaf]
+    fetches = zip(leaf_nodes, fetch_multi(leaf_nodes, startTime, endTime))
 
     for node, results in fetches:
       if isinstance(results, FetchInProgress):
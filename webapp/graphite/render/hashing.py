@@ -17,6 +17,8 @@ from hashlib import md5
 from itertools import chain
 import bisect
 
+from graphite.util import LRUCache
+
 
 def hashRequest(request):
   # Normalize the request parameters so ensure we're deterministic
@@ -42,50 +44,84 @@ def compactHash(string):
   return hash.hexdigest()
 
 
+def fnv32a(string, seed=0x811c9dc5):
+  "32 bit FNV-1a hash of string, as computed by carbon"
+  hval = seed
+  fnv_32_prime = 0x01000193
+  uint32_max = 2 ** 32
+  for char in string:
+    hval = hval ^ ord(char)
+    hval = (hval * fnv_32_prime) % uint32_max
+  return hval
+
+
 class ConsistentHashRing:
-  def __init__(self, nodes, replica_count=100):
+  """Consistent hash ring over a set of nodes.
+
+  The hash types are carbon's: 'carbon_ch' places nodes with 16 bits of md5
+  per ring position, 'fnv1a_ch' folds a 32 bit FNV-1a hash into 16 bits and
+  keys the replicas of a node on its instance name only, like carbon's relays
+  configured with the same hash type.
+
+  The ordered list of distinct nodes met walking the ring from a position is
+  computed once per position and reused by every key landing there. Lookups
+  can additionally be memoized in an LRU cache of cache_size keys."""
+  hash_types = ('carbon_ch', 'fnv1a_ch')
+
+  def __init__(self, nodes, replica_count=100, hash_type='carbon_ch', cache_size=0):
+    if hash_type not in self.hash_types:
+      raise ValueError("Unknown consistent hashing type %s" % hash_type)
     self.ring = []
     self.ring_len = len(self.ring)
     self.nodes = set()
     self.nodes_len = len(self.nodes)
     self.replica_count = replica_count
+    self.hash_type = hash_type
+    self.positions = []
+    self.walks = []
+    self.cache = LRUCache(cache_size) if cache_size else None
     for node in nodes:
       self.add_node(node)
 
   def compute_ring_position(self, key):
-    big_hash = md5( str(key) ).hexdigest()
-    small_hash = int(big_hash[:4], 16)
+    if self.hash_type == 'fnv1a_ch':
+      big_hash = '%x' % fnv32a(str(key))
+      small_hash = int(big_hash[:4], 16) ^ int(big_hash[4:], 16)
+    else:
+      big_hash = md5( str(key) ).hexdigest()
+      small_hash = int(big_hash[:4], 16)
     return small_hash
 
   def add_node(self, key):
     self.nodes.add(key)
     self.nodes_len = len(self.nodes)
     for i in range(self.replica_count):
-      replica_key = "%s:%d" % (key, i)
+      if self.hash_type == 'fnv1a_ch':
+        replica_key = "%d-%s" % (i, key[1])
+      else:
+        replica_key = "%s:%d" % (key, i)
       position = self.compute_ring_position(replica_key)
       entry = (position, key)
       bisect.insort(self.ring, entry)
     self.ring_len = len(self.ring)
+    self.precompute()
 
   def remove_node(self, key):
     self.nodes.discard(key)
     self.nodes_len = len(self.nodes)
     self.ring = [entry for entry in self.ring if entry[1] != key]
     self.ring_len = len(self.ring)
+    self.precompute()
 
-  def get_node(self, key):
-    assert self.ring
-    position = self.compute_ring_position(key)
-    search_entry = (position, None)
-    index = bisect.bisect_left(self.ring, search_entry) % self.ring_len
-    entry = self.ring[index]
-    return entry[1]
+  def precompute(self):
+    self.positions = [position for (position, node) in self.ring]
+    self.walks = [None] * self.ring_len # filled in as positions get used
+    if self.cache is not None:
+      self.cache.clear()
 
-  def get_nodes(self, key):
+  def walk(self, index):
+    "Returns the distinct nodes met walking the ring from index"
     nodes = []
-    position = self.compute_ring_position(key)
-    search_entry = (position, None)
-    index = bisect.bisect_left(self.ring, search_entry) % self.ring_len
     last_index = (index - 1) % self.ring_len
     nodes_len = len(nodes)
     while nodes_len < self.nodes_len and index != last_index:
@@ -97,4 +133,27 @@ class ConsistentHashRing:
 
       index = (index + 1) % self.ring_len
 
-    return nodes
+    return tuple(nodes)
+
+  def get_node(self, key):
+    assert self.ring
+    return self.get_nodes(key)[0]
+
+  def get_nodes(self, key):
+    if not self.ring:
+      return []
+
+    if self.cache is not None:
+      nodes = self.cache.get(key)
+      if nodes is not None:
+        return list(nodes)
+
+    position = self.compute_ring_position(key)
+    index = bisect.bisect_left(self.positions, position) % self.ring_len
+    nodes = self.walks[index]
+    if nodes is None:
+      nodes = self.walks[index] = self.walk(index)
+
+    if self.cache is not None:
+      self.cache.set(key, nodes)
+    return list(nodes)
@@ -41,6 +41,7 @@ GRAPHTEMPLATES_CONF = ''
 STORAGE_DIR = ''
 WHITELIST_FILE = ''
 INDEX_FILE = ''
+METRIC_CATALOG_FILE = ''
 LOG_DIR = ''
 CERES_DIR = ''
 WHISPER_DIR = ''
@@ -59,12 +60,22 @@ CARBON_METRIC_PREFIX='carbon'
 CARBONLINK_HOSTS = ["127.0.0.1:7002"]
 CARBONLINK_TIMEOUT = 1.0
 CARBONLINK_HASHING_KEYFUNC = None
+CARBONLINK_HASHING_TYPE = 'carbon_ch'
+CARBONLINK_HASHING_CACHE_SIZE = 0
 CARBONLINK_RETRY_DELAY = 15
+CARBONLINK_POOL_SIZE = 10
+CARBONLINK_POOL_IDLE_TIMEOUT = 60
+CARBONLINK_HEDGED_REQUESTS = False
+CARBONLINK_HEDGE_PERCENTILE = 95
+CARBONLINK_CACHE_HORIZON = 0
+CARBONLINK_CACHE_ONLY_WINDOW = 0
 REPLICATION_FACTOR = 1
 MEMCACHE_HOSTS = []
 MEMCACHE_KEY_PREFIX = ''
 FIND_CACHE_DURATION = 300
 FIND_TOLERANCE = 2 * FIND_CACHE_DURATION
+NEGATIVE_FIND_CACHE_DURATION = 0
+LOCAL_FIND_CACHE_SIZE = 0
 DEFAULT_CACHE_DURATION = 60 #metric data and graphs are cached for one minute by default
 LOG_CACHE_PERFORMANCE = False
 LOG_ROTATE = True
@@ -86,6 +97,11 @@ RRD_CF = 'AVERAGE'
 STORAGE_FINDERS = (
     'graphite.finders.standard.StandardFinder',
 )
+TRIE_FINDER_REFRESH_INTERVAL = 60
+TRIE_FINDER_USE_INDEX = False
+INDEX_FORMAT = 'text'
+INDEX_TRIGRAMS = True
+USE_METRIC_CATALOG = False
 
 #Authentication settings
 USE_LDAP_AUTH = False
@@ -126,6 +142,17 @@ DATABASES = None
 # If using rrdcached, set to the address or socket of the daemon
 FLUSHRRDCACHED = ''
 
+# Read whisper files through read-only memory mappings, caching parsed headers
+WHISPER_MMAP = False
+WHISPER_HEADER_CACHE_SIZE = 10000
+
+# Worker threads per process reading local data files concurrently (0 disables)
+FETCH_POOL_SIZE = 0
+# Maximum number of workers a single fetch may occupy
+FETCH_CONCURRENCY = 8
+# Worker threads per process running local finders and directories concurrently (0 disables)
+FIND_POOL_SIZE = 0
+
 ## Load our local_settings
 try:
   from graphite.local_settings import *  # noqa
@@ -158,6 +185,8 @@ if not WHITELIST_FILE:
   WHITELIST_FILE = join(STORAGE_DIR, 'lists', 'whitelist')
 if not INDEX_FILE:
   INDEX_FILE = join(STORAGE_DIR, 'index')
+if not METRIC_CATALOG_FILE:
+  METRIC_CATALOG_FILE = join(STORAGE_DIR, 'catalog.db')
 if not LOG_DIR:
   LOG_DIR = join(STORAGE_DIR, 'log', 'webapp')
 if not WHISPER_DIR:
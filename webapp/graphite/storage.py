@@ -1,4 +1,9 @@
+import heapq
+import os
 import time
+from functools import partial
+from multiprocessing.pool import ThreadPool
+from threading import Lock
 
 try:
   from importlib import import_module
@@ -6,12 +11,14 @@ except ImportError:  # python < 2.7 compatibility
   from django.utils.importlib import import_module
 
 from django.conf import settings
+from django.core.cache import cache
 
-from graphite.util import is_local_interface, is_pattern
+from graphite.util import LRUCache, is_local_interface, is_pattern
 from graphite.remote_storage import RemoteStore
-from graphite.node import LeafNode
+from graphite.node import BranchNode, LeafNode
 from graphite.intervals import Interval, IntervalSet
 from graphite.readers import MultiReader
+from graphite.render.hashing import compactHash
 
 
 def get_finder(finder_path):
@@ -20,6 +27,146 @@ def get_finder(finder_path):
   return getattr(module, class_name)()
 
 
+def select_minimal_node_set(leaf_nodes, query_interval, prior_to_window=None):
+  """Picks the leaf nodes of a path that together cover as much of
+  query_interval as possible. Local nodes adding any coverage come first,
+  then the node adding the most coverage is taken until none adds any,
+  only counting coverage before prior_to_window's end if it is given."""
+  minimal_node_set = set()
+  covered_intervals = IntervalSet([])
+  nodes_remaining = []
+
+  # Prefer local nodes first (and do *not* drop the tolerance window)
+  relevant_intervals = {}
+  for node in leaf_nodes:
+    relevant_intervals[node] = node.intervals.intersect_interval(query_interval)
+    if node.local and measure_of_added_coverage(covered_intervals, relevant_intervals[node]) > 0:
+      minimal_node_set.add(node)
+      covered_intervals = covered_intervals.union(node.intervals)
+    else:
+      nodes_remaining.append(node)
+
+  if prior_to_window is not None:
+    for node in nodes_remaining:
+      relevant_intervals[node] = relevant_intervals[node].intersect_interval(prior_to_window)
+
+  # Coverage a node adds only shrinks as more is covered, so the coverage
+  # computed for a node earlier is an upper bound of what it adds now. Only
+  # the node at the top of the heap is measured again, and it is taken if it
+  # still beats every other node's bound.
+  heap = [ (-relevant_intervals[node].size, i, node) for (i, node) in enumerate(nodes_remaining) ]
+  heapq.heapify(heap)
+
+  while heap:
+    (bound, i, node) = heapq.heappop(heap)
+    coverage = measure_of_added_coverage(covered_intervals, relevant_intervals[node])
+    if heap and coverage < -heap[0][0]:
+      heapq.heappush(heap, (-coverage, i, node))
+      continue
+
+    if coverage == 0:
+      break
+
+    minimal_node_set.add(node)
+    covered_intervals = covered_intervals.union(node.intervals)
+
+  return minimal_node_set
+
+
+def find_cache_key(query):
+  """Returns the (pattern, start, end, index version) a query's results are
+  cached under. Times are bucketed like remote find results unless
+  FIND_CACHE_DURATION is 0, and rebuilding INDEX_FILE changes the index
+  version."""
+  duration = settings.FIND_CACHE_DURATION
+  (start, end) = (query.startTime or "", query.endTime or "")
+  if duration > 0:
+    start = start and start - (start % duration)
+    end = end and end - (end % duration)
+
+  try:
+    index_mtime = int( os.path.getmtime(settings.INDEX_FILE) )
+  except OSError:
+    index_mtime = 0
+
+  return (query.pattern, start, end, index_mtime)
+
+
+def negative_find_cache_key(query, local):
+  "Returns the cache key recording that a query matched nothing"
+  key = "%s:%s:%s:%d:%s" % (find_cache_key(query) + (int(local),))
+  return "find-miss:%s" % compactHash(key)
+
+
+def node_descriptor(node):
+  """Returns the (path, reader, intervals) a LeafNode or BranchNode can be
+  created from again, reader being None for branches and intervals None
+  unless the finder already set them (from the metric catalog, say). Any
+  other kind of node gives None."""
+  if node.__class__ is LeafNode:
+    return (node.path, node.reader, node._intervals)
+  elif node.__class__ is BranchNode:
+    return (node.path, None, None)
+
+
+def node_from_descriptor(descriptor):
+  (path, reader, intervals) = descriptor
+  if reader is None:
+    return BranchNode(path)
+  node = LeafNode(path, reader)
+  node.intervals = intervals
+  return node
+
+
+def measure_of_added_coverage(covered_intervals, relevant_intervals):
+  """Returns how much of relevant_intervals covered_intervals leaves
+  uncovered, sweeping the sorted bounds of both sets at once"""
+  (covered_starts, covered_ends) = (covered_intervals.starts, covered_intervals.ends)
+  count = len(covered_starts)
+  added = 0
+  i = 0
+
+  for (start, end) in zip(relevant_intervals.starts, relevant_intervals.ends):
+    while i < count and covered_ends[i] <= start:
+      i += 1
+
+    cursor = start
+    j = i
+    while j < count and covered_starts[j] < end:
+      if covered_starts[j] > cursor:
+        added += covered_starts[j] - cursor
+      cursor = max(cursor, covered_ends[j])
+      j += 1
+
+    if cursor < end:
+      added += end - cursor
+
+  return added
+
+
+find_pool = None
+find_pool_pid = None
+find_pool_lock = Lock()
+
+
+def get_find_pool():
+  "Returns this process' worker pool for local finds, or None if disabled"
+  global find_pool, find_pool_pid
+  if settings.FIND_POOL_SIZE < 1:
+    return None
+
+  with find_pool_lock:
+    # Worker threads do not survive a fork, so each process gets its own pool
+    if find_pool is None or find_pool_pid != os.getpid():
+      find_pool = ThreadPool(settings.FIND_POOL_SIZE)
+      find_pool_pid = os.getpid()
+    return find_pool
+
+
+def run_find_task(task):
+  return list( task() )
+
+
 class Store:
   def __init__(self, finders=None, hosts=None):
     if finders is None:
@@ -31,22 +178,31 @@ class Store:
       hosts = settings.CLUSTER_SERVERS
     remote_hosts = [host for host in hosts if not is_local_interface(host)]
     self.remote_stores = [ RemoteStore(host) for host in remote_hosts ]
+    self.local_find_cache = LRUCache(settings.LOCAL_FIND_CACHE_SIZE)
 
 
   def find(self, pattern, startTime=None, endTime=None, local=False):
     query = FindQuery(pattern, startTime, endTime)
 
+    # Patterns that recently matched nothing anywhere are not searched again
+    if settings.NEGATIVE_FIND_CACHE_DURATION > 0:
+      miss_key = negative_find_cache_key(query, local)
+      if cache.get(miss_key):
+        return
+    else:
+      miss_key = None
+
     # Start remote searches
     if not local:
       remote_requests = [ r.find(query) for r in self.remote_stores if r.available ]
+      complete = len(remote_requests) == len(self.remote_stores)
+    else:
+      complete = True
 
     matching_nodes = set()
 
     # Search locally
-    for finder in self.finders:
-      for node in finder.find_nodes(query):
-        #log.info("find() :: local :: %s" % node)
-        matching_nodes.add(node)
+    matching_nodes.update( self.find_local_cached(query) )
 
     # Gather remote search results
     if not local:
@@ -54,6 +210,12 @@ class Store:
         for node in request.get_results():
           #log.info("find() :: remote :: %s from %s" % (node,request.store.host))
           matching_nodes.add(node)
+        if request.failed:
+          complete = False
+
+    # A miss is only cached when every store could be searched
+    if not matching_nodes and complete and miss_key is not None:
+      cache.set(miss_key, True, settings.NEGATIVE_FIND_CACHE_DURATION)
 
     # Group matching nodes by their path
     nodes_by_path = {}
@@ -63,6 +225,16 @@ class Store:
 
       nodes_by_path[node.path].append(node)
 
+    # If the query doesn't fall entirely within the FIND_TOLERANCE window
+    # we disregard the window. This prevents unnecessary remote fetches
+    # caused when carbon's cache skews node.intervals, giving the appearance
+    # remote systems have data we don't have locally, which we probably do.
+    tolerance_window = int( time.time() ) - settings.FIND_TOLERANCE
+    if query.interval.start < tolerance_window:
+      prior_to_window = Interval( float('-inf'), tolerance_window )
+    else:
+      prior_to_window = None
+
     # Reduce matching nodes for each path to a minimal set
     found_branch_nodes = set()
 
@@ -80,44 +252,13 @@ class Store:
       if not leaf_nodes:
         continue
 
-      # Calculate best minimal node set
-      minimal_node_set = set()
-      covered_intervals = IntervalSet([])
-
-      # If the query doesn't fall entirely within the FIND_TOLERANCE window
-      # we disregard the window. This prevents unnecessary remote fetches
-      # caused when carbon's cache skews node.intervals, giving the appearance
-      # remote systems have data we don't have locally, which we probably do.
-      now = int( time.time() )
-      tolerance_window = now - settings.FIND_TOLERANCE
-      disregard_tolerance_window = query.interval.start < tolerance_window
-      prior_to_window = Interval( float('-inf'), tolerance_window )
-
-      def measure_of_added_coverage(node, drop_window=disregard_tolerance_window):
-        relevant_intervals = node.intervals.intersect_interval(query.interval)
-        if drop_window:
-          relevant_intervals = relevant_intervals.intersect_interval(prior_to_window)
-        return covered_intervals.union(relevant_intervals).size - covered_intervals.size
-
-      nodes_remaining = list(leaf_nodes)
-
-      # Prefer local nodes first (and do *not* drop the tolerance window)
-      for node in leaf_nodes:
-        if node.local and measure_of_added_coverage(node, False) > 0:
-          nodes_remaining.remove(node)
-          minimal_node_set.add(node)
-          covered_intervals = covered_intervals.union(node.intervals)
-
-      while nodes_remaining:
-        node_coverages = [ (measure_of_added_coverage(n), n) for n in nodes_remaining ]
-        best_coverage, best_node = max(node_coverages)
-
-        if best_coverage == 0:
-          break
+      # A lone leaf has nothing to be reduced against, so unless the query is
+      # bounded in time we can yield it without computing its intervals
+      if len(leaf_nodes) == 1 and query.startTime is None and query.endTime is None:
+        yield leaf_nodes[0]
+        continue
 
-        nodes_remaining.remove(best_node)
-        minimal_node_set.add(best_node)
-        covered_intervals = covered_intervals.union(best_node.intervals)
+      minimal_node_set = select_minimal_node_set(leaf_nodes, query.interval, prior_to_window)
 
       # Sometimes the requested interval falls within the caching window.
       # We include the most likely node if the gap is within tolerance.
@@ -137,6 +278,45 @@ class Store:
         reader = MultiReader(minimal_node_set)
         yield LeafNode(path, reader)
 
+  def find_local_cached(self, query):
+    """Returns the nodes the local finders find, from the local find cache
+    when they were found less than FIND_CACHE_DURATION ago. The cache holds
+    node descriptors, every hit gets new nodes so that intervals computed for
+    one request are not reused by the next."""
+    if settings.LOCAL_FIND_CACHE_SIZE < 1 or settings.FIND_CACHE_DURATION <= 0:
+      return [ node for nodes in self.find_local(query) for node in nodes ]
+
+    key = find_cache_key(query)
+    now = time.time()
+    entry = self.local_find_cache.get(key)
+    if entry is not None and entry[0] > now:
+      return [ node_from_descriptor(descriptor) for descriptor in entry[1] ]
+
+    nodes = [ node for nodes in self.find_local(query) for node in nodes ]
+    descriptors = [ node_descriptor(node) for node in nodes ]
+    if None in descriptors:
+      self.local_find_cache.pop(key)
+    else:
+      self.local_find_cache.set(key, (now + settings.FIND_CACHE_DURATION, descriptors))
+    return nodes
+
+  def find_local(self, query):
+    """Generates the nodes each local finder found, as lists. Finders with a
+    find_tasks(query) method split their find into several callables, such as
+    one per root directory. With FIND_POOL_SIZE set the tasks run
+    concurrently and their results are generated as they complete."""
+    tasks = []
+    for finder in self.finders:
+      if hasattr(finder, 'find_tasks'):
+        tasks.extend( finder.find_tasks(query) )
+      else:
+        tasks.append( partial(finder.find_nodes, query) )
+
+    pool = get_find_pool()
+    if pool is None or len(tasks) < 2:
+      return ( run_find_task(task) for task in tasks )
+    return pool.imap_unordered(run_find_task, tasks)
+
 
 
 class FindQuery:
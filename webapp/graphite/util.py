@@ -18,8 +18,10 @@ import socket
 import time
 import sys
 from os.path import splitext, basename, relpath
-from shutil import move
 from tempfile import mkstemp
+from threading import Lock
+from collections import OrderedDict
+from multiprocessing.pool import ThreadPool
 try:
   import cPickle as pickle
   USING_CPICKLE = True
@@ -188,30 +190,130 @@ else:
 unpickle = SafeUnpickler
 
 
-def write_index(whisper_dir=None, ceres_dir=None, index=None):
+class LRUCache(object):
+  """A thread-safe mapping holding at most max_size entries. Once full, the
+  least recently used entry is evicted to make room for a new one."""
+  def __init__(self, max_size):
+    self.max_size = max_size
+    self.lock = Lock()
+    self.entries = OrderedDict()
+
+  def __len__(self):
+    return len(self.entries)
+
+  def __contains__(self, key):
+    return key in self.entries
+
+  def get(self, key, default=None):
+    with self.lock:
+      try:
+        value = self.entries.pop(key)
+      except KeyError:
+        return default
+      self.entries[key] = value
+      return value
+
+  def set(self, key, value):
+    with self.lock:
+      self.entries.pop(key, None)
+      self.entries[key] = value
+      while len(self.entries) > self.max_size:
+        self.entries.popitem(last=False)
+
+  def pop(self, key, default=None):
+    with self.lock:
+      return self.entries.pop(key, default)
+
+  def clear(self):
+    with self.lock:
+      self.entries.clear()
+
+
+def write_index(whisper_dir=None, ceres_dir=None, index=None, format=None,
+                incremental=False, jobs=1):
+  """Rebuilds the search index. An incremental rebuild only lists the
+  directories whose mtime changed since the previous one, as recorded in the
+  index's .state file, and walks top level subtrees on jobs threads."""
   if not whisper_dir:
     whisper_dir = settings.WHISPER_DIR
   if not ceres_dir:
     ceres_dir = settings.CERES_DIR
   if not index:
     index = settings.INDEX_FILE
+  if not format:
+    format = settings.INDEX_FORMAT
+
+  state_file = index + '.state'
+  if incremental:
+    state = load_index_state(state_file)
+    new_state = {}
+
+  # Written next to the index so that renaming it over the index is atomic
+  fd, tmp = mkstemp(dir=os.path.dirname( os.path.abspath(index) ))
   try:
-    fd, tmp = mkstemp()
+    tmp_index = os.fdopen(fd, 'wb')
     try:
-      tmp_index = os.fdopen(fd, 'wt')
-      build_index(whisper_dir, ".wsp", tmp_index)
-      build_index(ceres_dir, ".ceres-node", tmp_index)
+      if format == 'binary':
+        output = MetricPathCollector()
+      else:
+        output = tmp_index
+
+      for (base_path, extension) in [(whisper_dir, ".wsp"), (ceres_dir, ".ceres-node")]:
+        if incremental:
+          new_state[base_path] = build_index_incremental(base_path, extension, output,
+                                                         state.get(base_path, {}), jobs)
+        else:
+          build_index(base_path, extension, output)
+
+      if format == 'binary':
+        from graphite.metrics.index import write_binary_index
+        t = time.time()
+        entries = write_binary_index(output, tmp_index)
+        log.info("[IndexSearcher] binary index write took %.6f seconds (%d entries)" % (time.time() - t, entries))
     finally:
       tmp_index.close()
-    move(tmp, index)
+    os.rename(tmp, index)
   finally:
     try:
       os.unlink(tmp)
     except:
       pass
+
+  if incremental:
+    save_index_state(state_file, new_state)
   return None
 
 
+def load_index_state(state_file):
+  try:
+    with open(state_file, 'rb') as fh:
+      return pickle.load(fh)
+  except Exception:
+    return {} # missing or unreadable, everything gets rescanned
+
+
+def save_index_state(state_file, state):
+  fd, tmp = mkstemp(dir=os.path.dirname( os.path.abspath(state_file) ))
+  try:
+    with os.fdopen(fd, 'wb') as fh:
+      pickle.dump(state, fh, protocol=-1)
+    os.rename(tmp, state_file)
+  finally:
+    try:
+      os.unlink(tmp)
+    except:
+      pass
+
+
+class MetricPathCollector(list):
+  "Collects the metric paths build_index() writes out as lines"
+  def write(self, line):
+    self.append( line.rstrip('\n') )
+
+  def flush(self):
+    pass
+
+
 def build_index(base_path, extension, fd):
   t = time.time()
   total_entries = 0
@@ -230,3 +332,64 @@ def build_index(base_path, extension, fd):
   fd.flush()
   log.info("[IndexSearcher] index rebuild of \"%s\" took %.6f seconds (%d entries)" % (base_path, time.time() - t, total_entries))
   return None
+
+
+def build_index_incremental(base_path, extension, fd, state, jobs=1):
+  """Writes the same lines as build_index() but reuses the entries state
+  recorded for directories whose mtime did not change. Returns the new state,
+  a dict of directory -> (mtime, metrics, subdirectories)."""
+  t = time.time()
+  new_state = {}
+  lines = scan_index_directory(base_path, '', extension, state, new_state, recurse=False)
+
+  subdirs = new_state.get('', (None, [], []))[2]
+  scan_subtree = lambda subdir: scan_index_directory(base_path, subdir, extension, state, new_state)
+  if jobs > 1 and len(subdirs) > 1:
+    pool = ThreadPool( min(jobs, len(subdirs)) )
+    try:
+      subtrees = pool.map(scan_subtree, subdirs, 1)
+    finally:
+      pool.close()
+  else:
+    subtrees = map(scan_subtree, subdirs)
+
+  for subtree in [lines] + subtrees:
+    for line in subtree:
+      fd.write(line)
+  fd.flush()
+
+  total_entries = sum(len(metrics) for (mtime, metrics, subdirs) in new_state.values())
+  rescanned = sum(1 for (directory, entry) in new_state.items() if state.get(directory) is not entry)
+  log.info("[IndexSearcher] incremental index rebuild of \"%s\" took %.6f seconds (%d entries, %d of %d directories rescanned)" %
+           (base_path, time.time() - t, total_entries, rescanned, len(new_state)))
+  return new_state
+
+
+def scan_index_directory(base_path, directory, extension, state, new_state, recurse=True):
+  from graphite.finders import list_directory
+  fs_dir = os.path.join(base_path, directory)
+  try:
+    mtime = os.stat(fs_dir).st_mtime
+  except OSError:
+    return []
+
+  entry = state.get(directory)
+  if entry is None or entry[0] != mtime:
+    # Like the full walk, directories that vanished or cannot be read are
+    # left out with their subtree, and are listed again by the next build
+    try:
+      (subdirs, files) = list_directory(fs_dir)
+    except OSError as e:
+      log.exception("Leaving %s out of the index: %s" % (fs_dir, e))
+      return []
+    metrics = [ f[:-len(extension)] for f in files if f.endswith(extension) ]
+    entry = (mtime, metrics, subdirs)
+  new_state[directory] = entry
+
+  path = relpath(fs_dir, base_path).replace('/', '.')
+  lines = [ "{0}.{1}\n".format(path, metric) for metric in entry[1] ]
+  if recurse:
+    for subdir in entry[2]:
+      lines.extend( scan_index_directory(base_path, os.path.join(directory, subdir),
+                                         extension, state, new_state) )
+  return lines
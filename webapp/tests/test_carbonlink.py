@@ -0,0 +1,338 @@
+import cPickle as pickle
+import os
+import socket
+import struct
+import threading
+import time
+
+from django.conf import settings
+from django.test import TestCase
+
+from django.test.utils import override_settings
+
+from graphite.carbonlink import (CarbonLinkPool, ConnectionPool, ConnectionPoolExhausted,
+                                 LatencyHistogram, parse_hosts, recv_exactly)
+
+
+class FakeCarbonCache(object):
+    """A stand-in carbon-cache answering CarbonLink queries from a dict of
+    metric -> datapoints. Every request received is recorded."""
+    def __init__(self, datapoints, bulk=True, delay=0, path=None,
+                 address='127.0.0.1'):
+        self.datapoints = datapoints
+        self.bulk = bulk
+        self.responses_per_request = 1
+        self.delay = delay
+        self.requests = []
+        if path is None:
+            self.sock = socket.socket()
+            self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            self.sock.bind((address, 0))
+            self.port = self.sock.getsockname()[1]
+        else:
+            self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            self.sock.bind(path)
+            self.port = path
+        self.sock.listen(16)
+        thread = threading.Thread(target=self.serve)
+        thread.daemon = True
+        thread.start()
+
+    def serve(self):
+        while True:
+            try:
+                conn, addr = self.sock.accept()
+            except socket.error:
+                return
+            thread = threading.Thread(target=self.handle, args=(conn,))
+            thread.daemon = True
+            thread.start()
+
+    def handle(self, conn):
+        try:
+            while True:
+                length = struct.unpack('!L', recv_exactly(conn, 4))[0]
+                request = pickle.loads(recv_exactly(conn, length))
+                self.requests.append(request)
+                time.sleep(self.delay)
+                response = pickle.dumps(self.respond(request), protocol=-1)
+                conn.sendall((struct.pack('!L', len(response)) + response) *
+                             self.responses_per_request)
+        except Exception:
+            conn.close()
+
+    def respond(self, request):
+        if request['type'] == 'cache-query':
+            return {'datapoints': self.datapoints.get(request['metric'], [])}
+        if request['type'] == 'set-metadata':
+            return {'old_value': None}
+        if request['type'] == 'cache-query-bulk' and self.bulk:
+            return {'datapointsByMetric': dict(
+                (m, self.datapoints.get(m, [])) for m in request['metrics'])}
+        return {'error': 'Invalid request type "%s"' % request['type']}
+
+    def close(self):
+        self.sock.close()
+
+
+class CarbonLinkTest(TestCase):
+    def setUp(self):
+        self.datapoints = dict(('metric%d' % i, [(60 * i, float(i))])
+                               for i in range(50))
+        self.caches = [FakeCarbonCache(self.datapoints),
+                       FakeCarbonCache(self.datapoints)]
+        self.pool = CarbonLinkPool(
+            [('127.0.0.1', cache.port, str(i))
+             for i, cache in enumerate(self.caches)], 1.0)
+
+    def tearDown(self):
+        for cache in self.caches:
+            cache.close()
+
+    def test_query(self):
+        self.assertEqual(self.pool.query('metric3'), [(180, 3.0)])
+        self.assertEqual(self.pool.query('missing'), [])
+
+    def test_query_bulk(self):
+        metrics = sorted(self.datapoints)
+        self.assertEqual(self.pool.query_bulk(metrics), self.datapoints)
+
+        # One request per carbon-cache holding any of the metrics
+        requests = [r for cache in self.caches for r in cache.requests]
+        self.assertEqual(len(requests), 2)
+        self.assertEqual(set(r['type'] for r in requests),
+                         set(['cache-query-bulk']))
+        self.assertEqual(sorted(m for r in requests for m in r['metrics']),
+                         metrics)
+
+    def test_query_bulk_fallback(self):
+        for cache in self.caches:
+            cache.bulk = False
+        metrics = ['metric1', 'metric2']
+        self.assertEqual(self.pool.query_bulk(metrics),
+                         dict((m, self.datapoints[m]) for m in metrics))
+
+    def test_query_all_hosts(self):
+        self.datapoints['carbon.agents.a'] = [(60, 1.0), (120, 2.0)]
+        self.assertEqual(self.pool.query('carbon.agents.a'),
+                         [(60, 1.0), (120, 2.0)] * 2)
+        self.assertEqual(self.pool.query_bulk(['carbon.agents.a', 'metric1']),
+                         {'carbon.agents.a': [(60, 1.0), (120, 2.0)] * 2,
+                          'metric1': [(60, 1.0)]})
+
+    def test_send_requests_pipelined(self):
+        requests = [{'type': 'cache-query', 'metric': 'metric%d' % i}
+                    for i in range(10)]
+        hosts = self.pool.hosts
+        responses = self.pool.send_requests(dict((h, requests) for h in hosts))
+        for host in hosts:
+            self.assertEqual([r['datapoints'] for r in responses[host]],
+                             [self.datapoints['metric%d' % i] for i in range(10)])
+        # Each host received all its requests over a single connection
+        self.assertEqual([self.pool.connections.idle_count(h) for h in hosts], [1, 1])
+
+    def test_send_requests_extra_responses(self):
+        self.caches[0].responses_per_request = 2
+        request = {'type': 'cache-query', 'metric': 'metric1'}
+        hosts = self.pool.hosts
+        responses = self.pool.send_requests(dict((h, [request]) for h in hosts))
+        self.assertEqual(list(responses), [hosts[1]])
+        # The out of sync connection is closed rather than pooled
+        self.assertEqual(self.pool.connections.idle_count(hosts[0]), 0)
+        self.assertEqual(self.pool.connections.open_count(hosts[0]), 0)
+
+    def test_send_requests_timeout(self):
+        self.caches[0].delay = 0.5
+        self.pool.timeout = 0.2
+        request = {'type': 'cache-query', 'metric': 'metric1'}
+        hosts = self.pool.hosts
+        start = time.time()
+        responses = self.pool.send_requests(dict((h, [request]) for h in hosts))
+        self.assertTrue(time.time() - start < 0.4)
+        self.assertEqual(list(responses), [hosts[1]])
+
+    def test_send_requests_saturated_pools(self):
+        self.pool.timeout = 0.2
+        hosts = self.pool.hosts
+        for host in hosts:
+            for i in range(settings.CARBONLINK_POOL_SIZE):
+                self.pool.connections.get(host, 0)
+        request = {'type': 'cache-query', 'metric': 'metric1'}
+        start = time.time()
+        responses = self.pool.send_requests(dict((h, [request]) for h in hosts))
+        # Waiting for connections shares the overall timeout across hosts
+        self.assertTrue(time.time() - start < 0.3)
+        self.assertEqual(responses, {})
+
+
+@override_settings(REPLICATION_FACTOR=2, CARBONLINK_HEDGED_REQUESTS=True)
+class HedgedCarbonLinkTest(TestCase):
+    def setUp(self):
+        self.datapoints = dict(('metric%d' % i, [(60 * i, float(i))])
+                               for i in range(20))
+        # Replicas must live on distinct servers
+        self.caches = [FakeCarbonCache(self.datapoints, address=address)
+                       for address in ('127.0.0.1', '127.0.0.2')]
+        self.pool = CarbonLinkPool(
+            [(cache.sock.getsockname()[0], cache.port, None)
+             for cache in self.caches], 2.0)
+        self.pool.is_available = lambda host: True
+
+    def tearDown(self):
+        for cache in self.caches:
+            cache.close()
+
+    def warm_up(self, host, latency):
+        for i in range(LatencyHistogram.min_samples):
+            self.pool.latencies[host].record(latency)
+
+    def test_hedge_slow_replica(self):
+        self.caches[0].delay = 1.0
+        for host in self.pool.hosts:
+            self.warm_up(host, 0.01)
+        slow_host = self.pool.hosts[0]
+        self.pool.order_replicas = lambda replicas: [slow_host, self.pool.hosts[1]]
+
+        start = time.time()
+        self.assertEqual(self.pool.query('metric3'), [(180, 3.0)])
+        self.assertEqual(self.pool.query_bulk(sorted(self.datapoints)),
+                         self.datapoints)
+        self.assertTrue(time.time() - start < 0.5)
+        # Both requests were sent to the slow replica first, then hedged
+        self.assertEqual(len(self.caches[0].requests), 2)
+        self.assertEqual(len(self.caches[1].requests), 2)
+
+    def test_no_hedge_within_delay(self):
+        for host in self.pool.hosts:
+            self.warm_up(host, 1.0)
+        self.assertEqual(self.pool.query_bulk(sorted(self.datapoints)),
+                         self.datapoints)
+        # Every metric lives on both replicas, so a single bulk request is
+        # sent whichever replica each metric would be asked first
+        self.assertEqual(sum(len(cache.requests) for cache in self.caches), 1)
+
+    def test_writes_not_hedged(self):
+        self.caches[0].delay = 0.5
+        for host in self.pool.hosts:
+            self.warm_up(host, 0.01)
+        slow_host = self.pool.hosts[0]
+        self.pool.order_replicas = lambda replicas: [slow_host, self.pool.hosts[1]]
+
+        self.pool.set_metadata('metric3', 'aggregationMethod', 'max')
+        self.assertEqual(len(self.caches[0].requests), 1)
+        self.assertEqual(len(self.caches[1].requests), 0)
+
+    def test_hedge_failed_replica(self):
+        self.caches[0].close()
+        self.pool.order_replicas = lambda replicas: list(self.pool.hosts)
+        self.assertEqual(self.pool.query('metric3'), [(180, 3.0)])
+
+    def test_latency_histogram(self):
+        histogram = LatencyHistogram(max_samples=100)
+        self.assertEqual(histogram.percentile(95), None)
+        for i in range(90):
+            histogram.record(0.001)
+        for i in range(9):
+            histogram.record(0.1)
+        self.assertTrue(0.001 <= histogram.percentile(50) < 0.002)
+        self.assertTrue(0.1 <= histogram.percentile(95) < 0.15)
+        # Reaching max_samples decays the counts
+        histogram.record(0.1)
+        self.assertEqual(histogram.total, 50)
+
+
+class ConnectionPoolTest(TestCase):
+    def setUp(self):
+        self.cache = FakeCarbonCache({})
+        self.host = ('127.0.0.1', None)
+
+    def tearDown(self):
+        self.cache.close()
+
+    def connect(self):
+        return socket.create_connection(('127.0.0.1', self.cache.port))
+
+    def checkout(self, pool):
+        self.assertTrue(pool.get(self.host, 0) is None)
+        return self.connect()
+
+    def test_reuse_and_limit(self):
+        pool = ConnectionPool(2, 60)
+        connections = [self.checkout(pool) for i in range(2)]
+        self.assertRaises(ConnectionPoolExhausted, pool.get, self.host, 0)
+        self.assertEqual(pool.stats['exhausted'], 1)
+        for connection in connections:
+            pool.put(self.host, connection)
+        self.assertEqual(pool.idle_count(self.host), 2)
+
+        self.assertTrue(pool.get(self.host, 0) is connections[1])
+        self.assertTrue(pool.get(self.host, 0) is connections[0])
+        self.assertEqual(pool.stats['reused'], 2)
+        pool.discard(self.host, connections[0])
+        self.assertEqual(pool.open_count(self.host), 1)
+        self.assertTrue(pool.get(self.host, 0) is None)
+
+    def test_wait_for_release(self):
+        pool = ConnectionPool(1, 60)
+        connection = self.checkout(pool)
+        timer = threading.Timer(0.1, pool.put, (self.host, connection))
+        timer.start()
+        self.assertTrue(pool.get(self.host, 1.0) is connection)
+        timer.join()
+
+    def test_idle_expiry(self):
+        pool = ConnectionPool(2, 0.05)
+        pool.put(self.host, self.checkout(pool))
+        time.sleep(0.1)
+        self.assertTrue(pool.get(self.host, 0) is None)
+        self.assertEqual(pool.stats['expired'], 1)
+        self.assertEqual(pool.open_count(self.host), 1)
+
+    def test_stale_connection(self):
+        pool = ConnectionPool(2, 60)
+        connection = self.checkout(pool)
+        # The fake cache hangs up on garbage requests
+        connection.sendall('\x00\x00\x00\x01x')
+        time.sleep(0.1)
+        pool.put(self.host, connection)
+        self.assertTrue(pool.get(self.host, 0) is None)
+        self.assertEqual(pool.stats['stale'], 1)
+
+
+class UnixSocketCarbonLinkTest(TestCase):
+    def setUp(self):
+        self.paths = [os.path.join(settings.TEMP_GRAPHITE_DIR, 'carbon-%s.sock' % i)
+                      for i in 'ab']
+        self.datapoints = {'metric1': [(60, 1.0)], 'metric2': [(120, 2.0)]}
+        self.caches = [FakeCarbonCache(self.datapoints, path=path)
+                       for path in self.paths]
+
+    def tearDown(self):
+        for cache in self.caches:
+            cache.close()
+        for path in self.paths:
+            os.unlink(path)
+
+    def test_parse_hosts(self):
+        self.assertEqual(
+            parse_hosts(['127.0.0.1:7002:a', '10.0.0.1:7102',
+                         'unix:/var/run/carbon-b.sock:b', 'unix:/tmp/c.sock']),
+            [('127.0.0.1', 7002, 'a'), ('10.0.0.1', 7102, None),
+             ('127.0.0.1', '/var/run/carbon-b.sock', 'b'),
+             ('127.0.0.1', '/tmp/c.sock', None)])
+
+        # Unix sockets are placed by instance name only
+        self.assertRaises(Exception, parse_hosts,
+                          ['127.0.0.1:7002:a', 'unix:/var/run/carbon-a.sock:a'])
+        self.assertRaises(Exception, parse_hosts,
+                          ['unix:/var/run/carbon-a.sock', 'unix:/var/run/carbon-b.sock'])
+
+    def test_unix_socket_query(self):
+        hosts = parse_hosts(['unix:%s:a' % self.paths[0],
+                             'unix:%s:b' % self.paths[1]])
+        pool = CarbonLinkPool(hosts, 1.0)
+        self.assertEqual(pool.query('metric1'), [(60, 1.0)])
+        self.assertEqual(pool.query_bulk(['metric1', 'metric2']),
+                         self.datapoints)
+        # Placement matches the equivalent loopback TCP entries
+        self.assertEqual(pool.hosts, [('127.0.0.1', 'a'), ('127.0.0.1', 'b')])
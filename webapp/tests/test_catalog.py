@@ -0,0 +1,102 @@
+import os
+import shutil
+import time
+
+import whisper
+from mock import patch
+
+from django.conf import settings
+from django.test import TestCase
+from django.test.utils import override_settings
+
+from graphite.finders.standard import StandardFinder
+from graphite.metrics import catalog
+from graphite.metrics.catalog import MetricCatalog, get_catalog, write_catalog
+from graphite.storage import FindQuery, Store
+
+
+class MetricCatalogTest(TestCase):
+    def setUp(self):
+        self.whisper_dir = os.path.join(settings.TEMP_GRAPHITE_DIR, 'catalog_whisper')
+        self.catalog_file = os.path.join(settings.TEMP_GRAPHITE_DIR, 'catalog.db')
+        os.makedirs(os.path.join(self.whisper_dir, 'hosts'))
+        self.addCleanup(shutil.rmtree, self.whisper_dir)
+        self.addCleanup(os.unlink, self.catalog_file)
+
+        self.live = os.path.join(self.whisper_dir, 'hosts', 'live.wsp')
+        self.idle = os.path.join(self.whisper_dir, 'hosts', 'idle.wsp')
+        whisper.create(self.live, [(10, 60), (60, 1440)], aggregationMethod='max')
+        whisper.create(self.idle, [(60, 60)])
+        self.idle_mtime = int(time.time()) - 86400
+        os.utime(self.idle, (self.idle_mtime, self.idle_mtime))
+
+    def test_metadata(self):
+        self.assertEqual(write_catalog([self.whisper_dir], self.catalog_file), 2)
+        metric_catalog = MetricCatalog(self.catalog_file)
+        self.assertEqual(metric_catalog.lookup(self.live)[1:4], (86400, 10, 'max'))
+        self.assertEqual(metric_catalog.lookup(self.idle)[:4],
+                         (self.idle_mtime, 3600, 60, 'average'))
+        self.assertEqual(metric_catalog.lookup('/missing.wsp'), None)
+
+        now = time.time()
+        live_mtime = os.stat(self.live).st_mtime
+        live_interval = list(metric_catalog.get_intervals(self.live, now))[0]
+        self.assertEqual((live_interval.start, live_interval.end),
+                         (now - 86400, live_mtime))
+        # Idle for longer than its retention, so it holds no data at all
+        idle_interval = list(metric_catalog.get_intervals(self.idle, now))[0]
+        self.assertEqual(idle_interval.size, 0)
+
+        # Written to again after the build
+        os.utime(self.idle, (int(now), int(now)))
+        idle_interval = list(metric_catalog.get_intervals(self.idle, now))[0]
+        self.assertEqual((idle_interval.start, idle_interval.end), (now - 3600, int(now)))
+
+        # No longer written to since the build
+        os.utime(self.live, (int(now) - 7200, int(now) - 7200))
+        live_interval = list(metric_catalog.get_intervals(self.live, now))[0]
+        self.assertEqual(live_interval.end, int(now) - 7200)
+
+    def test_rebuild_reads_changed_headers(self):
+        write_catalog([self.whisper_dir], self.catalog_file)
+        os.unlink(self.idle)
+        whisper.create(self.idle, [(60, 120)])
+
+        with patch('graphite.metrics.catalog.read_metadata',
+                   wraps=catalog.read_metadata) as read_metadata:
+            self.assertEqual(write_catalog([self.whisper_dir], self.catalog_file), 2)
+        self.assertEqual([call[0][0] for call in read_metadata.call_args_list],
+                         [self.idle])
+        self.assertEqual(MetricCatalog(self.catalog_file).lookup(self.idle)[1], 7200)
+
+    def test_finder_uses_catalog(self):
+        write_catalog([self.whisper_dir], self.catalog_file)
+        finder = StandardFinder([self.whisper_dir])
+        query = FindQuery('hosts.*', None, None)
+
+        with override_settings(USE_METRIC_CATALOG=True,
+                               METRIC_CATALOG_FILE=self.catalog_file):
+            self.assertEqual(get_catalog().catalog_file, self.catalog_file)
+            with patch('whisper.info', side_effect=AssertionError):
+                # The catalog is only consulted once intervals are needed
+                with patch.object(MetricCatalog, 'lookup') as lookup:
+                    nodes = sorted(finder.find_nodes(query), key=lambda node: node.path)
+                    self.assertFalse(lookup.called)
+                self.assertEqual([node.path for node in nodes],
+                                 ['hosts.idle', 'hosts.live'])
+                self.assertAlmostEqual(nodes[1].intervals.size, 86400, delta=60)
+
+        self.assertEqual(get_catalog(), None)
+        nodes = list(finder.find_nodes(query))
+        self.assertTrue(all(node._intervals is None for node in nodes))
+
+    def test_cached_finds_keep_intervals(self):
+        write_catalog([self.whisper_dir], self.catalog_file)
+        with override_settings(USE_METRIC_CATALOG=True, LOCAL_FIND_CACHE_SIZE=10,
+                               METRIC_CATALOG_FILE=self.catalog_file):
+            store = Store(finders=[StandardFinder([self.whisper_dir])], hosts=[])
+            self.assertEqual(len(list(store.find('hosts.live'))), 1)
+            with patch('whisper.info', side_effect=AssertionError):
+                nodes = list(store.find('hosts.live'))
+                self.assertAlmostEqual(nodes[0].intervals.size, 86400, delta=60)
+            self.assertEqual(len(store.local_find_cache), 1)
@@ -1,11 +1,21 @@
+import os
 import random
+import shutil
 import time
 
+from mock import patch
+
+from django.conf import settings
+from django.core.cache import get_cache
 from django.test import TestCase
 
+from graphite.finders import list_directory, match_entries
+from graphite.finders.standard import StandardFinder
+from graphite.finders.trie import TrieFinder
 from graphite.intervals import Interval, IntervalSet
 from graphite.node import LeafNode, BranchNode
-from graphite.storage import Store, get_finder
+from graphite.storage import (FindQuery, Store, get_finder,
+                              measure_of_added_coverage, select_minimal_node_set)
 
 
 class FinderTest(TestCase):
@@ -24,6 +34,349 @@ class FinderTest(TestCase):
         self.assertEqual(time_info, (100, 200, 10))
         self.assertEqual(len(series), 10)
 
+    def test_lazy_intervals(self):
+        store = Store(finders=[get_finder('tests.test_finders.DummyFinder')])
+        nodes = list(store.find('bar.*'))
+        self.assertEqual(len(nodes), 10)
+        self.assertTrue(all(node._intervals is None for node in nodes))
+
+        # Bounded queries still select nodes by their intervals
+        nodes = list(store.find('bar.*', time.time() - 600, time.time()))
+        self.assertEqual(len(nodes), 10)
+        self.assertTrue(all(node._intervals is not None for node in nodes))
+        self.assertEqual(list(store.find('bar.*', 100, 200)), [])
+
+    def test_parallel_finders(self):
+        finders = [SlowFinder('a'), SlowFinder('b'), SlowFinder('c')]
+        with self.settings(FIND_POOL_SIZE=3):
+            t = time.time()
+            nodes = list(Store(finders=finders, hosts=[]).find('*'))
+            elapsed = time.time() - t
+        self.assertEqual(sorted(node.path for node in nodes), ['a', 'b', 'c'])
+        self.assertTrue(elapsed < 2 * SlowFinder.delay, elapsed)
+
+    def test_find_tasks(self):
+        roots = [os.path.join(settings.TEMP_GRAPHITE_DIR, 'tasks%d' % i)
+                 for i in range(3)]
+        for (i, root) in enumerate(roots):
+            os.makedirs(os.path.join(root, 'disk%d' % i))
+            open(os.path.join(root, 'disk%d' % i, 'load.wsp'), 'w').close()
+            self.addCleanup(shutil.rmtree, root)
+
+        finder = StandardFinder(roots)
+        self.assertEqual(len(finder.find_tasks(FindQuery('*.load', None, None))), 3)
+        for pool_size in [0, 3]:
+            with self.settings(FIND_POOL_SIZE=pool_size):
+                nodes = Store(finders=[finder], hosts=[]).find('*.load')
+                self.assertEqual(sorted(node.path for node in nodes),
+                                 ['disk0.load', 'disk1.load', 'disk2.load'])
+
+
+class NegativeFindCacheTest(TestCase):
+    def setUp(self):
+        cache = get_cache('django.core.cache.backends.locmem.LocMemCache')
+        cache.clear()
+        patcher = patch('graphite.storage.cache', cache)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        self.finder = DummyFinder()
+        self.store = Store(finders=[self.finder], hosts=[])
+
+    def find(self, pattern, *args):
+        with patch.object(self.finder, 'find_nodes',
+                          wraps=self.finder.find_nodes) as find_nodes:
+            nodes = list(self.store.find(pattern, *args))
+        return (len(nodes), find_nodes.call_count)
+
+    def test_misses_are_cached(self):
+        with self.settings(NEGATIVE_FIND_CACHE_DURATION=60):
+            self.assertEqual(self.find('missing.*'), (0, 1))
+            self.assertEqual(self.find('missing.*'), (0, 0))
+            self.assertEqual(self.find('missing.*', 0, 100), (0, 1))
+            self.assertEqual(self.find('bar.*'), (10, 1))
+            self.assertEqual(self.find('bar.*'), (10, 1))
+
+    def test_disabled(self):
+        self.assertEqual(self.find('missing.*'), (0, 1))
+        self.assertEqual(self.find('missing.*'), (0, 1))
+
+    def test_non_ascii_pattern(self):
+        with self.settings(NEGATIVE_FIND_CACHE_DURATION=60):
+            self.assertEqual(self.find(u'caf\xe9.*'), (0, 1))
+            self.assertEqual(self.find(u'caf\xe9.*'), (0, 0))
+
+    def test_unbucketed_times(self):
+        with self.settings(NEGATIVE_FIND_CACHE_DURATION=60, FIND_CACHE_DURATION=0):
+            self.assertEqual(self.find('missing.*', 10, 100), (0, 1))
+            self.assertEqual(self.find('missing.*', 10, 100), (0, 0))
+            self.assertEqual(self.find('missing.*', 11, 100), (0, 1))
+
+    def test_index_rebuild_invalidates(self):
+        index_file = os.path.join(settings.TEMP_GRAPHITE_DIR, 'negative_index')
+        open(index_file, 'w').close()
+        self.addCleanup(os.unlink, index_file)
+
+        with self.settings(NEGATIVE_FIND_CACHE_DURATION=60, INDEX_FILE=index_file):
+            self.assertEqual(self.find('missing.*'), (0, 1))
+            self.assertEqual(self.find('missing.*'), (0, 0))
+            mtime = int(os.path.getmtime(index_file)) + 10
+            os.utime(index_file, (mtime, mtime))
+            self.assertEqual(self.find('missing.*'), (0, 1))
+
+    def test_failed_remote_store(self):
+        request = type('FailedRequest', (object,),
+                       {'failed': True, 'get_results': lambda self: []})()
+        self.store.remote_stores = [
+            type('RemoteStore', (object,),
+                 {'available': True, 'find': lambda self, query: request})()]
+        with self.settings(NEGATIVE_FIND_CACHE_DURATION=60):
+            self.assertEqual(self.find('missing.*'), (0, 1))
+            self.assertEqual(self.find('missing.*'), (0, 1))
+
+
+class LocalFindCacheTest(TestCase):
+    def setUp(self):
+        self.finder = DummyFinder()
+        with self.settings(LOCAL_FIND_CACHE_SIZE=10):
+            self.store = Store(finders=[self.finder], hosts=[])
+
+    def find(self, pattern):
+        with patch.object(self.finder, 'find_nodes',
+                          wraps=self.finder.find_nodes) as find_nodes:
+            with self.settings(LOCAL_FIND_CACHE_SIZE=10):
+                nodes = sorted(self.store.find(pattern), key=lambda node: node.path)
+        return (nodes, find_nodes.call_count)
+
+    def test_cached(self):
+        (nodes, calls) = self.find('bar.*')
+        self.assertEqual(calls, 1)
+        nodes[0].intervals
+
+        (cached_nodes, calls) = self.find('bar.*')
+        self.assertEqual(calls, 0)
+        self.assertEqual([node.path for node in cached_nodes],
+                         [node.path for node in nodes])
+        self.assertTrue(cached_nodes[0].reader is nodes[0].reader)
+        # Nodes are created again, intervals are computed for each request
+        self.assertFalse(cached_nodes[0] is nodes[0])
+        self.assertEqual(cached_nodes[0]._intervals, None)
+
+        self.assertEqual(self.find('foo')[1], 1)
+        self.assertEqual(self.find('foo')[1], 0)
+
+    def test_expiry(self):
+        with self.settings(FIND_CACHE_DURATION=0):
+            self.assertEqual(self.find('bar.*')[1], 1)
+            self.assertEqual(self.find('bar.*')[1], 1)
+            self.assertEqual(len(self.store.local_find_cache), 0)
+
+    def test_custom_nodes_not_cached(self):
+        self.find('foo')
+        self.assertEqual(len(self.store.local_find_cache), 1)
+
+        custom_node = type('CustomNode', (BranchNode,), {})('custom')
+        self.finder.find_nodes = lambda query: [custom_node]
+        with self.settings(LOCAL_FIND_CACHE_SIZE=10):
+            self.assertEqual(list(self.store.find('custom')), [custom_node])
+        self.assertEqual(len(self.store.local_find_cache), 1)
+
+
+class MinimalNodeSetTest(TestCase):
+    def node(self, intervals, local=False):
+        node = LeafNode('a.b', DummyReader('a.b'))
+        node.intervals = IntervalSet([Interval(*i) for i in intervals])
+        node.local = local
+        return node
+
+    def test_added_coverage(self):
+        covered = IntervalSet([Interval(0, 10), Interval(20, 30), Interval(40, 50)])
+        for intervals in [[(0, 60)], [(5, 25), (45, 55)], [(10, 20)], [(60, 70)],
+                          [(20, 30)], [(-10, 0), (25, 42)]]:
+            relevant = IntervalSet([Interval(*i) for i in intervals])
+            self.assertEqual(measure_of_added_coverage(covered, relevant),
+                             covered.union(relevant).size - covered.size)
+
+    def test_selection(self):
+        local = self.node([(0, 50)], local=True)
+        remote = self.node([(0, 80)])
+        useless = self.node([(10, 40)])
+        tail = self.node([(70, 100)])
+        self.assertEqual(
+            select_minimal_node_set([useless, local, remote, tail], Interval(0, 100)),
+            set([local, remote, tail]))
+        # Only coverage before the tolerance window counts for remote nodes
+        self.assertEqual(
+            select_minimal_node_set([local, remote, tail], Interval(0, 100),
+                                    Interval(float('-inf'), 60)),
+            set([local, remote]))
+        self.assertEqual(select_minimal_node_set([remote], Interval(200, 300)), set())
+
+    def test_greedy_order(self):
+        # Each step takes the node adding the most to what is already covered
+        small = self.node([(0, 30)])
+        large = self.node([(20, 100)])
+        filler = self.node([(5, 25)])
+        self.assertEqual(
+            select_minimal_node_set([small, filler, large], Interval(0, 100)),
+            set([large, small]))
+
+
+class MatchEntriesTest(TestCase):
+    entries = ['api01', 'api02', 'api11', 'db01', 'web01', 'web02', 'web03',
+               'web{01}', 'x,y', 'a*b', 'a-b']
+
+    def test_wildcards(self):
+        self.assertEqual(match_entries(self.entries, 'web0?'),
+                         ['web01', 'web02', 'web03'])
+        self.assertEqual(match_entries(self.entries, '[ad]*1'),
+                         ['api01', 'api11', 'db01'])
+        self.assertEqual(match_entries(self.entries, 'web0[!12]'), ['web03'])
+        self.assertEqual(match_entries(self.entries, 'a\\*b'), ['a*b'])
+        self.assertEqual(match_entries(self.entries, 'x,y'), ['x,y'])
+
+    def test_braces(self):
+        self.assertEqual(match_entries(self.entries, '{web,api}{01,02}'),
+                         ['api01', 'api02', 'web01', 'web02'])
+        self.assertEqual(match_entries(self.entries, '{web0{1,3},db*}'),
+                         ['db01', 'web01', 'web03'])
+        self.assertEqual(match_entries(self.entries, '{,a}pi0{1}'), ['api01'])
+        # Unbalanced or escaped braces are literal
+        self.assertEqual(match_entries(self.entries, 'web{01'), [])
+        self.assertEqual(match_entries(self.entries, 'web\\{01\\}'), ['web{01}'])
+        self.assertEqual(match_entries(self.entries, 'web[{]01}'), ['web{01}'])
+
+
+class StandardFinderTest(TestCase):
+    finder_class = StandardFinder
+
+    def setUp(self):
+        self.root = os.path.join(settings.TEMP_GRAPHITE_DIR, 'finder')
+        for path in ['servers/web1/cpu.wsp', 'servers/web1/load.wsp',
+                     'servers/web2/cpu.wsp', 'servers/web2/disk/sda.wsp',
+                     'servers/.hidden.wsp', 'servers/notes.txt']:
+            path = os.path.join(self.root, path)
+            if not os.path.isdir(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path))
+            open(path, 'w').close()
+        os.symlink(os.path.join(self.root, 'servers', 'web1'),
+                   os.path.join(self.root, 'servers', 'web3'))
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def find(self, pattern, finder=None):
+        finder = finder or self.finder_class([self.root])
+        nodes = finder.find_nodes(FindQuery(pattern, None, None))
+        return sorted((node.path, node.is_leaf) for node in nodes)
+
+    def check_find(self):
+        self.assertEqual(self.find('servers.*'), [
+            ('servers.web1', False),
+            ('servers.web2', False), ('servers.web3', False)])
+        self.assertEqual(self.find('servers.*.cpu'), [
+            ('servers.web1.cpu', True), ('servers.web2.cpu', True),
+            ('servers.web3.cpu', True)])
+        self.assertEqual(self.find('servers.web2.*'), [
+            ('servers.web2.cpu', True), ('servers.web2.disk', False)])
+        self.assertEqual(self.find('servers.{web1,web2}.load'), [
+            ('servers.web1.load', True)])
+        self.assertEqual(self.find('missing.*'), [])
+
+    def test_find_nodes(self):
+        self.check_find()
+
+    def test_find_nodes_without_scandir(self):
+        with patch('graphite.finders.scandir', None):
+            self.check_find()
+
+    def test_literal_components(self):
+        with patch('graphite.finders.standard.list_directory',
+                   wraps=list_directory) as listing:
+            self.assertEqual(self.find('servers.web2.disk.sda'), [
+                ('servers.web2.disk.sda', True)])
+            self.assertEqual(self.find('servers.web2.disk'), [
+                ('servers.web2.disk', False)])
+            self.assertEqual(self.find('servers.web2.missing.sda'), [])
+            self.assertEqual(listing.call_count, 0)
+
+            self.assertEqual(self.find('servers.*.cpu'), [
+                ('servers.web1.cpu', True), ('servers.web2.cpu', True),
+                ('servers.web3.cpu', True)])
+            self.assertEqual(listing.call_count, 1)
+
+    def test_unusable_literal_components(self):
+        outside = os.path.dirname(self.root)
+        for pattern in ['', outside, outside + '.*', 'servers..web1',
+                        'servers/web1', 'servers/web1.cpu', 'servers.web1/cpu']:
+            self.assertEqual(self.find(pattern), [], pattern)
+
+    def test_unencodable_literal_components(self):
+        with patch('sys.getfilesystemencoding', return_value='ascii'):
+            self.assertEqual(self.find(u'servers.caf\xe9'), [])
+            self.assertEqual(self.find(u'servers.caf\xe9.cpu'), [])
+            self.assertEqual(self.find(u'servers.web1.cpu'),
+                             [('servers.web1.cpu', True)])
+
+
+class TrieFinderTest(StandardFinderTest):
+    finder_class = TrieFinder
+
+    def test_literal_components(self):
+        finder = TrieFinder([self.root])
+        self.find('servers', finder)
+        with patch('graphite.finders.trie.list_directory') as listing:
+            self.assertEqual(self.find('servers.web2.disk.sda', finder), [
+                ('servers.web2.disk.sda', True)])
+            self.assertEqual(self.find('servers.*.cpu', finder), [
+                ('servers.web1.cpu', True), ('servers.web2.cpu', True),
+                ('servers.web3.cpu', True)])
+            self.assertEqual(listing.call_count, 0)
+
+    def test_refresh(self):
+        finder = TrieFinder([self.root])
+        self.assertEqual(self.find('servers.web2.*', finder), [
+            ('servers.web2.cpu', True), ('servers.web2.disk', False)])
+
+        os.unlink(os.path.join(self.root, 'servers/web2/cpu.wsp'))
+        os.mkdir(os.path.join(self.root, 'servers/web2/net'))
+        open(os.path.join(self.root, 'servers/web2/net/eth0.wsp'), 'w').close()
+        with self.settings(TRIE_FINDER_REFRESH_INTERVAL=0):
+            # Starts a refresh in the background
+            self.find('servers.web2.*', finder)
+            finder.refresher.join()
+            self.assertEqual(self.find('servers.web2.*', finder), [
+                ('servers.web2.disk', False), ('servers.web2.net', False)])
+            self.assertEqual(self.find('servers.web2.net.*', finder), [
+                ('servers.web2.net.eth0', True)])
+
+    def test_background_refresh(self):
+        finder = TrieFinder([self.root])
+        self.find('servers', finder)
+        with self.settings(TRIE_FINDER_REFRESH_INTERVAL=0):
+            with patch.object(finder, 'refresh', side_effect=lambda: time.sleep(0.5)):
+                start = time.time()
+                self.assertEqual(len(self.find('servers.*', finder)), 3)
+                self.assertTrue(time.time() - start < 0.25)
+                finder.refresher.join()
+
+    def test_index(self):
+        index_file = os.path.join(self.root, 'index')
+        with open(index_file, 'w') as index:
+            index.write('servers.web1.cpu\nservers.web1.load\nservers.db1.cpu\n')
+
+        with self.settings(TRIE_FINDER_USE_INDEX=True, INDEX_FILE=index_file,
+                           WHISPER_DIR=self.root):
+            finder = TrieFinder()
+            # servers.db1.cpu has no whisper file
+            self.assertEqual(self.find('servers.*.cpu', finder), [
+                ('servers.web1.cpu', True)])
+            self.assertEqual(self.find('servers.*', finder), [
+                ('servers.db1', False), ('servers.web1', False)])
+            node = list(finder.find_nodes(FindQuery('servers.web1.load', None, None)))[0]
+            self.assertEqual(node.reader.fs_path,
+                             os.path.join(self.root, 'servers/web1/load.wsp'))
+
 
 class DummyReader(object):
     __slots__ = ('path',)
@@ -50,3 +403,14 @@ class DummyFinder(object):
             for i in xrange(10):
                 path = 'bar.{0}'.format(i)
                 yield LeafNode(path, DummyReader(path))
+
+
+class SlowFinder(object):
+    delay = 0.2
+
+    def __init__(self, name):
+        self.name = name
+
+    def find_nodes(self, query):
+        time.sleep(self.delay)
+        yield BranchNode(self.name)
@@ -0,0 +1,67 @@
+import bisect
+from hashlib import md5
+
+from django.test import TestCase
+
+from graphite.render.hashing import ConsistentHashRing, fnv32a
+
+
+def reference_get_nodes(ring, key):
+    """The ring walk ConsistentHashRing used before lookups were precomputed"""
+    position = int(md5(str(key)).hexdigest()[:4], 16)
+    index = bisect.bisect_left(ring.ring, (position, None)) % ring.ring_len
+    last_index = (index - 1) % ring.ring_len
+    nodes = []
+    while len(nodes) < ring.nodes_len and index != last_index:
+        node = ring.ring[index][1]
+        if node not in nodes:
+            nodes.append(node)
+        index = (index + 1) % ring.ring_len
+    return nodes
+
+
+class ConsistentHashRingTest(TestCase):
+    def setUp(self):
+        self.hosts = [('127.0.0.1', str(i)) for i in range(8)]
+        self.keys = ['collectd.host%d.cpu.%d' % (i, i % 7) for i in range(2000)]
+
+    def test_carbon_placement(self):
+        ring = ConsistentHashRing(self.hosts, cache_size=100)
+        for key in self.keys:
+            expected = reference_get_nodes(ring, key)
+            self.assertEqual(ring.get_nodes(key), expected)
+            self.assertEqual(ring.get_node(key), expected[0])
+        # memoized lookups return the same placement
+        for key in self.keys:
+            self.assertEqual(ring.get_nodes(key), reference_get_nodes(ring, key))
+
+    def test_remove_node(self):
+        ring = ConsistentHashRing(self.hosts, cache_size=100)
+        placement = dict((key, ring.get_node(key)) for key in self.keys)
+        ring.remove_node(self.hosts[0])
+        for key in self.keys:
+            if placement[key] != self.hosts[0]:
+                self.assertEqual(ring.get_node(key), placement[key])
+            else:
+                self.assertNotEqual(ring.get_node(key), self.hosts[0])
+
+    def test_fnv1a_ch(self):
+        ring = ConsistentHashRing(self.hosts, hash_type='fnv1a_ch')
+        # FNV-1a test vectors
+        self.assertEqual(fnv32a(''), 0x811c9dc5)
+        self.assertEqual(fnv32a('foobar'), 0xbf9cf968)
+        # The two 16 bit halves are folded into a single ring position
+        self.assertEqual(ring.compute_ring_position('foobar'), 0xbf9c ^ 0xf968)
+        for key in self.keys:
+            nodes = ring.get_nodes(key)
+            self.assertEqual(sorted(nodes), sorted(self.hosts))
+
+        # Replicas are keyed on the instance name only, like carbon does
+        moved = ConsistentHashRing([('10.0.0.%d' % i, instance)
+                                    for (i, (server, instance)) in enumerate(self.hosts)],
+                                   hash_type='fnv1a_ch')
+        for key in self.keys:
+            self.assertEqual(moved.get_node(key)[1], ring.get_node(key)[1])
+
+        self.assertRaises(ValueError, ConsistentHashRing, self.hosts,
+                          hash_type='unknown')
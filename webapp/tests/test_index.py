@@ -0,0 +1,169 @@
+import os
+import re
+import shutil
+import time
+
+from mock import patch
+
+from django.conf import settings
+from django.test import TestCase
+
+from graphite.metrics.index import (BinaryIndex, SearchIndexCorrupt,
+                                    is_binary_index, read_index_paths,
+                                    write_binary_index)
+from graphite.metrics.ngram import TrigramIndex, required_literals
+from graphite.metrics.search import IndexSearcher
+from graphite.util import write_index
+
+from . import DATA_DIR
+
+
+class BinaryIndexTest(TestCase):
+    def setUp(self):
+        self.text_index = os.path.join(DATA_DIR, 'index')
+        with open(self.text_index) as index:
+            self.paths = [line.strip() for line in index if line.strip()]
+        self.paths += ['servers.web1.cpu', 'servers.web2.cpu', 'servers.web2',
+                       'servers.web10.cpu', 'servers.web1.cpu']
+
+        self.binary_index = os.path.join(settings.TEMP_GRAPHITE_DIR, 'index.bin')
+        with open(self.binary_index, 'wb') as index:
+            self.assertEqual(write_binary_index(self.paths, index),
+                             len(set(self.paths)))
+
+    def tearDown(self):
+        os.unlink(self.binary_index)
+
+    def test_paths(self):
+        self.assertTrue(is_binary_index(self.binary_index))
+        self.assertFalse(is_binary_index(self.text_index))
+        self.assertEqual(list(read_index_paths(self.binary_index)),
+                         sorted(set(self.paths), key=lambda p: p.split('.')))
+
+        index = BinaryIndex(self.binary_index)
+        self.assertEqual(index.child(index.root_offset, 'servers')[:2],
+                         ('servers', False))
+        self.assertEqual(index.child(index.root_offset, 'other'), None)
+
+    def test_search_matches_text_index(self):
+        # The text index loses the children of a metric listed after them
+        text_index = os.path.join(settings.TEMP_GRAPHITE_DIR, 'index.txt')
+        with open(text_index, 'w') as index:
+            index.write('\n'.join(read_index_paths(self.binary_index)) + '\n')
+        self.addCleanup(os.unlink, text_index)
+
+        text_searcher = IndexSearcher(text_index)
+        binary_searcher = IndexSearcher(self.binary_index)
+        for query in ['collectd', 'collectd.test.load.load', 'collectd.*.df-root.*',
+                      'servers.web1*.cpu', 'servers.{web2,web10}', 'missing.*']:
+            self.assertEqual(sorted(binary_searcher.search(query)),
+                             sorted(text_searcher.search(query)))
+
+    def test_corrupt(self):
+        with open(self.binary_index, 'r+b') as index:
+            index.truncate(8)
+        self.assertRaises(SearchIndexCorrupt, BinaryIndex, self.binary_index)
+
+    def test_write_index(self):
+        whisper_dir = os.path.join(settings.TEMP_GRAPHITE_DIR, 'index_whisper')
+        os.makedirs(os.path.join(whisper_dir, 'a', 'b'))
+        for name in ['c.wsp', 'd.wsp']:
+            open(os.path.join(whisper_dir, 'a', 'b', name), 'w').close()
+        self.addCleanup(shutil.rmtree, whisper_dir)
+
+        write_index(whisper_dir, whisper_dir, self.binary_index, 'binary')
+        self.assertEqual(list(read_index_paths(self.binary_index)),
+                         ['a.b.c', 'a.b.d'])
+
+
+class TrigramIndexTest(TestCase):
+    def setUp(self):
+        with open(os.path.join(DATA_DIR, 'index')) as index:
+            self.paths = [line.strip() for line in index if line.strip()]
+        self.paths += ['servers.Web1.CPU', 'servers.web2.cpu', 'servers.db1.disk']
+        self.index = TrigramIndex(self.paths)
+
+    def test_required_literals(self):
+        self.assertEqual(required_literals('Web1.cpu'), ['web1', 'cpu'])
+        self.assertEqual(required_literals('df-(root|var)$'), ['df-'])
+        self.assertEqual(required_literals('a.*b'), ['a', 'b'])
+        self.assertEqual(required_literals('(unbalanced'), [])
+
+    def test_search_matches_scan(self):
+        for patterns in [['web1'], ['CPU'], ['load', 'db1'], ['df-root$'],
+                         ['w.b'], ['^servers\\.web[0-9]'], ['x'], ['missing']]:
+            regexes = [re.compile(pattern, re.I) for pattern in patterns]
+            expected = [path for path in self.paths
+                        if any(regex.search(path) for regex in regexes)]
+            self.assertEqual(self.index.search(patterns), expected)
+        self.assertEqual(len(self.index.search(['collectd'], 3)), 3)
+
+    def test_candidates(self):
+        self.assertEqual(self.index.candidates(['db1']),
+                         [self.paths.index('servers.db1.disk')])
+        self.assertEqual(self.index.candidates(['missing']), [])
+        self.assertEqual(self.index.candidates(['ab']), None)
+
+
+class IndexReloadTest(TestCase):
+    def setUp(self):
+        self.index_path = os.path.join(settings.TEMP_GRAPHITE_DIR, 'index.reload')
+        self.write(['a.b.c'])
+        self.addCleanup(os.unlink, self.index_path)
+        self.searcher = IndexSearcher(self.index_path)
+
+    def write(self, paths, mtime=None):
+        with open(self.index_path, 'w') as index:
+            index.write('\n'.join(paths) + '\n')
+        if mtime is not None:
+            os.utime(self.index_path, (mtime, mtime))
+
+    def paths(self, query='a.*.*'):
+        return [result['path'] for result in self.searcher.search(query)
+                if result['is_leaf']]
+
+    def test_background_reload(self):
+        self.assertEqual(self.searcher.substring_search(['b']), ['a.b.c'])
+        self.searcher.trigram_builder.join()
+        self.assertTrue(self.searcher.last_reload_duration >= 0)
+        snapshot = self.searcher.snapshot
+
+        self.write(['a.b.c', 'a.d.e'], int(snapshot.mtime) + 10)
+        # The stale snapshot answers until the reload is done
+        self.assertEqual(self.paths(), ['a.b.c'])
+        self.searcher.reloader.join()
+        self.assertNotEqual(self.searcher.snapshot, snapshot)
+        self.assertEqual(sorted(self.paths()), ['a.b.c', 'a.d.e'])
+        # The trigram index was rebuilt with the snapshot
+        self.searcher.trigram_builder.join()
+        self.assertNotEqual(self.searcher.snapshot.trigram_index, None)
+        self.assertEqual(self.searcher.substring_search(['d.e']), ['a.d.e'])
+
+    def test_scan_until_trigram_index_is_built(self):
+        with patch.object(IndexSearcher, 'load_trigram_index',
+                          side_effect=lambda: time.sleep(0.2) or TrigramIndex(['a.b.c'])):
+            self.assertEqual(self.searcher.substring_search(['b']), ['a.b.c'])
+            self.assertEqual(self.searcher.snapshot.trigram_index, None)
+            self.assertTrue(self.searcher.trigram_builder.is_alive())
+            self.assertEqual(self.searcher.substring_search(['c$']), ['a.b.c'])
+            self.searcher.trigram_builder.join()
+        self.assertNotEqual(self.searcher.snapshot.trigram_index, None)
+
+    def test_trigram_index_disabled(self):
+        with self.settings(INDEX_TRIGRAMS=False):
+            self.assertEqual(self.searcher.substring_search(['b']), ['a.b.c'])
+        self.assertEqual(self.searcher.trigram_builder, None)
+
+    def test_failed_reload_keeps_index(self):
+        snapshot = self.searcher.snapshot
+        mtime = int(snapshot.mtime) + 10
+        with open(self.index_path, 'wb') as index:
+            index.write('GIDX')
+        os.utime(self.index_path, (mtime, mtime))
+
+        self.assertEqual(self.paths(), ['a.b.c'])
+        self.searcher.reloader.join()
+        self.assertEqual(self.searcher.snapshot, snapshot)
+        self.assertEqual(self.searcher.failed_mtime, mtime)
+        self.assertEqual(self.paths(), ['a.b.c'])
+        self.assertFalse(self.searcher.reloader.is_alive())
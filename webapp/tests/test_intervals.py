@@ -0,0 +1,67 @@
+import pickle
+import random
+
+from django.test import TestCase
+
+from graphite.intervals import INFINITY, Interval, IntervalSet
+from graphite.util import unpickle
+
+
+def random_set(count):
+    bounds = sorted(random.sample(range(1000), count * 2))
+    return IntervalSet([Interval(bounds[i], bounds[i + 1])
+                        for i in range(0, len(bounds), 2)])
+
+
+def covered_points(interval_set):
+    "The integer points an IntervalSet covers, as half-open [start, end)"
+    return set(point for interval in interval_set
+               for point in range(int(interval.start), int(interval.end)))
+
+
+class IntervalSetTest(TestCase):
+    # Pickled by the version that kept a list of Interval objects
+    OLD_PICKLE = '\x80\x02(cgraphite.intervals\nIntervalSet\nq\x00oq\x01}q\x02(U\tintervalsq\x03]q\x04((cgraphite.intervals\nInterval\nq\x05oq\x06}q\x07(U\x05startq\x08K\x00U\x04sizeq\tK\nU\x03endq\nK\nU\x05tupleq\x0bK\x00K\n\x86q\x0cub(h\x05oq\r}q\x0e(h\x08K\x14h\tK\nh\nK\x1eh\x0bK\x14K\x1e\x86q\x0fubeh\tK\x14ub.'
+
+    def test_construction(self):
+        intervals = IntervalSet([Interval(20, 30), Interval(0, 10),
+                                 Interval(5, 15), Interval(15, 18)])
+        self.assertEqual(intervals.intervals, [Interval(0, 18), Interval(20, 30)])
+        self.assertEqual(intervals.size, 28)
+        self.assertFalse(IntervalSet([]))
+
+    def test_operations_match_points(self):
+        random.seed(1)
+        for i in range(200):
+            a = random_set(random.randint(0, 10))
+            b = random_set(random.randint(0, 10))
+            self.assertEqual(covered_points(a.union(b)),
+                             covered_points(a) | covered_points(b))
+            self.assertEqual(covered_points(a.intersect(b)),
+                             covered_points(a) & covered_points(b))
+            self.assertEqual(covered_points(a - b),
+                             covered_points(a) - covered_points(b))
+            self.assertEqual(a.union(b).size,
+                             sum(interval.size for interval in a.union(b)))
+
+            window = Interval(*sorted(random.sample(range(1000), 2)))
+            self.assertEqual(covered_points(a.intersect_interval(window)),
+                             covered_points(a) & covered_points(IntervalSet([window])))
+
+    def test_complement(self):
+        intervals = IntervalSet([Interval(-INFINITY, 0), Interval(10, 20)])
+        self.assertEqual(intervals.complement().intervals,
+                         [Interval(0, 10), Interval(20, INFINITY)])
+        self.assertEqual(IntervalSet([]).complement().intervals,
+                         [Interval(-INFINITY, INFINITY)])
+
+    def test_pickle_compatibility(self):
+        intervals = unpickle.loads(self.OLD_PICKLE)
+        self.assertEqual(intervals.intervals, [Interval(0, 10), Interval(20, 30)])
+        self.assertEqual(intervals.size, 20)
+
+        state = pickle.loads(pickle.dumps(intervals, -1)).__getstate__()
+        self.assertEqual(state['size'], 20)
+        self.assertEqual(state['intervals'][1].__getstate__()['tuple'], (20, 30))
+        self.assertEqual(unpickle.loads(pickle.dumps(intervals, -1)).intervals,
+                         intervals.intervals)
@@ -0,0 +1,164 @@
+import os
+import time
+
+import whisper
+from mock import patch
+
+from django.conf import settings
+from django.test import TestCase
+from django.test.utils import override_settings
+
+from graphite import readers
+from graphite.node import LeafNode
+from graphite.readers import CeresReader, MultiReader, WhisperReader, fetch_multi
+
+
+class WhisperReaderTest(TestCase):
+    def setUp(self):
+        self.fs_path = os.path.join(settings.WHISPER_DIR, 'readers_test.wsp')
+        whisper.create(self.fs_path, [(60, 60), (300, 24)])
+        now = int(time.time())
+        whisper.update_many(self.fs_path, [(now - i * 60, i) for i in range(90)])
+        readers.whisper_header_cache.clear()
+
+    def tearDown(self):
+        os.unlink(self.fs_path)
+
+    def test_mmap_fetch_matches_whisper(self):
+        now = int(time.time())
+        for (start, end) in [(now - 1800, now), (now - 7200, now - 600),
+                             (now - 86400, now), (now + 60, now + 120)]:
+            self.assertEqual(
+                readers.fetch_whisper_mmap(self.fs_path, start, end, now=now),
+                whisper.fetch(self.fs_path, start, end, now=now))
+
+    @override_settings(WHISPER_MMAP=True)
+    def test_mmap_header_cache(self):
+        reader = WhisperReader(self.fs_path, 'readers_test')
+        reader.get_intervals()
+        self.assertEqual(len(readers.whisper_header_cache), 1)
+        reader.get_intervals()
+        self.assertEqual(len(readers.whisper_header_cache), 1)
+
+        # The cache is keyed by file identity, so an update misses it
+        time.sleep(0.01)
+        os.utime(self.fs_path, None)
+        reader.fetch(time.time() - 600, time.time())
+        self.assertEqual(len(readers.whisper_header_cache), 2)
+
+    def test_empty_matches_read(self):
+        reader = WhisperReader(self.fs_path, 'readers_test')
+        now = int(time.time())
+        for (start, end) in [(now - 1800, now), (now - 86400, now - 600)]:
+            (time_info, values) = reader.read(start, end)
+            self.assertEqual(reader.empty(start, end),
+                             (time_info, [None] * len(values)))
+
+
+class FetchPlanTest(TestCase):
+    def test_plan_fetch_disabled(self):
+        self.assertEqual(readers.plan_fetch(0, 100, now=10 ** 9), (True, True))
+
+    @override_settings(CARBONLINK_CACHE_HORIZON=3600,
+                       CARBONLINK_CACHE_ONLY_WINDOW=120)
+    def test_plan_fetch(self):
+        now = 10 ** 9
+        self.assertEqual(readers.plan_fetch(now - 86400, now - 7200, now=now),
+                         (True, False))
+        self.assertEqual(readers.plan_fetch(now - 7200, now, now=now),
+                         (True, True))
+        self.assertEqual(readers.plan_fetch(now - 60, now, now=now),
+                         (False, True))
+
+    @override_settings(CARBONLINK_CACHE_HORIZON=3600,
+                       CARBONLINK_CACHE_ONLY_WINDOW=300)
+    def test_fetch_routing(self):
+        fs_path = os.path.join(settings.WHISPER_DIR, 'readers_plan_test.wsp')
+        whisper.create(fs_path, [(60, 1440)])
+        self.addCleanup(os.unlink, fs_path)
+        now = int(time.time())
+        whisper.update(fs_path, 1.0, now - 86400 + 600)
+        reader = WhisperReader(fs_path, 'readers_plan_test')
+
+        with patch('graphite.readers.CarbonLink') as carbonlink:
+            (time_info, values) = reader.fetch(now - 86400, now - 7200)
+            self.assertFalse(carbonlink.query_bulk.called)
+            self.assertEqual(len([v for v in values if v is not None]), 1)
+
+            carbonlink.query_bulk.return_value = {
+                'readers_plan_test': [(now - 60, 2.0)]}
+            with patch.object(WhisperReader, 'read') as read:
+                (time_info, values) = reader.fetch(now - 120, now)
+                self.assertFalse(read.called)
+            self.assertEqual([v for v in values if v is not None], [2.0])
+
+
+class CeresReaderTest(TestCase):
+    @override_settings(CARBONLINK_CACHE_ONLY_WINDOW=300)
+    def test_cache_only_window(self):
+        reader = CeresReader(CeresNode(60), 'ceres_test')
+        now = int(time.time())
+        with patch('graphite.readers.CarbonLink') as carbonlink:
+            carbonlink.query_bulk.return_value = {
+                'ceres_test': [(now - 60, 2.0)]}
+            ((start, end, step), values) = reader.fetch(now - 120, now)
+        self.assertEqual(step, 60)
+        self.assertEqual(len(values), (end - start) // step)
+        self.assertEqual([v for v in values if v is not None], [2.0])
+
+
+class FetchMultiTest(TestCase):
+    def test_fetch_multi(self):
+        BatchReader.batches = []
+        nodes = [LeafNode('a', BatchReader(1)), LeafNode('b', SingleReader(2)),
+                 LeafNode('c', BatchReader(3))]
+        results = fetch_multi(nodes, 0, 30)
+        self.assertEqual(results, [((0, 30, 10), [1, 1, 1]),
+                                   ((0, 30, 10), [2, 2, 2]),
+                                   ((0, 30, 10), [3, 3, 3])])
+        self.assertEqual(BatchReader.batches, [[1, 3]])
+
+    @override_settings(FETCH_POOL_SIZE=4, FETCH_CONCURRENCY=2)
+    def test_fetch_multi_concurrently(self):
+        nodes = [LeafNode(str(i), SingleReader(i)) for i in range(20)]
+        results = fetch_multi(nodes, 0, 10)
+        self.assertEqual([values for (time_info, values) in results],
+                         [[i] for i in range(20)])
+
+    def test_multi_reader_fetch_multi(self):
+        BatchReader.batches = []
+        multi_readers = [
+            MultiReader([LeafNode('a', BatchReader(1)), LeafNode('a', BatchReader(None))]),
+            MultiReader([LeafNode('b', BatchReader(2))]),
+        ]
+        results = MultiReader.fetch_multi(multi_readers, 0, 30)
+        self.assertEqual(len(BatchReader.batches), 1)
+        self.assertEqual([r.waitForResults() for r in results],
+                         [((0, 30, 10), [1, 1, 1]), ((0, 30, 10), [2, 2, 2])])
+
+
+class CeresNode(object):
+    "Like ceres.CeresNode, which only sets timeStep once readMetadata() ran"
+    def __init__(self, step):
+        self.step = step
+        self.timeStep = None
+
+    def readMetadata(self):
+        self.timeStep = self.step
+
+
+class SingleReader(object):
+    def __init__(self, value):
+        self.value = value
+
+    def fetch(self, start_time, end_time):
+        return (start_time, end_time, 10), [self.value] * ((end_time - start_time) / 10)
+
+
+class BatchReader(SingleReader):
+    batches = []
+
+    @classmethod
+    def fetch_multi(cls, readers, start_time, end_time):
+        cls.batches.append([r.value for r in readers])
+        return [r.fetch(start_time, end_time) for r in readers]
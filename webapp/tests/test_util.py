@@ -1,6 +1,13 @@
+import os
+import shutil
+
+from mock import call, patch
+
+from django.conf import settings
 from django.test import TestCase
 
 from graphite import util
+from graphite.finders import list_directory
 
 
 class UtilTest(TestCase):
@@ -8,3 +15,63 @@ class UtilTest(TestCase):
         addresses = ['127.0.0.1', '127.0.0.1:8080', '8.8.8.8']
         results = [ util.is_local_interface(a) for a in addresses ]
         self.assertEqual( results, [True, True, False] )
+
+
+class IncrementalIndexTest(TestCase):
+    def setUp(self):
+        self.root = os.path.join(settings.TEMP_GRAPHITE_DIR, 'incremental')
+        self.whisper_dir = os.path.join(self.root, 'whisper')
+        self.ceres_dir = os.path.join(self.root, 'ceres')
+        self.index = os.path.join(self.root, 'index')
+        for path in ['a/b/c.wsp', 'a/b/d.wsp', 'e/f.wsp', 'e/g/h.wsp']:
+            self.create(path)
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def create(self, path):
+        path = os.path.join(self.whisper_dir, path)
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        open(path, 'w').close()
+
+    def build(self, **kwargs):
+        util.write_index(self.whisper_dir, self.ceres_dir, self.index, 'text', **kwargs)
+        with open(self.index) as index:
+            return sorted(index.read().split())
+
+    def test_incremental_matches_full_build(self):
+        full = self.build()
+        self.assertEqual(full, ['a.b.c', 'a.b.d', 'e.f', 'e.g.h'])
+        self.assertEqual(self.build(incremental=True, jobs=4), full)
+        self.assertTrue(os.path.exists(self.index + '.state'))
+
+        self.create('a/b/x.wsp')
+        os.unlink(os.path.join(self.whisper_dir, 'e/f.wsp'))
+        self.assertEqual(self.build(incremental=True, jobs=4), self.build())
+
+    def test_unchanged_directories_are_not_listed(self):
+        self.build(incremental=True)
+        self.create('e/g/i.wsp')
+        with patch('graphite.finders.list_directory',
+                   wraps=list_directory) as listing:
+            self.assertEqual(self.build(incremental=True),
+                             ['a.b.c', 'a.b.d', 'e.f', 'e.g.h', 'e.g.i'])
+        self.assertEqual(listing.call_args_list,
+                         [call(os.path.join(self.whisper_dir, 'e/g'))])
+
+    def test_unreadable_directory(self):
+        self.build(incremental=True)
+        self.create('a/b/x.wsp')
+        unreadable = os.path.join(self.whisper_dir, 'a/b')
+
+        def listing(fs_dir):
+            if fs_dir == unreadable:
+                raise OSError(13, 'Permission denied', fs_dir)
+            return list_directory(fs_dir)
+
+        with patch('graphite.finders.list_directory', side_effect=listing):
+            self.assertEqual(self.build(incremental=True),
+                             ['e.f', 'e.g.h'])
+        self.assertEqual(self.build(incremental=True),
+                         ['a.b.c', 'a.b.d', 'a.b.x', 'e.f', 'e.g.h'])